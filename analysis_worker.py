@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Analysis worker, processes the analysis_jobs queue
+
+    Run as many of these as the Ollama hosts can keep busy, on one host
+    (--processes) or several; workers coordinate through the database
+    only, see services/jobqueue.py.
+
+    Usage:
+        python analysis_worker.py --enqueue --once
+        python analysis_worker.py --processes 4
+
+    ©2024, Ovais Quraishi
+"""
+
+import argparse
+import logging
+import multiprocessing
+import signal
+import threading
+
+from codescanner import get_scanner
+from services.analysis import NUM_ELEMENTS_CHUNK
+from services.jobqueue import (
+    default_worker_id,
+    enqueue_pending_notes,
+    queue_stats,
+    retry_failed_jobs,
+    run_worker,
+)
+
+
+def work(worker_id: str, batch_size: int, poll_interval: float, once: bool) -> None:
+    """One worker process, stops after its current batch on SIGTERM/SIGINT"""
+
+    logging.basicConfig(level=logging.INFO)
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    # load the ICD index before the analyses' event loop needs it
+    get_scanner()
+    run_worker(worker_id, batch_size, poll_interval, once, stop)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Analyze visit notes queued in analysis_jobs')
+    parser.add_argument('--worker-id', default=default_worker_id(), help='default host:pid')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes to run')
+    parser.add_argument('--batch-size', type=int, default=NUM_ELEMENTS_CHUNK, help='jobs leased at a time')
+    parser.add_argument('--poll-interval', type=float, default=10.0, help='seconds between polls of an empty queue')
+    parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+    parser.add_argument('--enqueue', action='store_true', help='enqueue notes not analyzed yet first')
+    parser.add_argument('--retry-failed', action='store_true', help='make failed jobs pending again first')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.retry_failed:
+        logging.info('Reset %s failed jobs', retry_failed_jobs())
+    if args.enqueue:
+        logging.info('Enqueued %s visit notes', enqueue_pending_notes())
+
+    if args.processes == 1:
+        work(args.worker_id, args.batch_size, args.poll_interval, args.once)
+    else:
+        processes = [multiprocessing.Process(target=work,
+                                             args=(f'{args.worker_id}/{i}', args.batch_size,
+                                                   args.poll_interval, args.once))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        # the children stop themselves on SIGINT/SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *_: [process.terminate() for process in processes])
+        for process in processes:
+            process.join()
+
+    logging.info('Analysis jobs by status: %s', queue_stats())
+
+
+if __name__ == '__main__':
+    main()
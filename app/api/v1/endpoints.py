@@ -32,6 +32,25 @@ async def health_check():
     )
 
 
+@router.get("/metrics")
+async def metrics(current_user: dict = Depends(get_current_user)):
+    """LLM call telemetry, response cache and Ollama host state.
+
+    Args:
+        current_user: Verified user from JWT token
+
+    Returns:
+        Counters and histograms per model and prompt type
+    """
+    from gptutils import HEALTH_MONITOR, ROUTER, cache_stats, telemetry_stats
+
+    return {
+        "llm_calls": telemetry_stats(),
+        "response_cache": cache_stats(),
+        "ollama_hosts": {"health": HEALTH_MONITOR.status(), "routing": ROUTER.status()},
+    }
+
+
 @router.post("/login", response_model=LoginResponse)
 async def login(request: LoginRequest):
     """Generate JWT access token.
@@ -62,7 +81,7 @@ async def analyze_visit_notes_endpoint(
         Message response
     """
     try:
-        if not analyze_visit_notes():
+        if not await analyze_visit_notes():
             raise HTTPException(status_code=502, detail="Ollama Server not available")
         return MessageResponse(message="analyze_visit_notes completed")
     except HTTPException:
@@ -87,7 +106,7 @@ async def analyze_visit_note_endpoint(
         Message response
     """
     try:
-        result = analyze_visit_note(visit_note_id)
+        result = await analyze_visit_note(visit_note_id)
         if not result:
             raise HTTPException(status_code=502, detail="Ollama Server not available")
         return MessageResponse(message="analyze_visit_note completed")
@@ -113,7 +132,7 @@ async def get_patient_endpoint(
         Patient record data
     """
     try:
-        patient_record = get_patient_record(patient_id)
+        patient_record = await get_patient_record(patient_id)
         if not patient_record:
             raise HTTPException(status_code=404, detail="Patient not found")
         # Return first record as PatientRecord model
@@ -1,7 +1,7 @@
 """Core configuration utilities."""
 
 import os
-from typing import Any
+from typing import Any, Optional
 
 from config import get_config, get_config_with_defaults, ConfigError
 
@@ -58,6 +58,22 @@ class AppSettings:
         """Get Ollama API URL from env or config."""
         return self._get_env_or_config("OLLAMA_API_URL", "service", "OLLAMA_API_URL", "http://localhost:11434")
 
+    @property
+    def ollama_api_urls(self) -> list[str]:
+        """Get all Ollama hosts, OLLAMA_API_URL may be comma separated."""
+        return [url.strip() for url in self.ollama_api_url.split(",") if url.strip()]
+
+    @property
+    def llm_shared_context(self) -> bool:
+        """Check if code prompts share the diagnosis as a conversation prefix."""
+        env_value = os.environ.get("LLM_SHARED_CONTEXT")
+        if env_value is not None:
+            return env_value.lower() in ("true", "1", "yes")
+        try:
+            return self._get_config().getboolean("service", "LLM_SHARED_CONTEXT", fallback=True)
+        except Exception:
+            return True
+
     @property
     def encryption_key(self) -> str:
         """Get encryption key from env or config."""
@@ -96,6 +112,76 @@ class AppSettings:
         except Exception:
             return ["medllama2"]
 
+    @property
+    def structured_output_llms(self) -> list[str]:
+        """Get medical LLM models that extract codes with one structured-output call."""
+        env_value = os.environ.get("STRUCTURED_OUTPUT_LLMS")
+        if env_value is None:
+            try:
+                env_value = self._get_config().get("service", "STRUCTURED_OUTPUT_LLMS", fallback="")
+            except Exception:
+                env_value = ""
+        return [llm.strip() for llm in env_value.split(",") if llm.strip()]
+
+    @property
+    def analysis_queue_enabled(self) -> bool:
+        """Check if analyze_visit_notes enqueues notes for analysis workers."""
+        env_value = os.environ.get("ANALYSIS_QUEUE_ENABLED")
+        if env_value is not None:
+            return env_value.lower() in ("true", "1", "yes")
+        try:
+            return self._get_config().getboolean("service", "ANALYSIS_QUEUE_ENABLED", fallback=False)
+        except Exception:
+            return False
+
+    @property
+    def analysis_checkpoints_enabled(self) -> bool:
+        """Check if completed analysis stages are checkpointed for resume."""
+        env_value = os.environ.get("ANALYSIS_CHECKPOINTS_ENABLED")
+        if env_value is not None:
+            return env_value.lower() in ("true", "1", "yes")
+        try:
+            return self._get_config().getboolean("service", "ANALYSIS_CHECKPOINTS_ENABLED", fallback=True)
+        except Exception:
+            return True
+
+    @property
+    def analysis_job_lease_seconds(self) -> int:
+        """Get seconds an analysis worker holds a job without a heartbeat."""
+        return int(self._get_env_or_config("ANALYSIS_JOB_LEASE_SECONDS", "service", "ANALYSIS_JOB_LEASE_SECONDS", "900"))
+
+    @property
+    def analysis_job_max_attempts(self) -> int:
+        """Get attempts of an analysis job before it is marked failed."""
+        return int(self._get_env_or_config("ANALYSIS_JOB_MAX_ATTEMPTS", "service", "ANALYSIS_JOB_MAX_ATTEMPTS", "3"))
+
+    def medllm_timeout(self, llm: str) -> Optional[float]:
+        """Get seconds a medical model may take on a note, None if unlimited.
+
+        MEDLLM_TIMEOUTS overrides MEDLLM_TIMEOUT per model, e.g. meditron=1200.
+        """
+        timeouts = self._get_env_or_config("MEDLLM_TIMEOUTS", "service", "MEDLLM_TIMEOUTS", "")
+        timeout = self._get_env_or_config("MEDLLM_TIMEOUT", "service", "MEDLLM_TIMEOUT", "1800")
+        for item in timeouts.split(","):
+            model, _, value = item.partition("=")
+            if model.strip() == llm and value.strip():
+                timeout = value
+        return float(timeout) if float(timeout) > 0 else None
+
+    @property
+    def pipeline_stage_limits(self) -> dict[str, int]:
+        """Get concurrent stages per stage group of the note pipeline."""
+        value = self._get_env_or_config(
+            "PIPELINE_STAGE_LIMITS", "service", "PIPELINE_STAGE_LIMITS",
+            "summary=4,diagnosis=4,codes=4,lookup=4,store=8",
+        )
+        limits = {}
+        for item in value.split(","):
+            group, _, limit = item.partition("=")
+            if group.strip() and limit.strip():
+                limits[group.strip()] = int(limit)
+        return limits
+
     @property
     def endpoint_url(self) -> str:
         """Get endpoint URL from env or config."""
@@ -1,11 +1,14 @@
 """FastAPI application for medical billing forecasting."""
 
+import asyncio
 import logging
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.api.v1.endpoints import router as api_router
+from codescanner import get_scanner
+from gptutils import HEALTH_MONITOR, OLLAMA_HOSTS, aclose_clients
 
 app = FastAPI(
     title="Billing Forecast GPT",
@@ -30,6 +33,17 @@ async def startup_event():
     """Application startup initialization."""
     logging.info("Starting Billing Forecast GPT API")
     logging.info("Loading configuration...")
+    # first requests should not wait for health probes or load the ICD
+    #  index (built on the fly without one) on the event loop
+    for host in OLLAMA_HOSTS:
+        HEALTH_MONITOR.refresh(host)
+    await asyncio.to_thread(get_scanner)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release pooled Ollama connections."""
+    await aclose_clients()
 
 
 @app.get("/", include_in_schema=False)
@@ -3,7 +3,7 @@
 from datetime import datetime
 from typing import Any, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class LoginRequest(BaseModel):
@@ -41,6 +41,28 @@ class PatientCodes(BaseModel):
     codes_document: dict[str, Any]
 
 
+class ClinicalCodes(BaseModel):
+    """Codes and prescriptions extracted from a diagnosis in one structured-output call."""
+    icd: list[str] = Field(default_factory=list, description="ICD-10 codes for the diagnosis")
+    cpt: list[str] = Field(default_factory=list, description="CPT codes for the diagnosis")
+    hcpcs: list[str] = Field(default_factory=list, description="HCPCS codes for the diagnosis")
+    prescriptions: list[str] = Field(default_factory=list, description="Medications to prescribe")
+    prescription_cpt: list[str] = Field(default_factory=list, description="CPT codes for the prescriptions")
+    prescription_hcpcs: list[str] = Field(default_factory=list, description="HCPCS codes for the prescriptions")
+
+
+class CodeDescription(BaseModel):
+    """Description of one CPT or HCPCS code."""
+    code: str = Field(description="The code as asked about")
+    short_description: str = Field(description="Short description of the code")
+    long_description: str = Field(description="Long description of the code")
+
+
+class CodeLookupBatch(BaseModel):
+    """Descriptions of several codes looked up in one structured-output call."""
+    codes: list[CodeDescription] = Field(default_factory=list, description="One entry per code asked about")
+
+
 class PatientRecord(BaseModel):
     """Complete patient record with notes, documents, and codes."""
     patient_id: str
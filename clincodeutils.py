@@ -1,32 +1,72 @@
 #!/usr/bin/env python3
 """ ©2024, Ovais Quraishi """
 
-import ast
-
+import asyncio
+import json
 import logging
-import re
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import ValidationError
+from app.models.schemas import CodeLookupBatch
+from config import get_config, get_config_with_defaults, ConfigError
 from gptutils import prompt_chat
+from gptutils import prompt_chat_async
+from gptutils import cached_response, cached_response_async
+from gptutils import cache_response, cache_response_async
+from gptutils import stop_after_json_object
+from gptutils import stop_after_matches
+from icdindex import get_icd_index
+from codescanner import scan_codes
+from llmjson import loads, LLMJSONError
+
+# Try to get config, use defaults if file not found
+try:
+    CONFIG = get_config()
+except (FileNotFoundError, ConfigError):
+    CONFIG = get_config_with_defaults()
+
+# stream code lookups and stop generating once a JSON object is complete
+STREAM_LOOKUPS = CONFIG.getboolean('service', 'LLM_STREAM_LOOKUPS', fallback=False)
+
+# ICD code details come from the offline ICD-10-CM index, the LLM is only
+#  asked to estimate reimbursement rates of billable codes
+ICD_LLM_REIMBURSEMENT = CONFIG.getboolean('service', 'ICD_LLM_REIMBURSEMENT', fallback=True)
+
+# ICD codes whose details are looked up at the same time
+ICD_LOOKUP_CONCURRENCY = CONFIG.getint('service', 'ICD_LOOKUP_CONCURRENCY', fallback=4)
+
+# CPT/HCPCS codes described per batched lookup call
+CODE_LOOKUP_BATCH_SIZE = CONFIG.getint('service', 'CODE_LOOKUP_BATCH_SIZE', fallback=10)
+
+def _lookup_stop():
+    """Stop predicate for JSON code lookups, None when not streaming
+    """
+
+    return stop_after_json_object() if STREAM_LOOKUPS else None
 
 def extract_icd10_codes(text):
-    """Extract ICD-10 codes from a string.
+    """Extract valid ICD-10-CM codes from a string, see codescanner.py
+    """
+
+    return scan_codes(text)['icd']
+
+def stop_after_icd10_codes(count):
+    """Stop predicate for streamed responses, true once count distinct
+        ICD-10 codes have been generated
     """
 
-    lookup_pattern = r'\b[A-TV-Z]\d{2}(?:\.\d{1,3})?\b'
-    return re.findall(lookup_pattern, text)
+    return stop_after_matches(extract_icd10_codes, count)
 
 def extract_cpt_codes(text):
     """Extract CPT codes from a string
     """
 
-    lookup_pattern = r'\b\d{5}\b'
-    return re.findall(lookup_pattern, text)
+    return scan_codes(text)['cpt']
 
 def extract_hcpcs_codes(text):
-    """Extract hcpcs codes from a string
+    """Extract HCPCS Level II codes from a string
     """
 
-    lookup_pattern = r'\b\d{5}\b'
-    return re.findall(lookup_pattern, text)
+    return scan_codes(text)['hcpcs']
 
 def icd_10_code_details(icd_10_code):
     """ICD-10 code details
@@ -39,19 +79,97 @@ def icd_10_code_details(icd_10_code):
         logging.error('Error: %s, %s', icd_10_code, e.args[0])
         return e.args[0]
 
-def icd_10_code_details_list(list_of_icd_10_codes):
-    """Details about each icd-10 code found
+def icd_reimbursement_prompt(icd_code, description):
+    """Prompt asking for reimbursement rate estimates of a single ICD-10 code
+    """
+
+    return f"""Response MUST BE JSON ONLY, no additional comments. Estimate reimbursement rates for ICD-10 code \
+    {icd_code} ({description}). Use the following python JSON template, \
+     {{'insurance_company': {{
+            'reimbursement_rate': 'REIMBURSEMENT RATE from the insurance company goes here',
+            'billing_instructions': 'billing instructions from the insurance company go here'
+        }},
+        'medical_provider': {{
+            'reimbursement_rate': 'REIMBURSEMENT RATE from the medical provider goes here',
+            'billing_instructions': 'billing instructions from the medical provider go here'
+        }}}}
+    """
+
+def lookup_icd_reimbursement_gpt(icd_code, description):
+    """Billing guidelines of an ICD-10 code estimated by llama3.2, None if
+        the response can not be parsed
     """
 
-    details_list = []
+    result = prompt_chat('llama3.2', icd_reimbursement_prompt(icd_code, description), False,
+                         stop_when=_lookup_stop(), prompt_type='icd_reimbursement')
+    if not result:
+        return None
+    try:
+        return loads(result['analysis'], expect=dict)
+    except LLMJSONError as e:
+        logging.error('Unable to parse reimbursement of %s: %s', icd_code, e.to_dict())
+        return None
+
+def icd_10_code_index_details(icd_code, index):
+    """ICD-10 code details from the offline index, shaped like the LLM
+        lookup's; None for codes that are not valid ICD-10-CM codes
+    """
 
-    for icd_10_code in list_of_icd_10_codes:
-        # should be dictionary object
-        detail = icd_10_code_details(icd_10_code).replace('  ','').replace('\n','')
-        details = ast.literal_eval(detail)
-        details_list.append(details)
+    entry = index.get(icd_code)
+    if entry is None:
+        logging.warning('Not a valid ICD-10-CM code: %s', icd_code)
+        return None
 
-    return details_list
+    full_data = {'short_description': entry.short_description,
+                 'long_description': entry.long_description}
+    if entry.billable and ICD_LLM_REIMBURSEMENT:
+        guidelines = lookup_icd_reimbursement_gpt(entry.code, entry.long_description)
+        if guidelines is not None:
+            full_data['billing_guidelines'] = guidelines
+    return {'code': entry.code, 'billable': entry.billable, 'full_data': full_data}
+
+def icd_10_code_detail(icd_10_code, index):
+    """Details of one icd-10 code, None if the code is invalid or its
+        lookup failed; never raises so one code can not fail the others
+    """
+
+    try:
+        if index is not None:
+            return icd_10_code_index_details(icd_10_code, index)
+        return loads(icd_10_code_details(icd_10_code), expect=dict)
+    except LLMJSONError as e:
+        logging.error('Unable to parse ICD-10 code details of %s: %s', icd_10_code, e.to_dict())
+        return None
+    except Exception as e:  # isolate per code failures
+        logging.error('ICD-10 code details of %s failed: %r', icd_10_code, e)
+        return None
+
+def icd_10_code_details_by_code(list_of_icd_10_codes):
+    """Details of each distinct icd-10 code, up to ICD_LOOKUP_CONCURRENCY
+        codes at a time. Invalid codes and codes whose lookup failed are
+        left out, the others are still returned.
+    """
+
+    index = get_icd_index()
+    codes = list(dict.fromkeys(list_of_icd_10_codes))
+    if not codes:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(ICD_LOOKUP_CONCURRENCY, len(codes))) as pool:
+        results = pool.map(lambda icd_10_code: icd_10_code_detail(icd_10_code, index), codes)
+        details = {code: detail for code, detail in zip(codes, results) if detail is not None}
+
+    if len(details) < len(codes):
+        logging.warning('ICD-10 code details of %s of %s codes unavailable: %s', len(codes) - len(details),
+                        len(codes), [code for code in codes if code not in details])
+    return details
+
+def icd_10_code_details_list(list_of_icd_10_codes):
+    """Details about each icd-10 code found, invalid codes are dropped
+    """
+
+    details = icd_10_code_details_by_code(list_of_icd_10_codes)
+    return [details[icd_10_code] for icd_10_code in list_of_icd_10_codes if icd_10_code in details]
 
 def lookup_icd_gpt(icd_code):
     """Lookup icd codes using llama3.2
@@ -78,38 +196,242 @@ def lookup_icd_gpt(icd_code):
         }}}}
     """
 
-    icd_details = prompt_chat('llama3.2', code_lookup_prompt + '', False)
+    icd_details = prompt_chat('llama3.2', code_lookup_prompt + '', False, stop_when=_lookup_stop(),
+                              prompt_type='icd_lookup')
 
     return icd_details
 
-def lookup_cpt_gpt(cpt_code_list):
-    """Lookup cpt codes using llama3.2
+def cpt_lookup_prompt(cpt_code):
+    """Prompt asking for details of a single CPT code
     """
 
-    cpt_details = []
-    for cpt_code in cpt_code_list:
-        code_lookup_prompt = f"""Explain CPT code {cpt_code}. Respond with JSON only. Keys cpt is the code number, \
+    return f"""Explain CPT code {cpt_code}. Respond with JSON only. Keys cpt is the code number, \
         details is a dictionary with nested keys short_description and long_description. JSON template {{"cpt": "actual \
         cpt code", "details": {{"short_description": "short description goes here", "long_description": "long \
         description goes here"}}}}"""
 
-        result = prompt_chat('llama3.2', code_lookup_prompt + '', False)
-        cpt_details.append(result['analysis'])
+def hcpcs_lookup_prompt(hcpcs_code):
+    """Prompt asking for details of a single HCPCS code
+    """
+
+    return f"""Explain HCPCS code {hcpcs_code}. Respond with JSON only. Keys cpt is the code number, \
+        details is a dictionary with nested keys short_description and long_description. JSON template {{"hcpcs": "actual \
+        hcpcs code", "details": {{"short_description": "short description goes here", "long_description": "long \
+        description goes here"}}}}"""
 
-    return cpt_details
+def code_lookup_prompt(kind, code):
+    """Single code lookup prompt of a kind, cpt or hcpcs
+    """
+
+    return cpt_lookup_prompt(code) if kind == 'cpt' else hcpcs_lookup_prompt(code)
+
+def batch_lookup_prompt(kind, codes):
+    """Prompt asking for details of several CPT or HCPCS codes at once
+    """
+
+    return f"""Explain each of the following {kind.upper()} codes: {', '.join(codes)}. Respond with JSON only, \
+        one entry per code with the code exactly as given, a short_description and a long_description."""
+
+def split_batch_lookup(kind, codes, analysis):
+    """Per code answers, shaped like the single code lookup's, of a batched
+        lookup response; codes missing or invalid in the response are left out
+    """
+
+    try:
+        batch = CodeLookupBatch.model_validate_json(analysis)
+    except ValidationError as e:
+        logging.error('Unable to parse %s lookup of %s: %s', kind, codes, e)
+        return {}
+
+    wanted = set(codes)
+    answers = {}
+    for entry in batch.codes:
+        code = entry.code.strip()
+        if code in wanted and code not in answers and entry.short_description.strip():
+            answers[code] = json.dumps({kind: code,
+                                        'details': {'short_description': entry.short_description,
+                                                    'long_description': entry.long_description}})
+    return answers
+
+def _lookup_batches(pending, sent):
+    """Batches of codes still to look up and the codes to look up one by
+        one, because the same batch was already asked and would only get
+        the same (cached) answer again
+    """
+
+    batches, singles = [], []
+    for i in range(0, len(pending), CODE_LOOKUP_BATCH_SIZE):
+        batch = tuple(pending[i:i + CODE_LOOKUP_BATCH_SIZE])
+        if batch in sent or len(batch) == 1:
+            singles.extend(batch)
+        else:
+            sent.add(batch)
+            batches.append(batch)
+    return batches, singles
+
+def lookup_codes_gpt(kind, code_list):
+    """Lookup cpt or hcpcs codes using llama3.2, CODE_LOOKUP_BATCH_SIZE codes
+        per call. Codes a batch did not answer are retried in a smaller
+        batch, then one by one. Answers are cached per code; codes whose
+        single lookup failed too are unresolved, None.
+    """
+
+    prompt_type = f'{kind}_lookup'
+    answers = {}
+    for code in dict.fromkeys(code_list):
+        cached = cached_response('llama3.2', code_lookup_prompt(kind, code), prompt_type)
+        if cached is not None:
+            answers[code] = cached
+
+    sent, unresolved = set(), set()
+    pending = [code for code in dict.fromkeys(code_list) if code not in answers]
+    while pending:
+        batches, singles = _lookup_batches(pending, sent)
+        for batch in batches:
+            result = prompt_chat('llama3.2', batch_lookup_prompt(kind, batch), False,
+                                 format=CodeLookupBatch.model_json_schema(), prompt_type=f'{kind}_batch_lookup')
+            if result:
+                for code, answer in split_batch_lookup(kind, batch, result['analysis']).items():
+                    answers[code] = answer
+                    cache_response('llama3.2', code_lookup_prompt(kind, code), answer, prompt_type)
+        for code in singles:
+            result = prompt_chat('llama3.2', code_lookup_prompt(kind, code), False, stop_when=_lookup_stop(),
+                                 prompt_type=prompt_type)
+            if not result:
+                logging.error('Unable to look up %s code %s', kind, code)
+                unresolved.add(code)
+                continue
+            answers[code] = result['analysis']
+        pending = [code for code in pending if code not in answers and code not in unresolved]
+
+    return [answers.get(code) for code in code_list]
+
+async def lookup_codes_gpt_async(kind, code_list):
+    """Async lookup_codes_gpt, batches and single lookups run concurrently
+    """
+
+    prompt_type = f'{kind}_lookup'
+    answers = {}
+    unique = list(dict.fromkeys(code_list))
+    cached = await asyncio.gather(*(cached_response_async('llama3.2', code_lookup_prompt(kind, code), prompt_type)
+                                    for code in unique))
+    answers.update((code, answer) for code, answer in zip(unique, cached) if answer is not None)
+
+    async def lookup_batch(batch):
+        result = await prompt_chat_async('llama3.2', batch_lookup_prompt(kind, batch), False,
+                                         format=CodeLookupBatch.model_json_schema(),
+                                         prompt_type=f'{kind}_batch_lookup')
+        found = split_batch_lookup(kind, batch, result['analysis']) if result else {}
+        for code, answer in found.items():
+            await cache_response_async('llama3.2', code_lookup_prompt(kind, code), answer, prompt_type)
+        return found
+
+    async def lookup_single(code):
+        result = await prompt_chat_async('llama3.2', code_lookup_prompt(kind, code), False,
+                                         stop_when=_lookup_stop(), prompt_type=prompt_type)
+        if not result:
+            logging.error('Unable to look up %s code %s', kind, code)
+            unresolved.add(code)
+            return {}
+        return {code: result['analysis']}
+
+    sent, unresolved = set(), set()
+    pending = [code for code in unique if code not in answers]
+    while pending:
+        batches, singles = _lookup_batches(pending, sent)
+        for found in await asyncio.gather(*(lookup_batch(batch) for batch in batches),
+                                          *(lookup_single(code) for code in singles)):
+            answers.update(found)
+        pending = [code for code in pending if code not in answers and code not in unresolved]
+
+    return [answers.get(code) for code in code_list]
+
+def lookup_cpt_gpt(cpt_code_list):
+    """Lookup cpt codes using llama3.2
+    """
+
+    return lookup_codes_gpt('cpt', cpt_code_list)
 
 def lookup_hcpcs_gpt(hcpcs_code_list):
     """Lookup hcpcs codes using llama3.2
     """
 
-    hcpcs_details = []
-    for hcpcs_code in hcpcs_code_list:
-        code_lookup_prompt = f"""Explain HCPCS code {hcpcs_code}. Respond with JSON only. Keys cpt is the code number, \
-        details is a dictionary with nested keys short_description and long_description. JSON template {{"hcpcs": "actual \
-        hcpcs code", "details": {{"short_description": "short description goes here", "long_description": "long \
-        description goes here"}}}}"""
+    return lookup_codes_gpt('hcpcs', hcpcs_code_list)
+
+async def lookup_cpt_gpt_async(cpt_code_list):
+    """Lookup cpt codes using llama3.2, batches run concurrently
+    """
+
+    return await lookup_codes_gpt_async('cpt', cpt_code_list)
+
+async def lookup_hcpcs_gpt_async(hcpcs_code_list):
+    """Lookup hcpcs codes using llama3.2, batches run concurrently
+    """
+
+    return await lookup_codes_gpt_async('hcpcs', hcpcs_code_list)
+
+# coded sections of a codes_document and the kind of codes they hold
+CODE_SECTIONS = {
+                 'icd': 'icd',
+                 'cpt': 'cpt',
+                 'hcpcs': 'hcpcs',
+                 'prescription_cpt': 'cpt',
+                 'prescription_hcpcs': 'hcpcs'
+                }
+
+CODE_EXTRACTORS = {
+                   'icd': extract_icd10_codes,
+                   'cpt': extract_cpt_codes,
+                   'hcpcs': extract_hcpcs_codes
+                  }
+
+def extract_section_codes(sections):
+    """Codes found in each coded section of a note's analysis envelopes,
+        each section scanned once
+    """
+
+    return {section: scan_codes(sections[section]['analysis'])[kind]
+            for section, kind in CODE_SECTIONS.items() if section in sections}
+
+class CodeLookupPlan:
+    """Looks up every distinct code of one or more notes (and medical
+        models) once and fans the details back out per section
+
+        The cpt and prescription_cpt sections of a note, and the notes of
+        a batch, often share codes; each is looked up only once.
+    """
+
+    def __init__(self):
+        self.codes = {kind: {} for kind in CODE_EXTRACTORS}
+        self.details = {kind: {} for kind in CODE_EXTRACTORS}
+
+    def add(self, section_codes):
+        """Plan the lookups of one note's extract_section_codes"""
+
+        for section, codes in section_codes.items():
+            self.codes[CODE_SECTIONS[section]].update(dict.fromkeys(codes))
+
+    async def run(self):
+        """Look up all planned codes, the kinds concurrently"""
+
+        icd_codes, cpt_codes, hcpcs_codes = (list(self.codes[kind]) for kind in ('icd', 'cpt', 'hcpcs'))
+        icd_details, cpt_details, hcpcs_details = await asyncio.gather(
+            asyncio.to_thread(icd_10_code_details_by_code, icd_codes),
+            lookup_cpt_gpt_async(cpt_codes),
+            lookup_hcpcs_gpt_async(hcpcs_codes))
+        self.details = {
+                        'icd': icd_details,
+                        'cpt': {code: detail for code, detail in zip(cpt_codes, cpt_details) if detail is not None},
+                        'hcpcs': {code: detail for code, detail in zip(hcpcs_codes, hcpcs_details)
+                                  if detail is not None}
+                       }
 
-        result = prompt_chat('llama3.2', code_lookup_prompt + '', False)
-        hcpcs_details.append(result['analysis'])
+    def section_details(self, section_codes):
+        """Details per section of one note's extract_section_codes, in
+            code order; codes without details (invalid ICD codes, failed
+            lookups) are left out
+        """
 
-    return hcpcs_details
+        return {section: [self.details[CODE_SECTIONS[section]][code] for code in codes
+                          if code in self.details[CODE_SECTIONS[section]]]
+                for section, codes in section_codes.items()}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Single-pass clinical code scanner
+    ©2024, Ovais Quraishi
+
+    One compiled pattern classifies tokens of LLM output as ICD-10-CM,
+    CPT (including category II/III, PLA and MAAA codes) or HCPCS Level II
+    codes. Numbers that are part of amounts, decimals, ZIP+4 codes or
+    addresses ("ZIP 62704", "Springfield, IL 62704") are skipped. Codes
+    are then validated:
+        ICD-10-CM   against the offline ICD index, see icdindex.py
+        CPT/HCPCS   against the known code lists (KNOWN_CODE_LISTS, by
+                    default the CMS DHS code list addendum)
+
+    LLMs often write ICD-10 codes without the dot. An undotted token
+    shaped like a HCPCS code is one if it follows a HCPCS or CPT label
+    ("HCPCS codes: J1100") or a known code list has it. Otherwise it is
+    an ICD-10 code if the index has it (J45909 -> J45.909, E1165 ->
+    E11.65), else a HCPCS code if it is shaped like one.
+
+    The DHS list only covers designated health services, so by default
+    CPT/HCPCS codes missing from it are still accepted when well formed,
+    i.e. any other 5 digit number counts as a CPT code; list cpt and
+    hcpcs in STRICT_CODE_KINDS once KNOWN_CODE_LISTS holds complete code
+    sets.
+"""
+
+import bisect
+import logging
+import re
+import threading
+from typing import Iterable, Optional
+
+from config import get_config, get_config_with_defaults, ConfigError
+from icdindex import ICDIndex, add_dot, get_icd_index
+
+try:
+    CONFIG = get_config()
+except (FileNotFoundError, ConfigError):
+    CONFIG = get_config_with_defaults()
+
+KNOWN_CODE_LISTS = CONFIG.get('service', 'KNOWN_CODE_LISTS',
+                              fallback='2024_DHS_Code_List_Addendum_03_01_2024.txt')
+STRICT_CODE_KINDS = CONFIG.get('service', 'STRICT_CODE_KINDS', fallback='icd')
+
+CODE_KINDS = ('icd', 'cpt', 'hcpcs')
+
+CODE_PATTERN = re.compile(r'''
+    (?<![\w$.])                                     # not inside a word, amount or decimal
+    (?:
+        (?P<icd>[A-Z]\d[0-9A-Z](?:\.[0-9A-Z]{1,4})?)  # ICD-10-CM, dotted or a category
+      | (?P<undotted>[A-Z]\d[0-9A-Z]{2,5})            # ICD-10-CM without the dot or HCPCS
+      | (?P<cpt>\d{4}[FMTU]|\d{5})                    # CPT
+    )
+    (?!\w|\.\d|-\d{4}\b)                            # not followed by decimals or ZIP+4
+    ''', re.VERBOSE)
+
+# HCPCS Level II
+HCPCS_PATTERN = re.compile(r'[A-HJ-MP-V]\d{4}')
+
+# code system labels, the last one before an undotted code disambiguates it
+LABEL_PATTERN = re.compile(r'\b(?i:(?P<icd>ICD)|(?P<cpt>CPT)|(?P<hcpcs>HCPCS))\b')
+
+# a 5 digit number right after these is a ZIP code, not a CPT code
+US_STATES = ('AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO MT NE NV NH NJ '
+             'NM NY NC ND OH OK OR PA PR RI SC SD TN TX UT VT VA WA WV WI WY')
+ADDRESS_CONTEXT = re.compile(r'(?:(?i:\bzip|\bpostal)(?i:\s*code)?\s*[:#]?|,\s*(?:%s))\s*$'
+                             % '|'.join(US_STATES.split()))
+
+
+def code_kind(code: str) -> Optional[str]:
+    """icd, cpt or hcpcs for a well formed code, None otherwise; an
+        undotted code is hcpcs if shaped like one
+    """
+
+    match = CODE_PATTERN.fullmatch(code)
+    if not match:
+        return None
+    if match.lastgroup == 'undotted':
+        return 'hcpcs' if HCPCS_PATTERN.fullmatch(code) else 'icd'
+    return match.lastgroup
+
+
+def in_address(text: str, start: int) -> bool:
+    """True if the number at start follows a ZIP/postal code label or a
+        state abbreviation in an address
+    """
+
+    return ADDRESS_CONTEXT.search(text, max(0, start - 24), start) is not None
+
+
+def load_known_codes(paths: Iterable[str]) -> dict[str, set[str]]:
+    """CPT and HCPCS codes of code list files, one code per line
+    """
+
+    known: dict[str, set[str]] = {'cpt': set(), 'hcpcs': set()}
+    for path in paths:
+        try:
+            with open(path, encoding='utf-8') as afile:
+                for line in afile:
+                    code = line.strip()
+                    kind = code_kind(code)
+                    if kind in known:
+                        known[kind].add(code)
+        except FileNotFoundError:
+            logging.warning('Code list %s not found', path)
+    return known
+
+
+class CodeScanner:
+    """Extracts validated, de-duplicated codes of every kind in one pass
+    """
+
+    def __init__(self,
+                 known_codes: Optional[dict[str, set[str]]] = None,
+                 icd_index: Optional[ICDIndex] = None,
+                 strict_kinds: Iterable[str] = ('icd',)
+                ) -> None:
+        self.known_codes = known_codes or {}
+        self.icd_index = icd_index
+        self.strict_kinds = set(strict_kinds)
+
+    def classify(self, token: str, label: Optional[str] = None) -> tuple[Optional[str], str]:
+        """Kind and code of an undotted token after a label (icd, cpt or
+            hcpcs), (None, token) if it is neither a known ICD-10 code nor
+            shaped like a HCPCS code
+        """
+
+        is_hcpcs = HCPCS_PATTERN.fullmatch(token) is not None
+        if is_hcpcs and (label in ('cpt', 'hcpcs') or token in self.known_codes.get('hcpcs', ())):
+            return 'hcpcs', token
+        if self.icd_index is not None:
+            entry = self.icd_index.get(token)
+            if entry is not None:
+                return 'icd', entry.code
+        elif not is_hcpcs:
+            return 'icd', add_dot(token)
+        return ('hcpcs' if is_hcpcs else None), token
+
+    def is_valid(self, kind: str, code: str) -> bool:
+        if kind == 'icd':
+            if self.icd_index is not None:
+                return code in self.icd_index
+            return True
+        if code in self.known_codes.get(kind, ()):
+            return True
+        return kind not in self.strict_kinds
+
+    def scan(self, text: str) -> dict[str, list[str]]:
+        """Codes by kind, in order of first appearance"""
+
+        found: dict[str, dict[str, None]] = {kind: {} for kind in CODE_KINDS}
+        text = text or ''
+        labels = [(label.start(), label.lastgroup) for label in LABEL_PATTERN.finditer(text)]
+        for match in CODE_PATTERN.finditer(text):
+            kind = match.lastgroup
+            code = match.group(kind)
+            if kind == 'undotted':
+                before = bisect.bisect(labels, (match.start(), ''))
+                kind, code = self.classify(code, labels[before - 1][1] if before else None)
+                if kind is None:
+                    continue
+            elif kind == 'cpt' and in_address(text, match.start()):
+                continue
+            if code not in found[kind] and self.is_valid(kind, code):
+                found[kind][code] = None
+        return {kind: list(codes) for kind, codes in found.items()}
+
+
+_SCANNER: Optional[CodeScanner] = None
+_SCANNER_LOCK = threading.Lock()
+
+
+def get_scanner() -> CodeScanner:
+    """The process-wide scanner, built on first use"""
+
+    global _SCANNER
+
+    if _SCANNER is None:
+        with _SCANNER_LOCK:
+            if _SCANNER is None:
+                _SCANNER = CodeScanner(
+                    load_known_codes(path.strip() for path in KNOWN_CODE_LISTS.split(',') if path.strip()),
+                    get_icd_index(),
+                    (kind.strip() for kind in STRICT_CODE_KINDS.split(',') if kind.strip()))
+    return _SCANNER
+
+
+def scan_codes(text: str) -> dict[str, list[str]]:
+    """icd, cpt and hcpcs codes found in text, validated and de-duplicated
+    """
+
+    return get_scanner().scan(text)
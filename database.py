@@ -30,27 +30,67 @@ def execute_query(sql_query):
         logging.error("%s", e)
         raise
 
+def insert_query(table_name, data):
+    """INSERT statement and its parameters for a row of data"""
+
+    placeholders = ', '.join(['%s'] * len(data))
+    columns = ', '.join(data.keys())
+    # Since the table keys that matter are set to UNIQUE value,
+    #   I find the ON CONFLICT DO NOTHING more effecient than
+    #   doing a lookup before INSERT. This way original content
+    #   is preserved by default. In case of updating existing
+    #   data, one can write a method to safely update data
+    #   while also preserving original data. For example use
+    #   ON CONFLICT DO UPDATE. For now this'd do.
+    sql_query = f"""INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) \
+                 ON CONFLICT DO NOTHING;"""
+    return sql_query, list(data.values())
+
 def insert_data_into_table(table_name, data):
     """Insert data into table"""
 
     conn, cur = psql_connection()
     try:
-        placeholders = ', '.join(['%s'] * len(data))
-        columns = ', '.join(data.keys())
-        # Since the table keys that matter are set to UNIQUE value,
-        #   I find the ON CONFLICT DO NOTHING more effecient than
-        #   doing a lookup before INSERT. This way original content
-        #   is preserved by default. In case of updating existing
-        #   data, one can write a method to safely update data
-        #   while also preserving original data. For example use
-        #   ON CONFLICT DO UPDATE. For now this'd do.
-        sql_query = f"""INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) \
-                     ON CONFLICT DO NOTHING;"""
-        cur.execute(sql_query, list(data.values()))
+        cur.execute(*insert_query(table_name, data))
+        conn.commit()
+    except psycopg2.Error as e:
+        logging.error("%s", e)
+        raise
+
+def execute_write_query(sql_query, params=None, fetch=True):
+    """Execute an INSERT/UPDATE/DELETE and commit, returning the rows
+        of a RETURNING clause when fetch is True
+    """
+
+    conn, cur = psql_connection()
+    try:
+        cur.execute(sql_query, params)
+        result = cur.fetchall() if fetch else None
         conn.commit()
+        return result
     except psycopg2.Error as e:
+        conn.rollback()
         logging.error("%s", e)
         raise
+    finally:
+        conn.close()
+
+def execute_write_queries(statements):
+    """Execute (sql_query, params) statements in one transaction, either
+        all of them are committed or none
+    """
+
+    conn, cur = psql_connection()
+    try:
+        for sql_query, params in statements:
+            cur.execute(sql_query, params)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logging.error("%s", e)
+        raise
+    finally:
+        conn.close()
 
 def get_select_query_results(sql_query):
     """Execute a query, return all rows for the query
@@ -3,19 +3,33 @@
     ©2024, Ovais Quraishi
 """
 
+import asyncio
 import hashlib
+import json
 import logging
+import threading
+import time
+import weakref
 import httpx
+from contextvars import ContextVar
 import sys
-from typing import Any, Optional
+from typing import Any, Callable, Iterator, Optional
 
-from ollama import Client
+from ollama import Client, AsyncClient, ResponseError
 
 from config import get_config, get_config_with_defaults, ConfigError
-from encryption import encrypt_text
+from encryption import encrypt_text, decrypt_text
+from healthmonitor import HealthMonitor
+from llmrouter import OllamaRouter, parse_hosts
+from llmcache import ResponseCache, MemoryTier, SQLiteTier, PostgresTier
+from llmcache import cache_key, is_deterministic
+from llmtelemetry import Telemetry, CallRecord, LedgerWriter, response_metrics
+from llmreplay import Recorder, Replayer, exchange_key
+from llmprofiles import OptionProfile, load_profiles, profile_for
+from singleflight import SingleFlight, AsyncSingleFlight
+from retrypolicy import RetryPolicy, RetryBudget, DeadlineExceeded
 from utils import ts_int_to_dt_obj
 from utils import sanitize_string
-from utils import check_endpoint_health
 
 # Try to get config, use defaults if file not found
 try:
@@ -23,64 +37,1102 @@ try:
 except (FileNotFoundError, ConfigError):
     CONFIG = get_config_with_defaults()
 
+# one or more comma separated Ollama hosts
+OLLAMA_HOSTS = parse_hosts(CONFIG.get('service', 'OLLAMA_API_URL'))
+
+# HTTP connection pool settings shared by every Ollama client
+OLLAMA_TIMEOUT = CONFIG.getfloat('service', 'OLLAMA_TIMEOUT', fallback=600.0)
+OLLAMA_CONNECT_TIMEOUT = CONFIG.getfloat('service', 'OLLAMA_CONNECT_TIMEOUT', fallback=5.0)
+OLLAMA_MAX_CONNECTIONS = CONFIG.getint('service', 'OLLAMA_MAX_CONNECTIONS', fallback=20)
+OLLAMA_MAX_KEEPALIVE = CONFIG.getint('service', 'OLLAMA_MAX_KEEPALIVE', fallback=10)
+OLLAMA_KEEPALIVE_EXPIRY = CONFIG.getfloat('service', 'OLLAMA_KEEPALIVE_EXPIRY', fallback=120.0)
+
+# process-wide client registry, keyed by Ollama host. httpx async
+#  connections belong to the event loop that opened them, so async
+#  clients are additionally keyed by the running loop
+_CLIENTS: dict[str, Client] = {}
+_ASYNC_CLIENTS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, AsyncClient]]' = weakref.WeakKeyDictionary()
+_CLIENTS_LOCK = threading.Lock()
+
+# bounds on concurrent async requests, per model and per host
+OLLAMA_MAX_CONCURRENCY_PER_MODEL = CONFIG.getint('service', 'OLLAMA_MAX_CONCURRENCY_PER_MODEL', fallback=4)
+OLLAMA_MAX_CONCURRENCY_PER_HOST = CONFIG.getint('service', 'OLLAMA_MAX_CONCURRENCY_PER_HOST', fallback=8)
+_SEMAPHORES: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[dict, dict]]' = weakref.WeakKeyDictionary()
+
+# cached host health and circuit breakers, see healthmonitor.py
+HEALTH_MONITOR = HealthMonitor(
+    ttl=CONFIG.getfloat('service', 'OLLAMA_HEALTH_TTL', fallback=30.0),
+    probe_interval=CONFIG.getfloat('service', 'OLLAMA_HEALTH_INTERVAL', fallback=10.0),
+    probe_timeout=CONFIG.getfloat('service', 'OLLAMA_HEALTH_TIMEOUT', fallback=2.0),
+    failure_threshold=CONFIG.getint('service', 'OLLAMA_BREAKER_THRESHOLD', fallback=3),
+    reset_timeout=CONFIG.getfloat('service', 'OLLAMA_BREAKER_RESET', fallback=30.0),
+    trial_timeout=CONFIG.getfloat('service', 'OLLAMA_BREAKER_TRIAL_TIMEOUT',
+                                  fallback=OLLAMA_TIMEOUT + OLLAMA_CONNECT_TIMEOUT)
+)
+
+# connection level failures that count against a host's circuit breaker
+CONNECTION_ERRORS = (httpx.ReadError,
+                     httpx.ConnectError,
+                     httpx.RemoteProtocolError,
+                     httpx.TimeoutException,
+                     ConnectionError,
+                     TimeoutError,
+                     asyncio.TimeoutError)
+
+class OllamaUnavailable(ConnectionError):
+    """No Ollama host is available for a model"""
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Connection errors and overloaded/failing hosts are worth a retry,
+        a request Ollama rejected is not
+    """
+
+    if isinstance(error, ResponseError):
+        return error.status_code in (429, 500, 502, 503, 504)
+    return True
+
+
+# retries with backoff and jitter within a per-call deadline (seconds,
+#  including retries), see retrypolicy.py
+LLM_DEADLINE = CONFIG.getfloat('service', 'LLM_DEADLINE', fallback=OLLAMA_TIMEOUT)
+RETRY_POLICY = RetryPolicy(
+    max_attempts=CONFIG.getint('service', 'LLM_RETRY_MAX_ATTEMPTS', fallback=3),
+    base_delay=CONFIG.getfloat('service', 'LLM_RETRY_BASE_DELAY', fallback=0.5),
+    max_delay=CONFIG.getfloat('service', 'LLM_RETRY_MAX_DELAY', fallback=10.0),
+    deadline=LLM_DEADLINE,
+    budget=RetryBudget(CONFIG.getfloat('service', 'LLM_RETRY_BUDGET_RATIO', fallback=0.2)),
+    retry_on=CONNECTION_ERRORS + (ResponseError,),
+    is_retryable=_is_retryable
+)
+
+# async calls running longer than their model/prompt type's p95 get a
+#  second, hedged request on another host; first answer wins
+LLM_HEDGE_ENABLED = CONFIG.getboolean('service', 'LLM_HEDGE_ENABLED', fallback=False)
+LLM_HEDGE_MIN_SAMPLES = CONFIG.getint('service', 'LLM_HEDGE_MIN_SAMPLES', fallback=20)
+
+# monotonic deadline of the Ollama request being sent, applied to its
+#  httpx timeouts by _apply_deadline
+_DEADLINE: ContextVar[Optional[float]] = ContextVar('ollama_deadline', default=None)
+
+# seconds a deadline must undercut a timeout by for a timeout to be
+#  blamed on the deadline rather than on the host
+DEADLINE_CAP_MARGIN = 1.0
+
+# default generation options, temperature 0 makes responses cacheable
+CHAT_OPTIONS = {'temperature': 0}
+
+# per prompt type generation limits, see llmprofiles.py
+OPTION_PROFILES = load_profiles(CONFIG)
+
+
+def _generation_options(prompt_type: str, keep_alive: Optional[str]) -> tuple[dict[str, Any], Optional[str]]:
+    """Chat options and keep_alive for a prompt type, an explicit
+        keep_alive wins over the profile's
+    """
+
+    profile: Optional[OptionProfile] = profile_for(OPTION_PROFILES, prompt_type)
+    if profile is None:
+        return dict(CHAT_OPTIONS), keep_alive
+    return dict(CHAT_OPTIONS, **profile.options()), keep_alive or profile.keep_alive
+
+# how long a model digest reported by /api/tags is trusted
+OLLAMA_DIGEST_TTL = CONFIG.getfloat('service', 'OLLAMA_DIGEST_TTL', fallback=300.0)
+_MODEL_DIGESTS: dict[tuple[str, str], tuple[Optional[str], float]] = {}
+
+# how long Ollama keeps a model (and its prompt cache) loaded between the
+#  questions of a Conversation
+LLM_CONVERSATION_KEEP_ALIVE = CONFIG.get('service', 'LLM_CONVERSATION_KEEP_ALIVE', fallback='10m')
+
+
+def _build_response_cache() -> Optional[ResponseCache]:
+    """Response cache configured in setup.config, None when disabled
+    """
+
+    if not CONFIG.getboolean('service', 'LLM_CACHE_ENABLED', fallback=True):
+        return None
+
+    ttl = CONFIG.getfloat('service', 'LLM_CACHE_TTL', fallback=604800.0)
+    tiers = [MemoryTier(CONFIG.getint('service', 'LLM_CACHE_MAX_ENTRIES', fallback=10000), ttl)]
+
+    persistent = CONFIG.get('service', 'LLM_CACHE_PERSISTENT', fallback='none').lower()
+    persistent_max = CONFIG.getint('service', 'LLM_CACHE_PERSISTENT_MAX_ENTRIES', fallback=100000)
+    if persistent == 'sqlite':
+        tiers.append(SQLiteTier(CONFIG.get('service', 'LLM_CACHE_SQLITE_PATH', fallback='llm_cache.sqlite3'),
+                                persistent_max, ttl))
+    elif persistent == 'postgres':
+        tiers.append(PostgresTier(persistent_max, ttl))
+
+    # responses may carry patient data, keep them encrypted at rest
+    if CONFIG.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED', fallback=True):
+        return ResponseCache(tiers,
+                             encode=lambda value: encrypt_text(value).decode('utf-8'),
+                             decode=decrypt_text)
+    return ResponseCache(tiers)
+
+
+RESPONSE_CACHE = _build_response_cache()
+
+def _build_recorder() -> Optional[Recorder]:
+    """JSONL recorder of LLM exchanges, None unless LLM_RECORD_PATH is set
+    """
+
+    path = CONFIG.get('service', 'LLM_RECORD_PATH', fallback='')
+    if not path:
+        return None
+    if CONFIG.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED', fallback=True):
+        return Recorder(path, encode=lambda value: encrypt_text(value).decode('utf-8'))
+    return Recorder(path)
+
+
+def _build_replayer() -> Optional[Replayer]:
+    """Replayer of recorded LLM exchanges, None unless LLM_REPLAY_PATH is set
+    """
+
+    path = CONFIG.get('service', 'LLM_REPLAY_PATH', fallback='')
+    if not path:
+        return None
+    replayer = Replayer(path, decode=decrypt_text)
+    logging.info('Replaying %s LLM exchanges from %s', len(replayer), path)
+    return replayer
+
+
+# record mode captures real exchanges, replay mode serves them instead of
+#  Ollama; chats missing from the recording still go to Ollama
+RECORDER = _build_recorder()
+REPLAYER = _build_replayer()
+
+# identical concurrent requests share one Ollama call
+SINGLE_FLIGHT = SingleFlight()
+ASYNC_SINGLE_FLIGHT = AsyncSingleFlight()
+
+# per-call timings and counters, optionally appended to the llm_calls table
+TELEMETRY = Telemetry(LedgerWriter() if CONFIG.getboolean('service', 'LLM_TELEMETRY_LEDGER', fallback=False)
+                      else None)
+
+
+def _apply_deadline(request: httpx.Request) -> None:
+    """httpx request hook capping the request's timeouts at the time left
+        until the call's deadline
+    """
+
+    deadline_at = _DEADLINE.get()
+    if deadline_at is None:
+        return
+    remaining = max(0.001, deadline_at - time.monotonic())
+    request.extensions['timeout'] = httpx.Timeout(min(OLLAMA_TIMEOUT, remaining),
+                                                  connect=min(OLLAMA_CONNECT_TIMEOUT, remaining)).as_dict()
+
+
+async def _apply_deadline_async(request: httpx.Request) -> None:
+    _apply_deadline(request)
+
+
+def _client_kwargs(is_async: bool = False) -> dict[str, Any]:
+    """httpx settings for pooled, keep-alive Ollama clients
+    """
+
+    return {
+            'timeout': httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            'event_hooks': {'request': [_apply_deadline_async if is_async else _apply_deadline]},
+            'limits': httpx.Limits(
+                                   max_connections=OLLAMA_MAX_CONNECTIONS,
+                                   max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+                                   keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+                                  )
+           }
+
+
+def get_client(host: Optional[str] = None) -> Client:
+    """Shared Ollama client for a host, created on first use
+    """
+
+    host = host or OLLAMA_HOSTS[0]
+    client = _CLIENTS.get(host)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(host)
+            if client is None:
+                client = Client(host=host, **_client_kwargs())
+                _CLIENTS[host] = client
+    return client
+
+
+def get_async_client(host: Optional[str] = None) -> AsyncClient:
+    """Shared async Ollama client for a host on the running event loop,
+        created on first use
+    """
+
+    host = host or OLLAMA_HOSTS[0]
+    loop = asyncio.get_running_loop()
+    with _CLIENTS_LOCK:
+        loop_clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = loop_clients.get(host)
+        if client is None:
+            client = AsyncClient(host=host, **_client_kwargs(is_async=True))
+            loop_clients[host] = client
+    return client
+
+
+def close_clients() -> None:
+    """Close pooled sync clients and forget async ones, e.g. on shutdown
+    """
+
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+        _ASYNC_CLIENTS.clear()
+
+
+async def aclose_clients() -> None:
+    """Close pooled clients of the running event loop and all sync clients
+    """
+
+    with _CLIENTS_LOCK:
+        loop_clients = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        await client.close()
+    close_clients()
+
+
+def _tag_name(llm: str) -> str:
+    """Model name as listed by /api/tags
+    """
+
+    return llm if ':' in llm else llm + ':latest'
+
+
+def _remember_digests(host: str, llm: str, models) -> None:
+    now = time.monotonic()
+    for model in models['models']:
+        _MODEL_DIGESTS[(host, _tag_name(model['model']))] = (model['digest'], now)
+    # remember models the host does not have, too
+    if llm:
+        _MODEL_DIGESTS.setdefault((host, _tag_name(llm)), (None, now))
+
+
+def _cached_digest(host: str, llm: str) -> tuple[Optional[str], bool]:
+    """Known digest for a model and whether it is still fresh
+    """
+
+    digest, fetched_at = _MODEL_DIGESTS.get((host, _tag_name(llm)), (None, 0.0))
+    return digest, time.monotonic() - fetched_at < OLLAMA_DIGEST_TTL
+
+
+def model_digest(host: str, llm: str) -> Optional[str]:
+    """Digest of the model build served by host, None if unknown
+    """
+
+    digest, fresh = _cached_digest(host, llm)
+    if not fresh:
+        try:
+            _remember_digests(host, llm, get_client(host).list())
+        except CONNECTION_ERRORS + (ResponseError,) as e:
+            logging.warning('Unable to list models on %s: %s', host, e)
+            return digest
+        digest, _ = _cached_digest(host, llm)
+    return digest
+
+
+async def model_digest_async(host: str, llm: str) -> Optional[str]:
+    """Digest of the model build served by host, None if unknown
+    """
+
+    digest, fresh = _cached_digest(host, llm)
+    if not fresh:
+        try:
+            _remember_digests(host, llm, await get_async_client(host).list())
+        except CONNECTION_ERRORS + (ResponseError,) as e:
+            logging.warning('Unable to list models on %s: %s', host, e)
+            return digest
+        digest, _ = _cached_digest(host, llm)
+    return digest
+
+
+def _host_models(host: str) -> set[str]:
+    """Models pulled on a host, also refreshing their known digests
+    """
+
+    models = get_client(host).list()
+    _remember_digests(host, '', models)
+    return {_tag_name(model['model']) for model in models['models']}
+
+
+# routes requests across OLLAMA_HOSTS, see llmrouter.py
+ROUTER = OllamaRouter(OLLAMA_HOSTS, HEALTH_MONITOR, _host_models, OLLAMA_DIGEST_TTL)
+
+
+def _admit(llm: str, route_key: Optional[str], host: Optional[str]) -> Optional[str]:
+    """First host, starting with host, whose circuit breaker admits a
+        request for llm
+    """
+
+    tried = []
+    while host is not None:
+        if HEALTH_MONITOR.is_available(host):
+            return host
+        tried.append(host)
+        host = ROUTER.pick(_tag_name(llm), route_key, exclude=tried)
+    logging.error('No Ollama Server available for %s', llm)
+    return None
+
+
+def _retry_host(llm: str, route_key: Optional[str], tried: list[str]) -> Optional[str]:
+    """Host for a retry, another one than before if there is one
+    """
+
+    host = ROUTER.pick(_tag_name(llm), route_key, exclude=tried)
+    return host if host is not None else (tried[-1] if tried else None)
+
+
+def _deadline_capped(error: BaseException, remaining: Optional[float]) -> bool:
+    """True if error is a timeout _apply_deadline shortened, i.e. the
+        caller's deadline rather than OLLAMA_(CONNECT_)TIMEOUT ran out
+    """
+
+    if not isinstance(error, httpx.TimeoutException) or remaining is None:
+        return False
+    timeout = OLLAMA_CONNECT_TIMEOUT if isinstance(error, httpx.ConnectTimeout) else OLLAMA_TIMEOUT
+    # remaining is taken when the attempt starts, the request is sent a
+    #  moment later; a deadline equal to the timeout does not cap it
+    return remaining + DEADLINE_CAP_MARGIN < timeout
+
+
+def _record_host_failure(host: str, error: BaseException, remaining: Optional[float]) -> None:
+    """Count a failed request against host, unless it only timed out
+        because the caller's deadline capped its timeout
+    """
+
+    if _deadline_capped(error, remaining):
+        return
+    HEALTH_MONITOR.record_failure(host)
+
+
+def _hedge_after(llm: str, prompt_type: str) -> Optional[float]:
+    """Seconds after which an async call gets a hedged request, None if
+        hedging is off or latency is not known well enough yet
+    """
+
+    if not LLM_HEDGE_ENABLED or len(ROUTER.hosts) < 2:
+        return None
+    return TELEMETRY.quantile(llm, prompt_type, 0.95, min_samples=LLM_HEDGE_MIN_SAMPLES)
+
+
+def _response_cache_key(digest: Optional[str], llm: str, content: str, options: dict[str, Any]) -> Optional[str]:
+    """Cache key for a prompt, None if the response must not be cached
+    """
+
+    if not digest:
+        return None
+    return cache_key(llm, digest, content, options)
+
+
+def _record_call(llm: str,
+                 prompt_type: str,
+                 started: float,
+                 host: Optional[str] = None,
+                 cache_hit: bool = False,
+                 complete: bool = True,
+                 error: Optional[str] = None,
+                 metrics: Optional[dict[str, Optional[int]]] = None,
+                 coalesced: bool = False
+                ) -> None:
+    """Account for an LLM call in TELEMETRY
+    """
+
+    TELEMETRY.record(CallRecord(model=llm,
+                                prompt_type=prompt_type,
+                                wall_time=time.monotonic() - started,
+                                host=host,
+                                cache_hit=cache_hit,
+                                complete=complete,
+                                error=error,
+                                metrics=metrics or {},
+                                coalesced=coalesced))
+
+
+def telemetry_stats() -> dict[str, dict[str, Any]]:
+    """LLM call counters and histograms per model and prompt type
+    """
+
+    return TELEMETRY.snapshot()
+
+
+def cache_stats() -> Optional[dict[str, Any]]:
+    """Response cache hit/miss counters
+    """
+
+    return RESPONSE_CACHE.stats() if RESPONSE_CACHE else None
+
+
+def _chat_messages(content: str) -> list[dict[str, str]]:
+    """Single user message chat
+    """
+
+    return [
+            {
+                'role': 'user',
+                'content': content
+            },
+           ]
+
+
+def _analyzed_obj(analysis: str, dt, encrypt_analysis: bool) -> dict[str, Any]:
+    """Wrap model output into the timestamp/sha512/analysis envelope
+        stored by callers
+    """
+
+    analysis = sanitize_string(analysis)
+
+    # this is for the analysis text only - the idea is to avoid
+    #  duplicate text document, to allow indexing the column so
+    #  to speed up search/lookups
+    analysis_sha512 = hashlib.sha512(str.encode(analysis)).hexdigest()
+
+    # see encryption.py module
+    # encrypt text *** make sure that encryption key file is secure! ***
+
+    if encrypt_analysis:
+        analysis = encrypt_text(analysis).decode('utf-8')
+
+    analyzed_obj = {
+                    'timestamp': dt,
+                    'shasum_512': analysis_sha512,
+                    'analysis': analysis
+                    }
+
+    return analyzed_obj
+
+
+def stop_after_json_object() -> Callable[[str], bool]:
+    """Stop predicate for streamed responses: true once the text holds a
+        complete top level JSON object
+    """
+
+    state = {'pos': 0, 'depth': 0, 'in_string': False, 'escaped': False, 'started': False}
+
+    def predicate(text: str) -> bool:
+        for char in text[state['pos']:]:
+            state['pos'] += 1
+            if state['in_string']:
+                if state['escaped']:
+                    state['escaped'] = False
+                elif char == '\\':
+                    state['escaped'] = True
+                elif char == '"':
+                    state['in_string'] = False
+            elif char == '"' and state['started']:
+                state['in_string'] = True
+            elif char == '{':
+                state['started'] = True
+                state['depth'] += 1
+            elif char == '}' and state['started']:
+                state['depth'] -= 1
+                if state['depth'] == 0:
+                    return True
+        return False
+
+    return predicate
+
+
+def stop_after_matches(extract: Callable[[str], list], count: int) -> Callable[[str], bool]:
+    """Stop predicate for streamed responses: true once extract() finds
+        count distinct matches, e.g. ICD-10 codes
+    """
+
+    def predicate(text: str) -> bool:
+        return len(set(extract(text))) >= count
+
+    return predicate
+
+
+def _chat_text(client: Client,
+               llm: str,
+               messages: list[dict[str, str]],
+               options: dict[str, Any],
+               stop_when: Optional[Callable[[str], bool]] = None,
+               on_chunk: Optional[Callable[[str], None]] = None,
+               keep_alive: Optional[str] = None,
+               format: Optional[dict[str, Any]] = None
+              ) -> tuple[str, bool, dict[str, Optional[int]]]:
+    """Run a chat request, returns the response text, whether it is
+        complete and Ollama's timing metrics. With stop_when or on_chunk the response is streamed and
+        closing the stream early makes Ollama stop generating. format is
+        Ollama's structured output JSON schema.
+    """
+
+    if stop_when is None and on_chunk is None:
+        response = client.chat(model=llm, stream=False, messages=messages, options=options,
+                               keep_alive=keep_alive, format=format)
+        return response['message']['content'], True, response_metrics(response)
+
+    text, metrics = '', {}
+    stream = client.chat(model=llm, stream=True, messages=messages, options=options,
+                         keep_alive=keep_alive, format=format)
+    try:
+        for part in stream:
+            chunk = part['message']['content']
+            text += chunk
+            if on_chunk is not None:
+                on_chunk(chunk)
+            if stop_when is not None and stop_when(text):
+                return text, False, {}
+            if part.get('done'):
+                metrics = response_metrics(part)
+    finally:
+        stream.close()
+    return text, True, metrics
+
+
+async def _chat_text_async(client: AsyncClient,
+                           llm: str,
+                           messages: list[dict[str, str]],
+                           options: dict[str, Any],
+                           stop_when: Optional[Callable[[str], bool]] = None,
+                           on_chunk: Optional[Callable[[str], None]] = None,
+                           keep_alive: Optional[str] = None,
+                           format: Optional[dict[str, Any]] = None
+                          ) -> tuple[str, bool, dict[str, Optional[int]]]:
+    """Async _chat_text
+    """
+
+    if stop_when is None and on_chunk is None:
+        response = await client.chat(model=llm, stream=False, messages=messages, options=options,
+                                     keep_alive=keep_alive, format=format)
+        return response['message']['content'], True, response_metrics(response)
+
+    text, metrics = '', {}
+    stream = await client.chat(model=llm, stream=True, messages=messages, options=options,
+                               keep_alive=keep_alive, format=format)
+    try:
+        async for part in stream:
+            chunk = part['message']['content']
+            text += chunk
+            if on_chunk is not None:
+                on_chunk(chunk)
+            if stop_when is not None and stop_when(text):
+                return text, False, {}
+            if part.get('done'):
+                metrics = response_metrics(part)
+    finally:
+        await stream.aclose()
+    return text, True, metrics
+
+
+def _cache_prompt(messages: list[dict[str, str]]) -> str:
+    """Text a chat is cached under, a single message chat by its content
+    """
+
+    if len(messages) == 1:
+        return messages[0]['content']
+    return json.dumps(messages, sort_keys=True)
+
 
 def prompt_chat(llm: str,
                 content: str,
-                encrypt_analysis: Optional[bool] = None
+                encrypt_analysis: Optional[bool] = None,
+                *,
+                stop_when: Optional[Callable[[str], bool]] = None,
+                on_chunk: Optional[Callable[[str], None]] = None,
+                route_key: Optional[str] = None,
+                format: Optional[dict[str, Any]] = None,
+                prompt_type: str = 'chat',
+                deadline: Optional[float] = None
                ) -> Optional[dict[str, Any]]:
     """Llama Chat Prompting and response
+
+        Passing stop_when and/or on_chunk streams the response; stop_when
+        is called with the text so far and ends generation once it
+        returns True, see stop_after_json_object/stop_after_matches.
+        Requests with the same route_key stick to the same Ollama host.
+        A JSON schema in format constrains the response to match it.
+        prompt_type labels the call in telemetry, e.g. summary or icd,
+        and selects its option profile (num_predict, stop, ...).
+        Failed calls are retried per RETRY_POLICY until deadline seconds
+        (default LLM_DEADLINE) have passed.
     """
 
-    ollama_server = CONFIG.get('service', 'OLLAMA_API_URL')
+    return prompt_messages(llm, _chat_messages(content), encrypt_analysis,
+                           stop_when=stop_when, on_chunk=on_chunk, route_key=route_key, format=format,
+                           prompt_type=prompt_type, deadline=deadline)
 
-    if not check_endpoint_health(ollama_server):
-        logging.error('Ollama Server %s is not available', ollama_server)
+
+def prompt_messages(llm: str,
+                    messages: list[dict[str, str]],
+                    encrypt_analysis: Optional[bool] = None,
+                    *,
+                    stop_when: Optional[Callable[[str], bool]] = None,
+                    on_chunk: Optional[Callable[[str], None]] = None,
+                    route_key: Optional[str] = None,
+                    keep_alive: Optional[str] = None,
+                    format: Optional[dict[str, Any]] = None,
+                    prompt_type: str = 'chat',
+                    deadline: Optional[float] = None
+                   ) -> Optional[dict[str, Any]]:
+    """prompt_chat for a multi-turn message list, keep_alive is passed
+        on to Ollama
+    """
+
+    started = time.monotonic()
+    if encrypt_analysis is None:
+        encrypt_analysis = CONFIG.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED')
+
+    dt = ts_int_to_dt_obj()
+    options, keep_alive = _generation_options(prompt_type, keep_alive)
+
+    # identifies the request for replay, recording and single-flight
+    exchange = exchange_key(llm, messages, options, format)
+    if REPLAYER is not None:
+        replayed = REPLAYER.get(exchange)
+        if replayed is not None:
+            _record_call(llm, prompt_type, started, 'replay', metrics=replayed[1])
+            return _analyzed_obj(replayed[0], dt, encrypt_analysis)
+
+    ollama_server = ROUTER.pick(_tag_name(llm), route_key)
+    if ollama_server is None:
+        logging.error('No Ollama Server available for %s', llm)
+        _record_call(llm, prompt_type, started, error='unavailable')
         return False
 
+    key = None
+    if RESPONSE_CACHE is not None and is_deterministic(options):
+        key = _response_cache_key(model_digest(ollama_server, llm), llm, _cache_prompt(messages),
+                                  dict(options, format=format) if format else options)
+    if key:
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            _record_call(llm, prompt_type, started, ollama_server, cache_hit=True)
+            return _analyzed_obj(cached, dt, encrypt_analysis)
+
+    tried: list[str] = []
+
+    def attempt(number: int, remaining: Optional[float]) -> tuple[str, bool, dict[str, Optional[int]]]:
+        host = _admit(llm, route_key, ollama_server if number == 1 else _retry_host(llm, route_key, tried))
+        if host is None:
+            _record_call(llm, prompt_type, started, error='unavailable')
+            raise OllamaUnavailable(f'No Ollama Server available for {llm}')
+        tried.append(host)
+
+        client = get_client(host)
+        logging.info('Running for %s on %s', llm, host)
+        token = _DEADLINE.set(time.monotonic() + remaining if remaining is not None else None)
+        try:
+            with ROUTER.track(host):
+                result = _chat_text(client, llm, messages, options, stop_when, on_chunk, keep_alive, format)
+        except ResponseError as e:
+            # the host answered, only this request failed
+            HEALTH_MONITOR.record_success(host)
+            _record_call(llm, prompt_type, started, host, error=type(e).__name__)
+            raise
+        except CONNECTION_ERRORS as e:
+            _record_host_failure(host, e, remaining)
+            _record_call(llm, prompt_type, started, host, error=type(e).__name__)
+            logging.error('Unable to reach Ollama Server %s: %s', host, e)
+            raise
+        else:
+            HEALTH_MONITOR.record_success(host)
+        finally:
+            _DEADLINE.reset(token)
+            # a deadline capped timeout or any other error has no outcome
+            HEALTH_MONITOR.release(host)
+        _record_call(llm, prompt_type, started, host, complete=result[1], metrics=result[2])
+        return result
+
+    def call() -> Optional[str]:
+        try:
+            # a streamed answer can not be taken back, so it is not retried
+            analysis, complete, metrics = RETRY_POLICY.call(attempt, deadline,
+                                                            max_attempts=1 if on_chunk else None)
+        except (CONNECTION_ERRORS + (DeadlineExceeded,)) as e:
+            logging.error('Giving up on %s after %s attempts: %r', llm, len(tried), e)
+            return None
+
+        # only complete responses are cached, a cut off one is specific
+        #  to the caller's stop predicate
+        if key and complete:
+            RESPONSE_CACHE.set(key, analysis)
+        if RECORDER is not None and complete:
+            RECORDER.record(exchange, llm, analysis, prompt_type, metrics)
+        return analysis
+
+    if stop_when is None and on_chunk is None:
+        # streamed calls are specific to their caller and never shared
+        analysis, shared = SINGLE_FLIGHT.do(exchange, call)
+        if shared:
+            _record_call(llm, prompt_type, started, ollama_server, coalesced=True)
+    else:
+        analysis = call()
+    if analysis is None:
+        return False
+
+    # chatgpt analysis
+    return _analyzed_obj(analysis, dt, encrypt_analysis)
+
+
+def stream_chat(llm: str,
+                content: str,
+                route_key: Optional[str] = None,
+                prompt_type: str = 'chat'
+               ) -> Iterator[str]:
+    """Yield response chunks as the model generates them. Closing the
+        generator early makes Ollama stop generating.
+    """
+
+    options, keep_alive = _generation_options(prompt_type, None)
+
+    ollama_server = _admit(llm, route_key, ROUTER.pick(_tag_name(llm), route_key))
+    if ollama_server is None:
+        return
+
+    with ROUTER.track(ollama_server):
+        stream = get_client(ollama_server).chat(model=llm,
+                                                stream=True,
+                                                messages=_chat_messages(content),
+                                                options=options,
+                                                keep_alive=keep_alive)
+        try:
+            for part in stream:
+                yield part['message']['content']
+            HEALTH_MONITOR.record_success(ollama_server)
+        except CONNECTION_ERRORS:
+            HEALTH_MONITOR.record_failure(ollama_server)
+            raise
+        finally:
+            stream.close()
+            HEALTH_MONITOR.release(ollama_server)
+
+
+def _semaphore(registry: dict[str, asyncio.Semaphore], key: str, limit: int) -> asyncio.Semaphore:
+    """Semaphore for key from a per-event-loop registry
+    """
+
+    semaphore = registry.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(limit)
+        registry[key] = semaphore
+    return semaphore
+
+
+def _concurrency_limits(llm: str, host: str) -> tuple[asyncio.Semaphore, asyncio.Semaphore]:
+    """Per-model (on a host) and per-host semaphores for the running
+        event loop
+    """
+
+    loop = asyncio.get_running_loop()
+    model_limits, host_limits = _SEMAPHORES.setdefault(loop, ({}, {}))
+    return (_semaphore(model_limits, f'{host}|{llm}', OLLAMA_MAX_CONCURRENCY_PER_MODEL),
+            _semaphore(host_limits, host, OLLAMA_MAX_CONCURRENCY_PER_HOST))
+
+
+async def prompt_chat_async(llm: str,
+                            content: str,
+                            encrypt_analysis: Optional[bool] = None,
+                            *,
+                            stop_when: Optional[Callable[[str], bool]] = None,
+                            on_chunk: Optional[Callable[[str], None]] = None,
+                            route_key: Optional[str] = None,
+                            format: Optional[dict[str, Any]] = None,
+                            prompt_type: str = 'chat',
+                            deadline: Optional[float] = None
+                           ) -> Optional[dict[str, Any]]:
+    """Async Llama Chat Prompting and response, same envelope, streaming
+        and routing options as prompt_chat. Concurrent calls are bounded
+        per model and per host.
+    """
+
+    return await prompt_messages_async(llm, _chat_messages(content), encrypt_analysis,
+                                       stop_when=stop_when, on_chunk=on_chunk, route_key=route_key,
+                                       format=format, prompt_type=prompt_type, deadline=deadline)
+
+
+async def prompt_messages_async(llm: str,
+                                messages: list[dict[str, str]],
+                                encrypt_analysis: Optional[bool] = None,
+                                *,
+                                stop_when: Optional[Callable[[str], bool]] = None,
+                                on_chunk: Optional[Callable[[str], None]] = None,
+                                route_key: Optional[str] = None,
+                                keep_alive: Optional[str] = None,
+                                format: Optional[dict[str, Any]] = None,
+                                prompt_type: str = 'chat',
+                                deadline: Optional[float] = None
+                               ) -> Optional[dict[str, Any]]:
+    """Async prompt_messages, slow calls may be hedged on a second host
+        (LLM_HEDGE_ENABLED)
+    """
+
+    started = time.monotonic()
     if encrypt_analysis is None:
         encrypt_analysis = CONFIG.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED')
 
     dt = ts_int_to_dt_obj()
-    client = Client(host=ollama_server)
-    logging.info('Running for %s', llm)
-    try:
-        response = client.chat(
-                                model=llm,
-                                stream=False,
-                                messages=[
-                                    {
-                                        'role': 'user',
-                                        'content': content
-                                    },
-                                ],
-                                options={
-                                    'temperature': 0
-                                }
-                            )
-
-        # chatgpt analysis
-        analysis = response['message']['content']
-        analysis = sanitize_string(analysis)
-
-        # this is for the analysis text only - the idea is to avoid
-        #  duplicate text document, to allow indexing the column so
-        #  to speed up search/lookups
-        analysis_sha512 = hashlib.sha512(str.encode(analysis)).hexdigest()
-
-        # see encryption.py module
-        # encrypt text *** make sure that encryption key file is secure! ***
-
-        if encrypt_analysis:
-            analysis = encrypt_text(analysis).decode('utf-8')
-
-        analyzed_obj = {
-                        'timestamp': dt,
-                        'shasum_512': analysis_sha512,
-                        'analysis': analysis
-                        }
-
-        return analyzed_obj
-    except (httpx.ReadError, httpx.ConnectError, httpx.RemoteProtocolError) as e:
-        logging.error('Error: %s', e.args[0])
-        logging.error('Unable to reach Ollama Server: %s', ollama_server)
+    options, keep_alive = _generation_options(prompt_type, keep_alive)
+
+    # identifies the request for replay, recording and single-flight
+    exchange = exchange_key(llm, messages, options, format)
+    if REPLAYER is not None:
+        replayed = REPLAYER.get(exchange)
+        if replayed is not None:
+            _record_call(llm, prompt_type, started, 'replay', metrics=replayed[1])
+            return _analyzed_obj(replayed[0], dt, encrypt_analysis)
+
+    ollama_server = ROUTER.pick(_tag_name(llm), route_key)
+    if ollama_server is None:
+        logging.error('No Ollama Server available for %s', llm)
+        _record_call(llm, prompt_type, started, error='unavailable')
+        return False
+
+    key = None
+    if RESPONSE_CACHE is not None and is_deterministic(options):
+        key = _response_cache_key(await model_digest_async(ollama_server, llm), llm,
+                                  _cache_prompt(messages), dict(options, format=format) if format else options)
+    if key:
+        cached = await _cache_get_async(key)
+        if cached is not None:
+            _record_call(llm, prompt_type, started, ollama_server, cache_hit=True)
+            return _analyzed_obj(cached, dt, encrypt_analysis)
+
+    tried: list[str] = []
+
+    async def attempt_on(host: str, remaining: Optional[float]) -> tuple[str, bool, dict[str, Optional[int]]]:
+        model_limit, host_limit = _concurrency_limits(llm, host)
+        async with model_limit, host_limit:
+            client = get_async_client(host)
+            logging.info('Running for %s on %s', llm, host)
+            token = _DEADLINE.set(time.monotonic() + remaining if remaining is not None else None)
+            try:
+                with ROUTER.track(host):
+                    result = await _chat_text_async(client, llm, messages, options,
+                                                    stop_when, on_chunk, keep_alive, format)
+            except ResponseError as e:
+                HEALTH_MONITOR.record_success(host)
+                _record_call(llm, prompt_type, started, host, error=type(e).__name__)
+                raise
+            except CONNECTION_ERRORS as e:
+                _record_host_failure(host, e, remaining)
+                _record_call(llm, prompt_type, started, host, error=type(e).__name__)
+                logging.error('Unable to reach Ollama Server %s: %s', host, e)
+                raise
+            finally:
+                _DEADLINE.reset(token)
+        HEALTH_MONITOR.record_success(host)
+        _record_call(llm, prompt_type, started, host, complete=result[1], metrics=result[2])
+        return result
+
+    async def attempt(number: int, remaining: Optional[float]) -> tuple[str, bool, dict[str, Optional[int]]]:
+        host = _admit(llm, route_key, ollama_server if number == 1 else _retry_host(llm, route_key, tried))
+        if host is None:
+            _record_call(llm, prompt_type, started, error='unavailable')
+            raise OllamaUnavailable(f'No Ollama Server available for {llm}')
+        tried.append(host)
+        admitted = [host]
+
+        hedge_after = _hedge_after(llm, prompt_type) if stop_when is None and on_chunk is None else None
+        # tasks copy the context, each attempt_on sets its own deadline
+        tasks: set[asyncio.Future] = set()
+        try:
+            if hedge_after is None:
+                return await attempt_on(host, remaining)
+
+            tasks.add(asyncio.ensure_future(attempt_on(host, remaining)))
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                hedge_host = ROUTER.pick(_tag_name(llm), route_key, exclude=tried)
+                if hedge_host is not None and HEALTH_MONITOR.is_available(hedge_host):
+                    logging.info('Hedging %s %s on %s after %.1fs', llm, prompt_type, hedge_host, hedge_after)
+                    tried.append(hedge_host)
+                    admitted.append(hedge_host)
+                    tasks.add(asyncio.ensure_future(attempt_on(
+                        hedge_host, remaining - hedge_after if remaining is not None else None)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # hedge losers, deadline capped timeouts and cancellations
+            #  (wait_for, MEDLLM_TIMEOUT) end without an outcome
+            for admitted_host in admitted:
+                HEALTH_MONITOR.release(admitted_host)
+
+    async def call() -> Optional[str]:
+        try:
+            analysis, complete, metrics = await RETRY_POLICY.call_async(attempt, deadline,
+                                                                        max_attempts=1 if on_chunk else None)
+        except (CONNECTION_ERRORS + (DeadlineExceeded,)) as e:
+            logging.error('Giving up on %s after %s attempts: %r', llm, len(tried), e)
+            return None
+
+        if key and complete:
+            await _cache_set_async(key, analysis)
+        if RECORDER is not None and complete:
+            await asyncio.to_thread(RECORDER.record, exchange, llm, analysis, prompt_type, metrics)
+        return analysis
+
+    if stop_when is None and on_chunk is None:
+        analysis, shared = await ASYNC_SINGLE_FLIGHT.do(exchange, call)
+        if shared:
+            _record_call(llm, prompt_type, started, ollama_server, coalesced=True)
+    else:
+        analysis = await call()
+    if analysis is None:
         return False
+    return _analyzed_obj(analysis, dt, encrypt_analysis)
+
+
+async def _cache_get_async(key: str) -> Optional[str]:
+    """Response cache read, off the event loop if it may touch disk/network
+    """
+
+    if RESPONSE_CACHE.has_persistent_tier:
+        return await asyncio.to_thread(RESPONSE_CACHE.get, key)
+    return RESPONSE_CACHE.get(key)
+
+
+async def _cache_set_async(key: str, value: str) -> None:
+    """Response cache write, off the event loop if it may touch disk/network
+    """
+
+    if RESPONSE_CACHE.has_persistent_tier:
+        await asyncio.to_thread(RESPONSE_CACHE.set, key, value)
+    else:
+        RESPONSE_CACHE.set(key, value)
+
+
+def _lookup_cache_key(llm: str, content: str, prompt_type: str, digest: Optional[str]) -> Optional[str]:
+    """Key prompt_chat caches the single message prompt content under
+    """
+
+    options, _ = _generation_options(prompt_type, None)
+    if RESPONSE_CACHE is None or not is_deterministic(options):
+        return None
+    return _response_cache_key(digest, llm, content, options)
+
+
+def cached_response(llm: str, content: str, prompt_type: str = 'chat') -> Optional[str]:
+    """Cached answer to the single message prompt content, as prompt_chat
+        would serve it, None if not cached
+    """
+
+    host = ROUTER.pick(_tag_name(llm))
+    key = _lookup_cache_key(llm, content, prompt_type, model_digest(host, llm) if host else None)
+    return RESPONSE_CACHE.get(key) if key else None
+
+
+def cache_response(llm: str, content: str, analysis: str, prompt_type: str = 'chat') -> None:
+    """Cache analysis as the answer to the single message prompt content,
+        e.g. per code answers split out of a batched lookup
+    """
+
+    host = ROUTER.pick(_tag_name(llm))
+    key = _lookup_cache_key(llm, content, prompt_type, model_digest(host, llm) if host else None)
+    if key:
+        RESPONSE_CACHE.set(key, analysis)
+
+
+async def cached_response_async(llm: str, content: str, prompt_type: str = 'chat') -> Optional[str]:
+    """Async cached_response
+    """
+
+    host = ROUTER.pick(_tag_name(llm))
+    key = _lookup_cache_key(llm, content, prompt_type, await model_digest_async(host, llm) if host else None)
+    return await _cache_get_async(key) if key else None
+
+
+async def cache_response_async(llm: str, content: str, analysis: str, prompt_type: str = 'chat') -> None:
+    """Async cache_response
+    """
+
+    host = ROUTER.pick(_tag_name(llm))
+    key = _lookup_cache_key(llm, content, prompt_type, await model_digest_async(host, llm) if host else None)
+    if key:
+        await _cache_set_async(key, analysis)
+
+
+class Conversation:
+    """Several questions about one shared context, e.g. the code prompts
+        about a diagnosis
+
+        Every request starts with the same context messages, so Ollama
+        evaluates the (long) context once, keeps it in its prompt cache
+        and only evaluates the short question of each later request. The
+        conversation sticks to one host and keeps the model loaded with
+        keep_alive in between.
+    """
+
+    ACK = 'Understood.'
+
+    def __init__(self,
+                 llm: str,
+                 context: str,
+                 encrypt_analysis: Optional[bool] = None,
+                 route_key: Optional[str] = None,
+                 keep_alive: Optional[str] = None
+                ) -> None:
+        self.llm = llm
+        self.encrypt_analysis = encrypt_analysis
+        # the prompt cache lives on one host, without a route key the
+        #  context itself picks it
+        self.route_key = route_key or hashlib.sha1(context.encode()).hexdigest()
+        self.keep_alive = keep_alive or LLM_CONVERSATION_KEEP_ALIVE
+        self.prefix = [
+                       {'role': 'user', 'content': context},
+                       {'role': 'assistant', 'content': self.ACK}
+                      ]
+
+    def messages(self, question: str, history: tuple[tuple[str, str], ...] = ()) -> list[dict[str, str]]:
+        """Context, earlier (question, answer) turns, then question
+        """
+
+        messages = list(self.prefix)
+        for asked, answer in history:
+            messages.append({'role': 'user', 'content': asked})
+            messages.append({'role': 'assistant', 'content': answer})
+        messages.append({'role': 'user', 'content': question})
+        return messages
+
+    def ask(self,
+            question: str,
+            history: tuple[tuple[str, str], ...] = (),
+            prompt_type: str = 'chat'
+           ) -> Optional[dict[str, Any]]:
+        """Answer envelope for question, see prompt_chat
+        """
+
+        return prompt_messages(self.llm, self.messages(question, history), self.encrypt_analysis,
+                               route_key=self.route_key, keep_alive=self.keep_alive, prompt_type=prompt_type)
+
+    async def ask_async(self,
+                        question: str,
+                        history: tuple[tuple[str, str], ...] = (),
+                        prompt_type: str = 'chat'
+                       ) -> Optional[dict[str, Any]]:
+        """Async ask
+        """
+
+        return await prompt_messages_async(self.llm, self.messages(question, history), self.encrypt_analysis,
+                                           route_key=self.route_key, keep_alive=self.keep_alive,
+                                           prompt_type=prompt_type)
+
+    async def ask_all_async(self,
+                            questions: dict[str, str],
+                            history: tuple[tuple[str, str], ...] = ()
+                           ) -> dict[str, Optional[dict[str, Any]]]:
+        """Answer envelopes per key of questions, keys double as telemetry
+            prompt types. The first question runs alone to warm the prompt
+            cache with the shared prefix, the rest run concurrently on top
+            of it.
+        """
+
+        if not questions:
+            return {}
+        keys = list(questions)
+        first = await self.ask_async(questions[keys[0]], history, keys[0])
+        rest = await asyncio.gather(*(self.ask_async(questions[key], history, key) for key in keys[1:]))
+        return dict(zip(keys, [first, *rest]))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Cached endpoint health and circuit breaking for Ollama hosts
+    ©2024, Ovais Quraishi
+
+    Callers ask HealthMonitor.is_available(host) before sending a request
+    instead of probing the host every time. Up/down state comes from a
+    background probe thread and is cached for a TTL; a stale state is
+    probed again inline, or in the background when asked from an event
+    loop, which must not block on the probe. A per-host circuit
+    breaker trips after consecutive connection errors so callers fail
+    fast while a host is stalled or down. A request admitted by
+    is_available must end with record_success, record_failure or
+    release, the latter e.g. when it was cancelled.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from utils import check_endpoint_health
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def _on_event_loop() -> bool:
+    """True if called from a thread running an asyncio event loop"""
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker for a single host
+    """
+
+    def __init__(self,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30.0,
+                 trial_timeout: Optional[float] = None
+                ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # seconds after which a half-open trial without an outcome is
+        #  considered lost and another one is let through, None never
+        self.trial_timeout = trial_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Current breaker state, moving open -> half-open once the
+            reset timeout has elapsed
+        """
+
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self) -> None:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trial_in_flight = False
+
+    def _trial_stale(self) -> bool:
+        return (self.trial_timeout is not None
+                and time.monotonic() - self._trial_started >= self.trial_timeout)
+
+    def allow_request(self) -> bool:
+        """True if a request may be sent; in half-open state only a
+            single trial request is let through
+        """
+
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and (not self._trial_in_flight or self._trial_stale()):
+                self._trial_in_flight = True
+                self._trial_started = time.monotonic()
+                return True
+            return False
+
+    def release_trial(self) -> None:
+        """End a half-open trial that recorded neither success nor
+            failure, e.g. a cancelled request, so the next one may try
+        """
+
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        """Close the breaker and reset the failure count"""
+
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """Count a connection failure, opening the breaker at the threshold
+            or straight away if the half-open trial failed
+        """
+
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logging.warning('Circuit breaker opened after %s failures', self._failures)
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def probe_succeeded(self) -> None:
+        """A health probe got through; let an open breaker try a request
+            and drop a half-open trial that was lost without an outcome
+        """
+
+        with self._lock:
+            if self._state == OPEN:
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            elif self._state == HALF_OPEN and self._trial_in_flight and self._trial_stale():
+                self._trial_in_flight = False
+
+
+class HealthMonitor:
+    """Background-probed, TTL cached health state plus a circuit breaker
+        per host
+    """
+
+    def __init__(self,
+                 ttl: float = 30.0,
+                 probe_interval: float = 10.0,
+                 probe_timeout: float = 2.0,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30.0,
+                 trial_timeout: Optional[float] = None,
+                 probe: Optional[Callable[[str, float], bool]] = None
+                ) -> None:
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = trial_timeout
+        self._probe = probe or check_endpoint_health
+        self._status: dict[str, tuple[bool, float]] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[str, bool], None]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._refreshing: set[str] = set()
+
+    def add_listener(self, listener: Callable[[str, bool], None]) -> None:
+        """Call listener(host, is_up) after every probe"""
+
+        self._listeners.append(listener)
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        """Circuit breaker for a host, created on first use"""
+
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout, self.trial_timeout)
+                self._breakers[host] = breaker
+                self._status.setdefault(host, (True, 0.0))
+            return breaker
+
+    def probe(self, host: str) -> bool:
+        """Probe a host now and cache the result"""
+
+        is_up = self._probe(host, self.probe_timeout)
+        with self._lock:
+            self._status[host] = (is_up, time.monotonic())
+        if is_up:
+            self.breaker(host).probe_succeeded()
+        for listener in self._listeners:
+            listener(host, is_up)
+        return is_up
+
+    def refresh(self, host: str) -> None:
+        """Probe a host in a background thread, unless it is already being
+            probed that way
+        """
+
+        with self._lock:
+            if host in self._refreshing:
+                return
+            self._refreshing.add(host)
+
+        def run() -> None:
+            try:
+                self.probe(host)
+            except Exception as e:  # keep the caller's state as it was
+                logging.error('Health probe for %s failed: %s', host, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(host)
+
+        threading.Thread(target=run, name='ollama-health-refresh', daemon=True).start()
+
+    def is_up(self, host: str) -> bool:
+        """Cached up/down state, probing if it is stale: inline, or in
+            the background when called from an event loop, which gets the
+            cached state meanwhile
+        """
+
+        self.breaker(host)
+        self._ensure_started()
+        with self._lock:
+            is_up, checked_at = self._status[host]
+        if time.monotonic() - checked_at > self.ttl:
+            if _on_event_loop():
+                self.refresh(host)
+                return is_up
+            return self.probe(host)
+        return is_up
+
+    def is_available(self, host: str) -> bool:
+        """True if the host is up and its breaker lets a request through"""
+
+        return self.is_up(host) and self.breaker(host).allow_request()
+
+    def record_success(self, host: str) -> None:
+        """A request to the host completed"""
+
+        self.breaker(host).record_success()
+        with self._lock:
+            self._status[host] = (True, time.monotonic())
+
+    def record_failure(self, host: str) -> None:
+        """A request to the host failed with a connection error"""
+
+        self.breaker(host).record_failure()
+
+    def release(self, host: str) -> None:
+        """A request admitted by is_available ended, with or without an
+            outcome; frees the host's half-open trial if it had none
+        """
+
+        self.breaker(host).release_trial()
+
+    def status(self) -> dict[str, dict[str, object]]:
+        """Snapshot of cached state for every known host"""
+
+        with self._lock:
+            hosts = dict(self._status)
+        return {
+                host: {'up': is_up, 'breaker': self.breaker(host).state}
+                for host, (is_up, _) in hosts.items()
+               }
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None or self.probe_interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='ollama-health',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.probe_interval):
+            with self._lock:
+                hosts = list(self._status)
+            for host in hosts:
+                try:
+                    self.probe(host)
+                except Exception as e:  # keep the probe thread alive
+                    logging.error('Health probe for %s failed: %s', host, e)
+
+    def stop(self) -> None:
+        """Stop the background probe thread"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.probe_timeout + 1)
+        self._thread = None
+        self._stop = threading.Event()
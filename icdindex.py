@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Offline ICD-10-CM code index
+    ©2024, Ovais Quraishi
+
+    Validity, billable flag and descriptions of ICD-10-CM codes without an
+    LLM round trip. The index is a gzipped TSV (code, billable, short and
+    long description) built once, e.g. at docker build time, by
+    tools/build_icd_index.py from the simple_icd_10_cm code set or a CMS
+    icd10cm_order file. Without a built index the icd10_cm package's code
+    list is used.
+"""
+
+import csv
+import gzip
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from config import get_config, get_config_with_defaults, ConfigError
+
+try:
+    CONFIG = get_config()
+except (FileNotFoundError, ConfigError):
+    CONFIG = get_config_with_defaults()
+
+ICD_INDEX_PATH = CONFIG.get('service', 'ICD_INDEX_PATH', fallback='icd10cm_index.tsv.gz')
+
+
+def normalize_code(code: str) -> str:
+    """Index key of an ICD-10 code, upper case without the dot"""
+
+    return code.strip().upper().replace('.', '')
+
+
+def add_dot(code: str) -> str:
+    """J45909 -> J45.909"""
+
+    return code[:3] + '.' + code[3:] if len(code) > 3 else code
+
+
+@dataclass(frozen=True)
+class ICDCode:
+    """One ICD-10-CM code"""
+    code: str
+    billable: bool
+    short_description: str
+    long_description: str
+
+
+class ICDIndex:
+    """ICD-10-CM codes by normalized code
+    """
+
+    def __init__(self, codes: Iterable[ICDCode], source: str = '') -> None:
+        self._codes = {normalize_code(code.code): code for code in codes}
+        self.source = source
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def __contains__(self, code: str) -> bool:
+        return normalize_code(code) in self._codes
+
+    def get(self, code: str) -> Optional[ICDCode]:
+        """The code's entry, None if it is not a valid ICD-10-CM code"""
+
+        return self._codes.get(normalize_code(code))
+
+    def is_billable(self, code: str) -> bool:
+        entry = self.get(code)
+        return entry is not None and entry.billable
+
+    def write(self, path: str) -> None:
+        """Save as a gzipped TSV, see load"""
+
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as afile:
+            writer = csv.writer(afile, delimiter='\t', lineterminator='\n')
+            for key in sorted(self._codes):
+                code = self._codes[key]
+                writer.writerow([key, int(code.billable), code.short_description, code.long_description])
+
+    @classmethod
+    def load(cls, path: str) -> 'ICDIndex':
+        """Index written by write"""
+
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as afile:
+            codes = [ICDCode(add_dot(row[0]), row[1] == '1', row[2], row[3])
+                     for row in csv.reader(afile, delimiter='\t')]
+        return cls(codes, path)
+
+    @classmethod
+    def from_icd10_cm(cls) -> 'ICDIndex':
+        """Index of the icd10_cm package's code list, which has one
+            description per code
+        """
+
+        import icd10
+
+        return cls((ICDCode(add_dot(code), billable, description, description)
+                    for code, (billable, description) in icd10.codes.items()), 'icd10_cm')
+
+
+_INDEX: Optional[ICDIndex] = None
+_INDEX_LOADED = False
+_INDEX_LOCK = threading.Lock()
+
+
+def get_icd_index() -> Optional[ICDIndex]:
+    """The process-wide index, loaded on first use; None if neither the
+        built index nor the icd10_cm package is available
+    """
+
+    global _INDEX, _INDEX_LOADED
+
+    if _INDEX_LOADED:
+        return _INDEX
+    with _INDEX_LOCK:
+        if not _INDEX_LOADED:
+            try:
+                _INDEX = ICDIndex.load(ICD_INDEX_PATH)
+            except FileNotFoundError:
+                try:
+                    _INDEX = ICDIndex.from_icd10_cm()
+                except ImportError:
+                    logging.warning('No ICD-10-CM index at %s and icd10_cm is not installed', ICD_INDEX_PATH)
+            if _INDEX is not None:
+                logging.info('Loaded %s ICD-10-CM codes from %s', len(_INDEX), _INDEX.source)
+            _INDEX_LOADED = True
+    return _INDEX
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Content-addressed cache for deterministic LLM responses
+    ©2024, Ovais Quraishi
+
+    Responses to temperature 0 prompts are cached under a key derived
+    from (model, model digest, prompt hash, options), so a model update
+    naturally invalidates old entries. An in-memory LRU tier sits in
+    front of an optional persistent tier (SQLite file or PostgreSQL
+    table); both honour a TTL and a maximum number of entries.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from database import execute_write_query
+
+
+def cache_key(model: str, digest: Optional[str], prompt: str, options: Optional[dict[str, Any]] = None) -> str:
+    """Cache key for a prompt sent to a specific model build
+    """
+
+    key_obj = {
+               'model': model,
+               'digest': digest or '',
+               'prompt_sha256': hashlib.sha256(prompt.encode()).hexdigest(),
+               'options': options or {}
+              }
+    return hashlib.sha256(json.dumps(key_obj, sort_keys=True).encode()).hexdigest()
+
+
+def is_deterministic(options: Optional[dict[str, Any]]) -> bool:
+    """Only temperature 0 responses are worth caching
+    """
+
+    return bool(options) and options.get('temperature') == 0
+
+
+class MemoryTier:
+    """In-process LRU tier with TTL
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteTier:
+    """Persistent tier in a local SQLite file
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: float = 0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS llm_response_cache (
+                                    cache_key TEXT PRIMARY KEY,
+                                    value TEXT NOT NULL,
+                                    created_at REAL NOT NULL,
+                                    accessed_at REAL NOT NULL)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS llm_response_cache_accessed_at
+                                    ON llm_response_cache (accessed_at)""")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created_at FROM llm_response_cache WHERE cache_key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            with self._conn:
+                if self.ttl and now - created_at > self.ttl:
+                    self._conn.execute('DELETE FROM llm_response_cache WHERE cache_key = ?', (key,))
+                    return None
+                self._conn.execute('UPDATE llm_response_cache SET accessed_at = ? WHERE cache_key = ?',
+                                   (now, key))
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("""INSERT INTO llm_response_cache (cache_key, value, created_at, accessed_at)
+                                  VALUES (?, ?, ?, ?)
+                                  ON CONFLICT (cache_key) DO UPDATE
+                                  SET value = excluded.value,
+                                      created_at = excluded.created_at,
+                                      accessed_at = excluded.accessed_at""",
+                               (key, value, now, now))
+            # size based eviction, least recently used first
+            self._conn.execute("""DELETE FROM llm_response_cache WHERE cache_key IN (
+                                    SELECT cache_key FROM llm_response_cache
+                                    ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                               (self.max_entries,))
+
+
+class PostgresTier:
+    """Persistent tier in the llm_response_cache table, see zollama.sql
+    """
+
+    name = 'postgres'
+
+    # trimming the table on every write would be wasteful
+    EVICT_EVERY = 500
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[str]:
+        ttl_clause = "AND created_at > now() - make_interval(secs => %s)" if self.ttl else ""
+        params = (key, self.ttl) if self.ttl else (key,)
+        rows = execute_write_query(f"""UPDATE llm_response_cache
+                                       SET accessed_at = now()
+                                       WHERE cache_key = %s {ttl_clause}
+                                       RETURNING value;""", params)
+        return rows[0][0] if rows else None
+
+    def set(self, key: str, value: str) -> None:
+        execute_write_query("""INSERT INTO llm_response_cache (cache_key, value, created_at, accessed_at)
+                               VALUES (%s, %s, now(), now())
+                               ON CONFLICT (cache_key) DO UPDATE
+                               SET value = EXCLUDED.value,
+                                   created_at = EXCLUDED.created_at,
+                                   accessed_at = EXCLUDED.accessed_at;""", (key, value), fetch=False)
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """Drop expired rows and trim the table to max_entries"""
+
+        if self.ttl:
+            execute_write_query("""DELETE FROM llm_response_cache
+                                   WHERE created_at < now() - make_interval(secs => %s);""",
+                                (self.ttl,), fetch=False)
+        execute_write_query("""DELETE FROM llm_response_cache WHERE cache_key IN (
+                                 SELECT cache_key FROM llm_response_cache
+                                 ORDER BY accessed_at DESC OFFSET %s);""",
+                            (self.max_entries,), fetch=False)
+
+
+class ResponseCache:
+    """Tiered response cache with hit/miss counters
+
+        Values written to persistent tiers go through encode/decode, so
+        patient derived text can be stored encrypted at rest.
+    """
+
+    def __init__(self,
+                 tiers: list,
+                 encode: Optional[Callable[[str], str]] = None,
+                 decode: Optional[Callable[[str], str]] = None
+                ) -> None:
+        self.tiers = tiers
+        self._encode = encode
+        self._decode = decode
+        self._lock = threading.Lock()
+        self.hits = {tier.name: 0 for tier in tiers}
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def _persistent(tier) -> bool:
+        return not isinstance(tier, MemoryTier)
+
+    @property
+    def has_persistent_tier(self) -> bool:
+        """True if lookups may do disk or network I/O"""
+
+        return any(self._persistent(tier) for tier in self.tiers)
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached value for key, promoting it into faster tiers on a hit
+        """
+
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(key)
+                if value is not None and self._decode and self._persistent(tier):
+                    value = self._decode(value)
+            except Exception as e:
+                # a broken cache tier must never fail the LLM call
+                logging.error('LLM cache %s tier read failed: %s', tier.name, e)
+                with self._lock:
+                    self.errors += 1
+                continue
+            if value is not None:
+                with self._lock:
+                    self.hits[tier.name] += 1
+                for faster_tier in self.tiers[:i]:
+                    self._set_tier(faster_tier, key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        """Store value in every tier"""
+
+        for tier in self.tiers:
+            self._set_tier(tier, key, value)
+
+    def _set_tier(self, tier, key: str, value: str) -> None:
+        try:
+            if self._encode and self._persistent(tier):
+                tier.set(key, self._encode(value))
+            else:
+                tier.set(key, value)
+        except Exception as e:
+            logging.error('LLM cache %s tier write failed: %s', tier.name, e)
+            with self._lock:
+                self.errors += 1
+
+    def stats(self) -> dict[str, Any]:
+        """Hit/miss counters"""
+
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {
+                    'hits': dict(self.hits),
+                    'misses': self.misses,
+                    'errors': self.errors,
+                    'hit_ratio': hits / lookups if lookups else 0.0
+                   }
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Tolerant JSON parsing of LLM output
+    ©2024, Ovais Quraishi
+
+    Models asked for JSON wrap it in prose, answer with the Python dict
+    literals our prompt templates show them, or leave a trailing comma.
+    loads() takes the first balanced JSON object or array of a completion,
+    parses it as is and, failing that, after repairing those defects:
+        single quoted strings       'a'     -> "a"
+        Python constants            True    -> true, None -> null
+        trailing commas             [1, 2,] -> [1, 2]
+        raw newlines/tabs in strings
+    Parsing uses orjson when it is installed and json otherwise. Failures
+    raise LLMJSONError, which tells where and why parsing failed.
+
+    tools/bench_llmjson.py compares this with the former ast.literal_eval
+    path on recorded responses.
+"""
+
+import json
+import re
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+OPENERS = {'{': '}', '[': ']'}
+PYTHON_CONSTANTS = {'True': 'true', 'False': 'false', 'None': 'null'}
+STRING_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+EXCERPT_LENGTH = 80
+
+# characters that matter when looking for the end of a JSON value
+STRUCTURE = re.compile(r'[{}\[\]"\'\\]')
+# what repair rewrites: strings, Python constants and trailing commas
+REPAIRABLE = re.compile(r'''
+    "(?:[^"\\]|\\.)*"
+  | '(?:[^'\\]|\\.)*'
+  | \b(?:True|False|None)\b
+  | ,(?=\s*[}\]])
+    ''', re.VERBOSE | re.DOTALL)
+CONTROL_CHARACTERS = re.compile(r'[\n\r\t]')
+# escapes and double quotes of a single quoted string's body
+SINGLE_QUOTED = re.compile(r'\\(.)|"', re.DOTALL)
+
+
+class LLMJSONError(ValueError):
+    """A completion holds no parsable JSON
+
+        reason      no_json, unbalanced, invalid or unexpected_type
+        position    offset in the completion where parsing failed
+        excerpt     completion text around position
+    """
+
+    def __init__(self, reason: str, message: str, text: str = '', position: Optional[int] = None) -> None:
+        super().__init__(f'{reason}: {message}')
+        self.reason = reason
+        self.message = message
+        self.position = position
+        start = max(0, (position or 0) - EXCERPT_LENGTH // 2)
+        self.excerpt = text[start:start + EXCERPT_LENGTH]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {'reason': self.reason, 'message': self.message,
+                'position': self.position, 'excerpt': self.excerpt}
+
+
+def _parse(fragment: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(fragment)
+    return json.loads(fragment)
+
+
+def extract_json(text: str) -> tuple[str, int]:
+    """First balanced JSON object or array in text and its offset, strings
+        in either quote style may hold brackets
+    """
+
+    start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+    if start < 0:
+        raise LLMJSONError('no_json', 'no JSON object or array found', text, 0)
+
+    closers = []
+    quote = None
+    escaped_at = -1
+    for match in STRUCTURE.finditer(text, start):
+        char = match.group()
+        i = match.start()
+        if quote:
+            if i == escaped_at:
+                continue
+            if char == '\\':
+                escaped_at = i + 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in OPENERS:
+            closers.append(OPENERS[char])
+        elif char in '}]':
+            if char != closers.pop():
+                raise LLMJSONError('unbalanced', f'unexpected {char!r}', text, i)
+            if not closers:
+                return text[start:i + 1], start
+    raise LLMJSONError('unbalanced', 'JSON is not closed, the completion may be truncated', text, start)
+
+
+def _double_quoted(match: re.Match) -> str:
+    # \' is not a JSON escape, a bare " ends a JSON string
+    if match.group(1) is None:
+        return '\\"'
+    return "'" if match.group(1) == "'" else match.group()
+
+
+def _repaired(match: re.Match) -> str:
+    token = match.group()
+    if token == ',':
+        return ''
+    if token in PYTHON_CONSTANTS:
+        return PYTHON_CONSTANTS[token]
+    body = token[1:-1]
+    if token[0] == "'":
+        body = SINGLE_QUOTED.sub(_double_quoted, body)
+    return '"' + CONTROL_CHARACTERS.sub(lambda m: STRING_ESCAPES[m.group()], body) + '"'
+
+
+def repair(fragment: str) -> str:
+    """fragment with single quoted strings, Python constants, trailing
+        commas and raw control characters in strings made valid JSON
+    """
+
+    return REPAIRABLE.sub(_repaired, fragment)
+
+
+def loads(text: str, expect: Optional[type] = None) -> Any:
+    """Value of the first JSON object or array in an LLM completion,
+        repaired if need be; expect checks the value's type
+    """
+
+    if not isinstance(text, str):
+        raise LLMJSONError('no_json', f'expected a completion string, got {type(text).__name__}')
+
+    fragment, offset = extract_json(text)
+    try:
+        value = _parse(fragment)
+    except ValueError:
+        try:
+            value = _parse(repair(fragment))
+        except ValueError as e:
+            position = getattr(e, 'pos', None)
+            raise LLMJSONError('invalid', str(e), text, offset + position if position is not None else offset) from e
+
+    if expect is not None and not isinstance(value, expect):
+        raise LLMJSONError('unexpected_type', f'expected {expect.__name__}, got {type(value).__name__}',
+                           text, offset)
+    return value
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Generation option profiles
+    ©2024, Ovais Quraishi
+
+    Every prompt type maps to a named profile of Ollama options: how many
+    tokens a call may generate (num_predict), its context window (num_ctx),
+    stop sequences and how long the model stays loaded afterwards
+    (keep_alive). A code lookup needs ~100 tokens of JSON, bounding it keeps
+    a model that starts rambling from burning CPU time on prose.
+
+    The defaults below are overridden per profile in setup.config sections
+    named [profile:<name>], e.g.
+
+        [profile:code_lookup]
+        num_predict=256
+        stop=["\\n\\n\\n"]
+        keep_alive=30m
+"""
+
+import json
+from configparser import RawConfigParser
+from dataclasses import dataclass, replace
+from typing import Any, Optional
+
+SECTION_PREFIX = 'profile:'
+
+
+@dataclass(frozen=True)
+class OptionProfile:
+    """Ollama options of one kind of prompt, None leaves Ollama's default"""
+    name: str
+    num_predict: Optional[int] = None
+    num_ctx: Optional[int] = None
+    stop: tuple[str, ...] = ()
+    keep_alive: Optional[str] = None
+
+    def options(self) -> dict[str, Any]:
+        """Options to merge into a chat request"""
+
+        options: dict[str, Any] = {}
+        if self.num_predict is not None:
+            options['num_predict'] = self.num_predict
+        if self.num_ctx is not None:
+            options['num_ctx'] = self.num_ctx
+        if self.stop:
+            options['stop'] = list(self.stop)
+        return options
+
+
+# num_ctx is left to Ollama by default, a model loaded with one context
+#  size is reloaded when a request asks for another
+DEFAULT_PROFILES = {
+                    'summary': OptionProfile('summary', num_predict=1024),
+                    'diagnosis': OptionProfile('diagnosis', num_predict=768),
+                    'code_extraction': OptionProfile('code_extraction', num_predict=512),
+                    'code_lookup': OptionProfile('code_lookup', num_predict=384),
+                    'code_batch_lookup': OptionProfile('code_batch_lookup', num_predict=2048)
+                   }
+
+# prompt_type labels, see gptutils.prompt_chat, by profile
+PROMPT_TYPE_PROFILES = {
+                        'summary': 'summary',
+                        'diagnosis': 'diagnosis',
+                        'codes': 'code_extraction',
+                        'icd': 'code_extraction',
+                        'cpt': 'code_extraction',
+                        'hcpcs': 'code_extraction',
+                        'prescription': 'code_extraction',
+                        'prescription_cpt': 'code_extraction',
+                        'prescription_hcpcs': 'code_extraction',
+                        'icd_lookup': 'code_lookup',
+                        'icd_reimbursement': 'code_lookup',
+                        'cpt_lookup': 'code_lookup',
+                        'hcpcs_lookup': 'code_lookup',
+                        'cpt_batch_lookup': 'code_batch_lookup',
+                        'hcpcs_batch_lookup': 'code_batch_lookup'
+                       }
+
+
+def _profile_from_section(config: RawConfigParser, section: str, base: OptionProfile) -> OptionProfile:
+    """base with the values set in a [profile:<name>] section, empty values
+        reset to Ollama's default
+    """
+
+    changes: dict[str, Any] = {}
+    for field in ('num_predict', 'num_ctx'):
+        if config.has_option(section, field):
+            value = config.get(section, field).strip()
+            changes[field] = int(value) if value else None
+    if config.has_option(section, 'stop'):
+        value = config.get(section, 'stop').strip()
+        changes['stop'] = tuple(json.loads(value)) if value else ()
+    if config.has_option(section, 'keep_alive'):
+        changes['keep_alive'] = config.get(section, 'keep_alive').strip() or None
+    return replace(base, **changes)
+
+
+def load_profiles(config: RawConfigParser) -> dict[str, OptionProfile]:
+    """DEFAULT_PROFILES updated, or extended, by setup.config sections
+    """
+
+    profiles = dict(DEFAULT_PROFILES)
+    for section in config.sections():
+        if section.startswith(SECTION_PREFIX):
+            name = section[len(SECTION_PREFIX):]
+            profiles[name] = _profile_from_section(config, section, profiles.get(name, OptionProfile(name)))
+    return profiles
+
+
+def profile_for(profiles: dict[str, OptionProfile], prompt_type: str) -> Optional[OptionProfile]:
+    """Profile of a prompt type, a profile named like the prompt type
+        takes precedence; None for unprofiled prompts
+    """
+
+    return profiles.get(prompt_type) or profiles.get(PROMPT_TYPE_PROFILES.get(prompt_type, ''))
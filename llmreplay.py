@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Record and replay of LLM exchanges
+    ©2024, Ovais Quraishi
+
+    With LLM_RECORD_PATH set, every completed chat is appended to a JSONL
+    file; with LLM_REPLAY_PATH set, chats found in such a file are served
+    from it instead of Ollama. tools/ollama_stub.py serves the same files,
+    so a pipeline run recorded against a real Ollama can be repeated on a
+    laptop without one.
+
+    Prompts are not written, exchanges are looked up by a hash of model,
+    messages, options and format. Responses are encrypted when patient
+    data encryption is enabled.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+
+def exchange_key(model: str,
+                 messages: list[dict[str, str]],
+                 options: Optional[dict[str, Any]] = None,
+                 format: Optional[Any] = None
+                ) -> str:
+    """Lookup key of a chat request
+    """
+
+    key_obj = {
+               'model': model,
+               'messages': [{'role': m['role'], 'content': m['content']} for m in messages],
+               'options': options or {},
+               'format': format
+              }
+    return hashlib.sha256(json.dumps(key_obj, sort_keys=True).encode()).hexdigest()
+
+
+class Recorder:
+    """Appends exchanges to a JSONL file
+    """
+
+    def __init__(self, path: str, encode: Optional[Callable[[str], str]] = None) -> None:
+        self.path = path
+        self._encode = encode
+        self._lock = threading.Lock()
+
+    def record(self,
+               key: str,
+               model: str,
+               response: str,
+               prompt_type: str = 'chat',
+               metrics: Optional[dict[str, Optional[int]]] = None
+              ) -> None:
+        line = {
+                'key': key,
+                'model': model,
+                'prompt_type': prompt_type,
+                'encrypted': self._encode is not None,
+                'response': self._encode(response) if self._encode else response,
+                'metrics': metrics or {},
+                'recorded_at': time.time()
+               }
+        try:
+            with self._lock, open(self.path, 'a', encoding='utf-8') as afile:
+                afile.write(json.dumps(line) + '\n')
+        except OSError as e:
+            # recording is a side channel, never fail the call
+            logging.error('Unable to record LLM exchange to %s: %s', self.path, e)
+
+
+class Replayer:
+    """Serves exchanges from JSONL files written by Recorder, the last
+        recording of a key wins
+    """
+
+    def __init__(self, path: str, decode: Optional[Callable[[str], str]] = None) -> None:
+        self.path = path
+        self._decode = decode
+        self._exchanges: dict[str, dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self) -> None:
+        """(Re)read the recording file"""
+
+        exchanges = {}
+        try:
+            with open(self.path, encoding='utf-8') as afile:
+                for line in afile:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        exchanges[exchange['key']] = exchange
+        except FileNotFoundError:
+            logging.warning('No LLM recordings at %s', self.path)
+        self._exchanges = exchanges
+
+    def __len__(self) -> int:
+        return len(self._exchanges)
+
+    def get(self, key: str) -> Optional[tuple[str, dict[str, Optional[int]]]]:
+        """Recorded (response, metrics) for key, None if not recorded"""
+
+        exchange = self._exchanges.get(key)
+        if exchange is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        response = exchange['response']
+        if exchange.get('encrypted'):
+            if self._decode is None:
+                raise ValueError(f'Recording {key} is encrypted and no decoder was given')
+            response = self._decode(response)
+        return response, exchange.get('metrics') or {}
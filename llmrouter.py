@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Request routing across several Ollama hosts
+    ©2024, Ovais Quraishi
+
+    OLLAMA_API_URL may list several hosts. Requests go to the healthy
+    host with the fewest outstanding requests among those that have the
+    model pulled. Requests carrying a route key (e.g. a patient note id)
+    stick to one host, chosen by rendezvous hashing, so that host's
+    loaded model and prompt cache stay warm.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+from healthmonitor import HealthMonitor, OPEN
+
+
+def parse_hosts(value: str) -> list[str]:
+    """Comma separated OLLAMA_API_URL into a list of hosts
+    """
+
+    return [host.strip() for host in value.split(',') if host.strip()]
+
+
+class OllamaRouter:
+    """Least-outstanding-requests router with health and model awareness
+    """
+
+    def __init__(self,
+                 hosts: list[str],
+                 health_monitor: HealthMonitor,
+                 list_models: Optional[Callable[[str], set[str]]] = None,
+                 models_ttl: float = 300.0
+                ) -> None:
+        self.hosts = list(hosts)
+        self.health_monitor = health_monitor
+        self.models_ttl = models_ttl
+        self._list_models = list_models
+        self._models: dict[str, tuple[set[str], float]] = {}
+        self._outstanding = {host: 0 for host in self.hosts}
+        self._lock = threading.Lock()
+        # model lists are refreshed from the health probe thread, never
+        #  on the request path
+        if list_models is not None:
+            health_monitor.add_listener(self._on_probe)
+
+    def _on_probe(self, host: str, is_up: bool) -> None:
+        if not is_up or host not in self._outstanding:
+            return
+        _, fetched_at = self._models.get(host, (set(), 0.0))
+        if time.monotonic() - fetched_at < self.models_ttl:
+            return
+        try:
+            self.set_models(host, self._list_models(host))
+        except Exception as e:
+            logging.warning('Unable to list models on %s: %s', host, e)
+
+    def set_models(self, host: str, models: Iterable[str]) -> None:
+        """Record the models a host has pulled"""
+
+        with self._lock:
+            self._models[host] = (set(models), time.monotonic())
+
+    def has_model(self, host: str, model: str) -> Optional[bool]:
+        """Whether host has model pulled, None if not known yet"""
+
+        with self._lock:
+            models = self._models.get(host)
+        if models is None:
+            return None
+        return model in models[0]
+
+    def _healthy(self, host: str) -> bool:
+        return self.health_monitor.is_up(host) and self.health_monitor.breaker(host).state != OPEN
+
+    def candidates(self, model: str, exclude: Iterable[str] = ()) -> list[str]:
+        """Healthy hosts for a model, preferring hosts known to have it
+        """
+
+        excluded = set(exclude)
+        healthy = [host for host in self.hosts if host not in excluded and self._healthy(host)]
+        with_model = [host for host in healthy if self.has_model(host, model) is not False]
+        # nobody is known to have the model, let a host pull it or fail
+        return with_model or healthy
+
+    def pick(self, model: str, route_key: Optional[str] = None, exclude: Iterable[str] = ()) -> Optional[str]:
+        """Host for the next request, None if no host is usable
+        """
+
+        hosts = self.candidates(model, exclude)
+        if not hosts:
+            return None
+        if len(hosts) == 1:
+            return hosts[0]
+        if route_key is not None:
+            # rendezvous hashing keeps a key on the same host while the
+            #  host set is stable and moves only that host's keys if not
+            return max(hosts, key=lambda host: hashlib.sha1(f'{route_key}|{host}'.encode()).digest())
+        with self._lock:
+            return min(hosts, key=lambda host: self._outstanding[host])
+
+    @contextmanager
+    def track(self, host: str) -> Iterator[str]:
+        """Count a request as outstanding on host while it runs"""
+
+        with self._lock:
+            self._outstanding[host] = self._outstanding.get(host, 0) + 1
+        try:
+            yield host
+        finally:
+            with self._lock:
+                self._outstanding[host] -= 1
+
+    def status(self) -> dict[str, dict[str, object]]:
+        """Outstanding requests and known models per host"""
+
+        with self._lock:
+            return {
+                    host: {
+                           'outstanding': self._outstanding[host],
+                           'models': sorted(self._models.get(host, (set(), 0.0))[0])
+                          }
+                    for host in self.hosts
+                   }
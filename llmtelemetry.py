@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Per-call LLM telemetry
+    ©2024, Ovais Quraishi
+
+    Ollama reports how long a request spent loading the model, evaluating
+    the prompt and generating tokens. Telemetry keeps that, together with
+    model, prompt type, cache hit status and wall time, as counters and
+    histograms per (model, prompt type), and optionally appends every call
+    to the llm_calls ledger table, see zollama.sql.
+"""
+
+import bisect
+import logging
+import os
+import queue
+import threading
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+from database import execute_write_query
+
+# Ollama response fields, durations are in nanoseconds
+METRIC_FIELDS = ('total_duration',
+                 'load_duration',
+                 'prompt_eval_count',
+                 'prompt_eval_duration',
+                 'eval_count',
+                 'eval_duration')
+
+# histogram bucket upper bounds, in seconds
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+NS_PER_SECOND = 1e9
+
+
+def response_metrics(response) -> dict[str, Optional[int]]:
+    """Timing and token counts of a (final) Ollama chat response
+    """
+
+    return {name: response.get(name) for name in METRIC_FIELDS}
+
+
+@dataclass
+class CallRecord:
+    """One LLM call as seen by the caller"""
+    model: str
+    prompt_type: str
+    wall_time: float
+    host: Optional[str] = None
+    cache_hit: bool = False
+    complete: bool = True
+    error: Optional[str] = None
+    coalesced: bool = False
+    metrics: dict[str, Optional[int]] = field(default_factory=dict)
+    timestamp: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    def seconds(self, name: str) -> Optional[float]:
+        """An Ollama duration in seconds, None if not reported"""
+
+        value = self.metrics.get(name)
+        return value / NS_PER_SECOND if value is not None else None
+
+
+class Histogram:
+    """Fixed bucket histogram with sum and count
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, None if
+            nothing was observed
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+                'sum': self.sum,
+                'count': self.count,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95)
+               }
+
+
+class _Series:
+    """Counters and histograms of one (model, prompt type)"""
+
+    HISTOGRAMS = ('wall_time', 'load_duration', 'prompt_eval_duration', 'eval_duration')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.incomplete = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+
+    def add(self, record: CallRecord) -> None:
+        self.calls += 1
+        self.cache_hits += record.cache_hit
+        self.coalesced += record.coalesced
+        self.errors += record.error is not None
+        self.incomplete += not record.complete
+        self.prompt_tokens += record.metrics.get('prompt_eval_count') or 0
+        self.eval_tokens += record.metrics.get('eval_count') or 0
+        if record.cache_hit or record.coalesced or record.error is not None:
+            # wall time of hits, shared calls and failures would skew the
+            #  latency view
+            return
+        self.histograms['wall_time'].observe(record.wall_time)
+        for name in self.HISTOGRAMS[1:]:
+            seconds = record.seconds(name)
+            if seconds is not None:
+                self.histograms[name].observe(seconds)
+
+    def snapshot(self) -> dict[str, Any]:
+        eval_seconds = self.histograms['eval_duration'].sum
+        return {
+                'calls': self.calls,
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'incomplete': self.incomplete,
+                'prompt_tokens': self.prompt_tokens,
+                'eval_tokens': self.eval_tokens,
+                'eval_tokens_per_second': self.eval_tokens / eval_seconds if eval_seconds else None,
+                **{name: histogram.snapshot() for name, histogram in self.histograms.items()}
+               }
+
+
+class LedgerWriter:
+    """Appends call records to the llm_calls table from a background
+        thread, so the request path never waits on the database
+
+        The thread is started on first use in each process; a forked
+        worker process does not inherit its parent's thread.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, max_queue: int = 10000) -> None:
+        self._max_queue = max_queue
+        self._queue: Optional['queue.Queue[CallRecord]'] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self) -> None:
+        # a lock held by a parent thread at fork time is never released
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def _records(self) -> 'queue.Queue[CallRecord]':
+        """This process's queue, its writer thread started on first use"""
+
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self._max_queue)
+                    threading.Thread(target=self._run, args=(self._queue,), name='llm-ledger', daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def __call__(self, record: CallRecord) -> None:
+        try:
+            self._records().put_nowait(record)
+        except queue.Full:
+            logging.warning('LLM call ledger queue full, dropping record')
+
+    def _run(self, records: 'queue.Queue[CallRecord]') -> None:
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.BATCH_SIZE and not records.empty():
+                batch.append(records.get_nowait())
+            try:
+                self.write(batch)
+            except Exception as e:  # keep the writer thread alive
+                logging.error('Unable to write %s LLM call records: %s', len(batch), e)
+
+    @staticmethod
+    def write(batch: list[CallRecord]) -> None:
+        columns = ('timestamp', 'model', 'host', 'prompt_type', 'cache_hit', 'complete', 'error',
+                   'wall_time') + METRIC_FIELDS
+        rows = []
+        for record in batch:
+            row = asdict(record)
+            row.update(record.metrics)
+            rows.append([row.get(column) for column in columns])
+        placeholders = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(rows))
+        execute_write_query(f"""INSERT INTO llm_calls ({', '.join(f'"{c}"' for c in columns)})
+                                VALUES {placeholders};""",
+                            [value for row in rows for value in row], fetch=False)
+
+
+class Telemetry:
+    """Counters and histograms of LLM calls, per (model, prompt type)
+    """
+
+    def __init__(self, ledger: Optional[Callable[[CallRecord], None]] = None) -> None:
+        self._ledger = ledger
+        self._series: dict[tuple[str, str], _Series] = {}
+        self._lock = threading.Lock()
+
+    def record(self, record: CallRecord) -> None:
+        """Account for one call"""
+
+        with self._lock:
+            series = self._series.get((record.model, record.prompt_type))
+            if series is None:
+                series = _Series()
+                self._series[(record.model, record.prompt_type)] = series
+            series.add(record)
+        if self._ledger is not None:
+            self._ledger(record)
+
+    def quantile(self, model: str, prompt_type: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """Wall time q-quantile of (model, prompt type), None if fewer than
+            min_samples calls were observed
+        """
+
+        with self._lock:
+            series = self._series.get((model, prompt_type))
+            if series is None or series.histograms['wall_time'].count < min_samples:
+                return None
+            return series.histograms['wall_time'].quantile(q)
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """Counters and histograms keyed by model, then prompt type"""
+
+        with self._lock:
+            snapshot: dict[str, dict[str, Any]] = {}
+            for (model, prompt_type), series in sorted(self._series.items()):
+                snapshot.setdefault(model, {})[prompt_type] = series.snapshot()
+            return snapshot
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Retry policy with exponential backoff, jitter, a retry budget and
+    per-call deadlines
+    ©2024, Ovais Quraishi
+
+    A retry only happens while the call's deadline leaves room for it and
+    the shared retry budget allows it. The budget earns a fraction of a
+    token per call and spends one per retry, so when a host is down,
+    retries stay a bounded share of the traffic instead of multiplying it.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, Type
+
+
+class DeadlineExceeded(TimeoutError):
+    """The call's deadline passed before it could complete"""
+
+
+class RetryBudget:
+    """Token bucket limiting retries to a share of calls
+    """
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 10.0) -> None:
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """A call was made"""
+
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """True if a retry may be made"""
+
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts, a
+        deadline and a retry budget
+    """
+
+    def __init__(self,
+                 max_attempts: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 10.0,
+                 multiplier: float = 2.0,
+                 deadline: Optional[float] = None,
+                 budget: Optional[RetryBudget] = None,
+                 retry_on: tuple[Type[BaseException], ...] = (Exception,),
+                 is_retryable: Optional[Callable[[BaseException], bool]] = None
+                ) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.budget = budget
+        self.retry_on = retry_on
+        self._is_retryable = is_retryable
+
+    def backoff(self, attempt: int) -> float:
+        """Sleep before retry number attempt (1-based), full jitter"""
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1)))
+
+    def deadline_at(self, deadline: Optional[float] = None) -> Optional[float]:
+        """Monotonic time by which a call started now must finish"""
+
+        seconds = deadline if deadline is not None else self.deadline
+        return time.monotonic() + seconds if seconds is not None else None
+
+    @staticmethod
+    def remaining(deadline_at: Optional[float]) -> Optional[float]:
+        """Seconds left until deadline_at, None without a deadline"""
+
+        return None if deadline_at is None else deadline_at - time.monotonic()
+
+    @classmethod
+    def _deadline_passed(cls, deadline_at: Optional[float]) -> bool:
+        remaining = cls.remaining(deadline_at)
+        return remaining is not None and remaining <= 0
+
+    def retryable(self, error: BaseException) -> bool:
+        if not isinstance(error, self.retry_on):
+            return False
+        return self._is_retryable(error) if self._is_retryable else True
+
+    def _next_delay(self,
+                    attempt: int,
+                    error: BaseException,
+                    deadline_at: Optional[float],
+                    max_attempts: Optional[int] = None
+                   ) -> Optional[float]:
+        """Backoff before the next attempt, None if the call must give up"""
+
+        if attempt >= (max_attempts or self.max_attempts) or not self.retryable(error):
+            return None
+        delay = self.backoff(attempt)
+        remaining = self.remaining(deadline_at)
+        if remaining is not None and remaining <= delay:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            logging.warning('Retry budget exhausted, not retrying %r', error)
+            return None
+        logging.info('Attempt %s failed with %r, retrying in %.2fs', attempt, error, delay)
+        return delay
+
+    def call(self,
+             fn: Callable[[int, Optional[float]], Any],
+             deadline: Optional[float] = None,
+             max_attempts: Optional[int] = None
+            ) -> Any:
+        """fn(attempt, remaining_seconds) with retries, re-raising the last
+            error when giving up. deadline and max_attempts override the
+            policy's for this call.
+        """
+
+        deadline_at = self.deadline_at(deadline)
+        if self.budget is not None:
+            self.budget.deposit()
+        attempt = 1
+        while True:
+            remaining = self.remaining(deadline_at)
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(f'Deadline exceeded after {attempt - 1} attempts')
+            try:
+                return fn(attempt, remaining)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, deadline_at, max_attempts)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self,
+                         fn: Callable[[int, Optional[float]], Awaitable[Any]],
+                         deadline: Optional[float] = None,
+                         max_attempts: Optional[int] = None
+                        ) -> Any:
+        """Async call, each attempt is cancelled when the deadline passes
+        """
+
+        deadline_at = self.deadline_at(deadline)
+        if self.budget is not None:
+            self.budget.deposit()
+        attempt = 1
+        while True:
+            remaining = self.remaining(deadline_at)
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(f'Deadline exceeded after {attempt - 1} attempts')
+            try:
+                return await asyncio.wait_for(fn(attempt, remaining), remaining)
+            except Exception as e:
+                # asyncio.TimeoutError is TimeoutError since 3.11, a socket
+                #   or nested timeout before the deadline is retried
+                if isinstance(e, asyncio.TimeoutError) and self._deadline_passed(deadline_at):
+                    raise DeadlineExceeded(f'Deadline exceeded on attempt {attempt}') from e
+                delay = self._next_delay(attempt, e, deadline_at, max_attempts)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -3,58 +3,166 @@
 import asyncio
 import json
 import logging
-from typing import Any
+from typing import Any, Optional
 
-from database import insert_data_into_table, get_select_query_result_dicts
+from pydantic import ValidationError
+
+from database import (
+    execute_write_queries,
+    get_select_query_result_dicts,
+    insert_data_into_table,
+    insert_query,
+)
 from encryption import decrypt_text
-from gptutils import prompt_chat
-from utils import ts_int_to_dt_obj, serialize_datetime
+from gptutils import Conversation, prompt_chat_async
+from utils import ts_int_to_dt_obj, serialize_datetime, list_into_chunks
 
 from app.core.config import settings
+from app.models.schemas import ClinicalCodes
 
 
 # Chunk size for batch processing
 NUM_ELEMENTS_CHUNK = 25
 
+# Model that condenses the OSCE conversation before diagnosis
+SUMMARY_LLM = "phi4"
 
-async def get_store_icd_cpt_codes(
-    patient_id: str,
-    patient_document_id: str,
+SUMMARY_PROMPT = "What disease does this patient have? P is patient, D is Doctor"
+DIAGNOSIS_PROMPT = "Diagnose this patient: "
+
+CODE_PROMPTS = {
+    "icd": "What are the ICD codes for this diagnosis? ",
+    "cpt": "What are the CPT codes for this diagnosis? ",
+    "hcpcs": "What are the HCPCS codes for this diagnosis? ",
+    "prescription": "What medication to prescribe for the diagnosis? ",
+    "prescription_cpt": "What are the CPT codes for these prescriptions? ",
+    "prescription_hcpcs": "What are the HCPCS codes for these prescriptions? ",
+}
+
+# Single structured-output prompt, see STRUCTURED_OUTPUT_LLMS
+STRUCTURED_CODE_PROMPT = (
+    "List the ICD-10, CPT and HCPCS codes for this diagnosis, the medications to "
+    "prescribe for it, and the CPT and HCPCS codes for those prescriptions. "
+    "Respond in JSON. Diagnosis: "
+)
+
+# Opening message of the shared-context code conversation
+CODE_CONTEXT_PROMPT = "Answer the following questions about this diagnosis: "
+
+
+def code_prompts(llm: str) -> dict[str, str]:
+    """Code extraction prompts for a model.
+
+    Args:
+        llm: LLM model name
+
+    Returns:
+        Prompt prefix per codes_document section
+    """
+    prompts = dict(CODE_PROMPTS)
+
+    # Adjust prompts if llm is 'meditron'
+    if llm == "meditron":
+        prompts["prescription_cpt"] = prompts["prescription"]
+
+    return prompts
+
+
+def get_visit_notes(visit_note_ids: list[str]) -> list[dict[str, Any]]:
+    """Fetch visit notes with their locality.
+
+    Args:
+        visit_note_ids: Patient note identifiers
+
+    Returns:
+        List of visit note rows
+    """
+    sql_query = """
+        SELECT
+            patient_id, patient_note_id, patient_note, patient_note ->> 'locality' as patient_locality
+        FROM
+            patient_notes
+        WHERE patient_note_id = ANY(%s);
+    """
+
+    return get_select_query_result_dicts(sql_query, (list(visit_note_ids),))
+
+
+async def summarize_visit_note(visit_note: dict[str, Any]) -> Optional[dict[str, Any]]:
+    """Condense the OSCE conversation of a visit note.
+
+    Args:
+        visit_note: Visit note row
+
+    Returns:
+        Encrypted summary envelope, False if the LLM call failed
+    """
+    # decrypt patient note content
+    content = decrypt_text(visit_note["patient_note"]["note"])
+
+    return await prompt_chat_async(
+        SUMMARY_LLM,
+        SUMMARY_PROMPT + content,
+        route_key=visit_note["patient_note_id"],
+        prompt_type="summary",
+    )
+
+
+async def diagnose(
+    llm: str,
+    summarized_obj: dict[str, Any],
+    route_key: Optional[str] = None,
+) -> Optional[dict[str, Any]]:
+    """Diagnosis and treatment plan for a summarized visit note.
+
+    Args:
+        llm: Medical LLM model name
+        summarized_obj: Summary envelope from summarize_visit_note
+        route_key: Keeps the note's prompts on one Ollama host
+
+    Returns:
+        Encrypted diagnosis envelope, False if the LLM call failed
+    """
+    recommended_diagnosis = decrypt_text(summarized_obj["analysis"])
+
+    return await prompt_chat_async(
+        llm,
+        DIAGNOSIS_PROMPT + recommended_diagnosis,
+        route_key=route_key,
+        prompt_type="diagnosis",
+    )
+
+
+async def fetch_code_sections(
     llm: str,
     analyzed_content: str,
-) -> None:
-    """Get ICD and CPT codes for the diagnosis and store them.
+    route_key: Optional[str] = None,
+) -> Optional[dict[str, dict[str, Any]]]:
+    """Ask the model for ICD/CPT/HCPCS codes and prescriptions.
 
     Args:
-        patient_id: Patient identifier
-        patient_document_id: Patient document identifier
         llm: LLM model name used for analysis
         analyzed_content: Decrypted analysis content
+        route_key: Keeps the note's prompts on one Ollama host
+
+    Returns:
+        Response envelope per section, None if any LLM call failed
     """
-    from clincodeutils import (
-        extract_icd10_codes,
-        extract_cpt_codes,
-        extract_hcpcs_codes,
-        icd_10_code_details_list,
-        lookup_cpt_gpt,
-        lookup_hcpcs_gpt,
-    )
+    if llm in settings.structured_output_llms:
+        sections = await _fetch_code_sections_structured(llm, analyzed_content, route_key)
+        if sections is not None:
+            return sections
+        logging.warning("Structured code extraction failed for %s, using free-text prompts", llm)
 
-    prompts = {
-        "icd": "What are the ICD codes for this diagnosis? ",
-        "cpt": "What are the CPT codes for this diagnosis? ",
-        "hcpcs": "What are the HCPCS codes for this diagnosis? ",
-        "prescription": "What medication to prescribe for the diagnosis? ",
-        "prescription_cpt": "What are the CPT codes for these prescriptions? ",
-        "prescription_hcpcs": "What are the HCPCS codes for these prescriptions? ",
-    }
+    prompts = code_prompts(llm)
 
-    # Adjust prompts if llm is 'meditron'
-    if llm == "meditron":
-        prompts["prescription_cpt"] = prompts["prescription"]
+    if settings.llm_shared_context:
+        return await _fetch_code_sections_shared(llm, analyzed_content, prompts, route_key)
 
     async def fetch_code(prompt_key: str, content: str) -> dict[str, Any]:
-        return await asyncio.to_thread(prompt_chat, llm, prompts[prompt_key] + content, False)
+        return await prompt_chat_async(
+            llm, prompts[prompt_key] + content, False, route_key=route_key, prompt_type=prompt_key
+        )
 
     # Gather all asynchronous tasks
     icd_obj, cpt_obj, hcpcs_obj, prescription_obj = await asyncio.gather(
@@ -64,6 +172,9 @@ async def get_store_icd_cpt_codes(
         fetch_code("prescription", analyzed_content),
     )
 
+    if not prescription_obj:
+        return None
+
     prescription_analysis = prescription_obj["analysis"]
 
     # Further gather tasks for prescriptions
@@ -72,168 +183,393 @@ async def get_store_icd_cpt_codes(
         fetch_code("prescription_hcpcs", prescription_analysis),
     )
 
-    icd_10_code_details = icd_10_code_details_list(extract_icd10_codes(icd_obj["analysis"]))
-    prescription_cpt_details = lookup_cpt_gpt(extract_cpt_codes(prescription_cpt_obj["analysis"]))
-    prescription_hcpcs_details = lookup_hcpcs_gpt(extract_hcpcs_codes(prescription_hcpcs_obj["analysis"]))
-
-    hcpcs_codes = extract_hcpcs_codes(hcpcs_obj["analysis"])
-
-    codes_document = {
-        "icd": {
-            "timestamp": serialize_datetime(icd_obj["timestamp"]),
-            "codes": extract_icd10_codes(icd_obj["analysis"]),
-            "details": icd_10_code_details,
-        },
-        "cpt": {
-            "timestamp": serialize_datetime(cpt_obj["timestamp"]),
-            "codes": extract_cpt_codes(cpt_obj["analysis"]),
-            "details": lookup_cpt_gpt(extract_cpt_codes(cpt_obj["analysis"])),
-        },
-        "hcpcs": {
-            "timestamp": serialize_datetime(hcpcs_obj["timestamp"]),
-            "codes": hcpcs_codes,
-            "details": lookup_hcpcs_gpt(hcpcs_codes),
-        },
-        "prescription": {
-            "timestamp": serialize_datetime(prescription_obj["timestamp"]),
-            "prescriptions": prescription_obj["analysis"],
-        },
-        "prescription_cpt": {
-            "timestamp": serialize_datetime(prescription_cpt_obj["timestamp"]),
-            "codes": extract_cpt_codes(prescription_cpt_obj["analysis"]),
-            "details": prescription_cpt_details,
-        },
-        "prescription_hcpcs": {
-            "timestamp": serialize_datetime(prescription_hcpcs_obj["timestamp"]),
-            "codes": extract_hcpcs_codes(prescription_hcpcs_obj["analysis"]),
-            "details": prescription_hcpcs_details,
-        },
+    sections = {
+        "icd": icd_obj,
+        "cpt": cpt_obj,
+        "hcpcs": hcpcs_obj,
+        "prescription": prescription_obj,
+        "prescription_cpt": prescription_cpt_obj,
+        "prescription_hcpcs": prescription_hcpcs_obj,
     }
 
-    codes_data = {
+    if not all(sections.values()):
+        return None
+    return sections
+
+
+async def _fetch_code_sections_structured(
+    llm: str,
+    analyzed_content: str,
+    route_key: Optional[str],
+) -> Optional[dict[str, dict[str, Any]]]:
+    """fetch_code_sections in one call constrained to the ClinicalCodes schema.
+
+    The validated lists are turned back into per-section envelopes, so
+    lookups and codes_document assembly work as for free-text answers.
+
+    Returns:
+        Response envelope per section, None if the call failed or the
+        response does not match the schema
+    """
+    codes_obj = await prompt_chat_async(
+        llm,
+        STRUCTURED_CODE_PROMPT + analyzed_content,
+        False,
+        route_key=route_key,
+        format=ClinicalCodes.model_json_schema(),
+        prompt_type="codes",
+    )
+    if not codes_obj:
+        return None
+
+    try:
+        codes = ClinicalCodes.model_validate_json(codes_obj["analysis"])
+    except ValidationError as e:
+        logging.warning("Invalid structured codes from %s: %s", llm, e.errors()[:3])
+        return None
+
+    def section(values: list[str], separator: str = ", ") -> dict[str, Any]:
+        return {
+            "timestamp": codes_obj["timestamp"],
+            "shasum_512": codes_obj["shasum_512"],
+            "analysis": separator.join(values),
+        }
+
+    return {
+        "icd": section(codes.icd),
+        "cpt": section(codes.cpt),
+        "hcpcs": section(codes.hcpcs),
+        "prescription": section(codes.prescriptions, "\n"),
+        "prescription_cpt": section(codes.prescription_cpt),
+        "prescription_hcpcs": section(codes.prescription_hcpcs),
+    }
+
+
+async def _fetch_code_sections_shared(
+    llm: str,
+    analyzed_content: str,
+    prompts: dict[str, str],
+    route_key: Optional[str],
+) -> Optional[dict[str, dict[str, Any]]]:
+    """fetch_code_sections as one conversation with the diagnosis as prefix.
+
+    Ollama evaluates the diagnosis once and reuses it from its prompt
+    cache, each code question only pays for its own tokens. The
+    prescription follow-ups continue from the prescription answer.
+    """
+    conversation = Conversation(llm, CODE_CONTEXT_PROMPT + analyzed_content, False, route_key)
+
+    sections = await conversation.ask_all_async(
+        {key: prompts[key].strip() for key in ("icd", "cpt", "hcpcs", "prescription")}
+    )
+    if not sections["prescription"]:
+        return None
+
+    history = ((prompts["prescription"].strip(), sections["prescription"]["analysis"]),)
+    sections.update(
+        await conversation.ask_all_async(
+            {key: prompts[key].strip() for key in ("prescription_cpt", "prescription_hcpcs")},
+            history,
+        )
+    )
+
+    if not all(sections.values()):
+        return None
+    return sections
+
+
+async def lookup_code_details(
+    sections: dict[str, dict[str, Any]],
+    section_codes: Optional[dict[str, list[str]]] = None,
+) -> dict[str, list]:
+    """Look up details of the codes found in each section, each distinct
+    code once even if several sections share it.
+
+    Args:
+        sections: Response envelope per section from fetch_code_sections
+        section_codes: Codes per section from extract_section_codes, extracted
+            from sections if not given
+
+    Returns:
+        Code details per section
+    """
+    from clincodeutils import CodeLookupPlan, extract_section_codes
+
+    if section_codes is None:
+        section_codes = extract_section_codes(sections)
+
+    plan = CodeLookupPlan()
+    plan.add(section_codes)
+    await plan.run()
+    return plan.section_details(section_codes)
+
+
+def build_codes_document(
+    sections: dict[str, dict[str, Any]],
+    details: dict[str, list],
+    section_codes: Optional[dict[str, list[str]]] = None,
+) -> dict[str, Any]:
+    """Assemble the codes_document stored in patient_codes.
+
+    Args:
+        sections: Response envelope per section from fetch_code_sections
+        details: Code details per section from lookup_code_details
+        section_codes: Codes per section from extract_section_codes, extracted
+            from sections if not given
+
+    Returns:
+        codes_document
+    """
+    from clincodeutils import extract_section_codes
+
+    if section_codes is None:
+        section_codes = extract_section_codes(sections)
+
+    codes_document = {}
+    for section, section_obj in sections.items():
+        codes_document[section] = {"timestamp": serialize_datetime(section_obj["timestamp"])}
+        if section == "prescription":
+            codes_document[section]["prescriptions"] = section_obj["analysis"]
+        else:
+            codes_document[section]["codes"] = section_codes[section]
+            codes_document[section]["details"] = details[section]
+
+    return codes_document
+
+
+# Skips the codes of a document whose codes were stored with it before,
+#   patient_codes has no UNIQUE key besides its id
+STORE_CODES_ONCE_QUERY = """
+    INSERT INTO patient_codes (timestamp, patient_id, patient_document_id, codes_document)
+    SELECT %s::timestamptz, %s, %s, %s::jsonb
+    WHERE NOT EXISTS (SELECT 1 FROM patient_codes WHERE patient_document_id = %s);
+"""
+
+
+def _codes_row(patient_id: str, patient_document_id: str, codes_document: dict[str, Any]) -> dict[str, Any]:
+    return {
         "timestamp": serialize_datetime(ts_int_to_dt_obj()),
         "patient_id": patient_id,
         "patient_document_id": patient_document_id,
         "codes_document": json.dumps(codes_document),
     }
 
-    insert_data_into_table("patient_codes", codes_data)
+
+def _analysis_document_row(
+    visit_note: dict[str, Any],
+    llm: str,
+    summarized_obj: dict[str, Any],
+    analyzed_obj: dict[str, Any],
+) -> dict[str, Any]:
+    if not settings.patient_data_encryption_enabled:
+        logging.error(
+            "URGENT: Patient Data Encryption disabled! "
+            "If spotted in Production logs, notify immediately!"
+        )
+
+    # construct patient data object for storage
+    patient_data_obj = {
+        "schema_version": "4",
+        "llm": llm,
+        "source": "healthcare",
+        "category": "patient",
+        "patient_id": visit_note["patient_id"],
+        "patient_note_id": visit_note["patient_note_id"],
+        "osce_note_summarized": summarized_obj["analysis"],
+        "analysis_document": analyzed_obj["analysis"],
+    }
+
+    return {
+        "timestamp": analyzed_obj["timestamp"],
+        "patient_document_id": analyzed_obj["shasum_512"],
+        "patient_locality": visit_note["patient_locality"],
+        "patient_id": visit_note["patient_id"],
+        "patient_note_id": visit_note["patient_note_id"],
+        "analysis_document": json.dumps(patient_data_obj),
+    }
 
 
-def analyze_visit_note(visit_note_id: str) -> bool:
-    """Analyze a specific visit note.
+def store_codes(patient_id: str, patient_document_id: str, codes_document: dict[str, Any]) -> None:
+    """Store a codes_document in patient_codes.
 
     Args:
-        visit_note_id: Patient note identifier
+        patient_id: Patient identifier
+        patient_document_id: Patient document identifier
+        codes_document: Document from build_codes_document
+    """
+    insert_data_into_table("patient_codes", _codes_row(patient_id, patient_document_id, codes_document))
+
+
+def store_analysis_document(
+    visit_note: dict[str, Any],
+    llm: str,
+    summarized_obj: dict[str, Any],
+    analyzed_obj: dict[str, Any],
+) -> None:
+    """Store a model's diagnosis of a visit note in patient_documents.
+
+    Args:
+        visit_note: Visit note row
+        llm: Medical LLM model name
+        summarized_obj: Summary envelope
+        analyzed_obj: Diagnosis envelope
+    """
+    insert_data_into_table(
+        "patient_documents", _analysis_document_row(visit_note, llm, summarized_obj, analyzed_obj)
+    )
+
+
+def store_analysis_with_codes(
+    visit_note: dict[str, Any],
+    llm: str,
+    summarized_obj: dict[str, Any],
+    analyzed_obj: dict[str, Any],
+    codes_document: dict[str, Any],
+) -> None:
+    """Store a model's diagnosis and its codes_document in one transaction,
+    so a failed write leaves neither row and a retry stores each once.
+
+    Args:
+        visit_note: Visit note row
+        llm: Medical LLM model name
+        summarized_obj: Summary envelope
+        analyzed_obj: Diagnosis envelope
+        codes_document: Document from build_codes_document
+    """
+    patient_document_id = analyzed_obj["shasum_512"]
+    codes_row = _codes_row(visit_note["patient_id"], patient_document_id, codes_document)
+    execute_write_queries([
+        insert_query("patient_documents",
+                     _analysis_document_row(visit_note, llm, summarized_obj, analyzed_obj)),
+        (STORE_CODES_ONCE_QUERY, [*codes_row.values(), patient_document_id]),
+    ])
+
+
+async def get_store_icd_cpt_codes(
+    patient_id: str,
+    patient_document_id: str,
+    llm: str,
+    analyzed_content: str,
+    route_key: Optional[str] = None,
+) -> bool:
+    """Get ICD and CPT codes for the diagnosis and store them.
+
+    Args:
+        patient_id: Patient identifier
+        patient_document_id: Patient document identifier
+        llm: LLM model name used for analysis
+        analyzed_content: Decrypted analysis content
+        route_key: Keeps the note's prompts on one Ollama host
 
     Returns:
-        True if analysis was successful, False otherwise
+        True if the codes were stored, False if an LLM call failed
     """
-    encrypt_analysis = settings.patient_data_encryption_enabled
+    sections = await fetch_code_sections(llm, analyzed_content, route_key)
+    if sections is None:
+        return False
 
-    sql_query = """
-        SELECT
-            patient_id, patient_note_id, patient_note, patient_note ->> 'locality' as patient_locality
-        FROM
-            patient_notes
-        WHERE patient_note_id = %s;
+    from clincodeutils import extract_section_codes
+
+    section_codes = extract_section_codes(sections)
+    details = await lookup_code_details(sections, section_codes)
+    codes_document = build_codes_document(sections, details, section_codes)
+    await asyncio.to_thread(store_codes, patient_id, patient_document_id, codes_document)
+    return True
+
+
+async def analyze_visit_note(visit_note_id: str) -> bool:
+    """Analyze a specific visit note with every medical model.
+
+    The analysis runs as a DAG of stages, see services.pipeline; the
+    medical models run concurrently, each within MEDLLM_TIMEOUT.
+
+    Args:
+        visit_note_id: Patient note identifier
+
+    Returns:
+        True if the analyses of all models were stored, False otherwise
     """
+    from services.pipeline import analyze_note_pipeline
+
+    visit_notes = await asyncio.to_thread(get_visit_notes, [visit_note_id])
+    if not visit_notes:
+        return False
+
+    visit_note = visit_notes[0]
+    logging.info(visit_note["patient_note_id"][0:10])
+    medllms = settings.medllms
+    timeouts = {llm: settings.medllm_timeout(llm) for llm in medllms}
+    return await analyze_note_pipeline(visit_note, medllms, settings.pipeline_stage_limits, timeouts)
+
+
+# notes some of the medical models (the parameter) have not stored an
+#  analysis of yet, or with checkpoints of an unfinished analysis, see
+#  services.checkpoints
+PENDING_NOTES_QUERY = """
+    SELECT n.patient_note_id
+    FROM patient_notes n
+    WHERE EXISTS (
+            SELECT 1
+            FROM unnest(%s::text[]) AS m(llm)
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM patient_documents d
+                WHERE d.patient_note_id = n.patient_note_id
+                  AND d.analysis_document->>'llm' = m.llm
+            )
+        )
+        OR EXISTS (
+            SELECT 1 FROM analysis_checkpoints c WHERE c.patient_note_id = n.patient_note_id
+        )
+"""
+
+
+def get_pending_visit_note_ids(medllms: Optional[list[str]] = None) -> list[str]:
+    """Visit notes not analyzed by every medical model yet.
+
+    A note where one model failed or timed out while the others stored
+    their analyses stays pending, so the missing model is resumed from
+    the note's checkpoints.
 
-    visit_notes = get_select_query_result_dicts(sql_query, (visit_note_id,))
-
-    for visit_note in visit_notes:
-        logging.info(visit_note["patient_note_id"][0:10])
-        patient_id = visit_note["patient_id"]
-        patient_note_id = visit_note["patient_note_id"]
-
-        # decrypt patient note content
-        content = decrypt_text(visit_note["patient_note"]["note"])
-
-        prompt = "What disease does this patient have? P is patient, D is Doctor"
-        summarized_obj = prompt_chat("phi4", prompt + content)
-
-        if summarized_obj:
-            recommended_diagnosis = decrypt_text(summarized_obj["analysis"])
-
-            # process diagnosis for ICD/CPT codes
-            for llm in settings.medllms:
-                analyzed_obj = prompt_chat(
-                    llm,
-                    "Diagnose this patient: " + recommended_diagnosis,
-                )
-
-                if not analyzed_obj:
-                    return False
-
-                # decrypt analysis result for ICD/CPT processing only
-                decrypted_analysis = decrypt_text(analyzed_obj["analysis"])
-                asyncio.run(
-                    get_store_icd_cpt_codes(
-                        patient_id,
-                        analyzed_obj["shasum_512"],
-                        llm,
-                        decrypted_analysis,
-                    )
-                )
-
-                if not encrypt_analysis:
-                    logging.error(
-                        "URGENT: Patient Data Encryption disabled! "
-                        "If spotted in Production logs, notify immediately!"
-                    )
-
-                # construct patient data object for storage
-                patient_data_obj = {
-                    "schema_version": "4",
-                    "llm": llm,
-                    "source": "healthcare",
-                    "category": "patient",
-                    "patient_id": patient_id,
-                    "patient_note_id": patient_note_id,
-                    "osce_note_summarized": summarized_obj["analysis"],
-                    "analysis_document": analyzed_obj["analysis"],
-                }
-
-                patient_analysis_data = {
-                    "timestamp": analyzed_obj["timestamp"],
-                    "patient_document_id": analyzed_obj["shasum_512"],
-                    "patient_locality": visit_note["patient_locality"],
-                    "patient_id": patient_id,
-                    "patient_note_id": patient_note_id,
-                    "analysis_document": json.dumps(patient_data_obj),
-                }
-
-                insert_data_into_table("patient_documents", patient_analysis_data)
-                return True
-        else:
-            return False
+    Args:
+        medllms: Medical LLM model names, settings.medllms by default
 
-    return False
+    Returns:
+        List of patient note identifiers
+    """
+    rows = get_select_query_result_dicts(PENDING_NOTES_QUERY + ";", (medllms or settings.medllms,))
+    return [row["patient_note_id"] for row in rows]
 
 
-def analyze_visit_notes() -> bool:
+async def analyze_visit_notes() -> bool:
     """Analyze all visit notes in the database.
 
+    Notes are processed in chunks of NUM_ELEMENTS_CHUNK, each chunk in
+    model-homogeneous waves, see services.scheduler. With
+    ANALYSIS_QUEUE_ENABLED the notes are enqueued for analysis_worker.py
+    processes instead, see services.jobqueue.
+
     Returns:
-        True if all analyses were successful, False otherwise
-    """
-    sql_query = """
-        SELECT patient_note_id
-        FROM patient_notes
-        WHERE patient_note_id NOT IN (
-            SELECT patient_note_id FROM patient_documents
-        );
+        True if all analyses were successful, or the notes were enqueued,
+        False otherwise
     """
+    if settings.analysis_queue_enabled:
+        from services.jobqueue import enqueue_pending_notes
 
-    all_visit_notes = get_select_query_result_dicts(sql_query)
-    for a_visit_note_id in all_visit_notes:
-        result = analyze_visit_note(a_visit_note_id["patient_note_id"])
-        if not result:
-            return False
-    return True
+        logging.info("Enqueued %s visit notes for analysis", await asyncio.to_thread(enqueue_pending_notes))
+        return True
+
+    from services.scheduler import analyze_in_waves
+
+    all_succeeded = True
+    pending = await asyncio.to_thread(get_pending_visit_note_ids)
+    for chunk in list_into_chunks(pending, NUM_ELEMENTS_CHUNK):
+        if not await analyze_in_waves(chunk, settings.medllms):
+            all_succeeded = False
+    return all_succeeded
 
 
-def get_patient_record(patient_id: str) -> list[dict[str, Any]]:
+async def get_patient_record(patient_id: str) -> list[dict[str, Any]]:
     """Get all notes, documents, and billing information for a patient.
 
     Args:
@@ -263,5 +599,5 @@ def get_patient_record(patient_id: str) -> list[dict[str, Any]]:
             AND pn.patient_id = %s;
     """
 
-    patient_record = get_select_query_result_dicts(sql_query, (patient_id,))
+    patient_record = await asyncio.to_thread(get_select_query_result_dicts, sql_query, (patient_id,))
     return patient_record
@@ -0,0 +1,146 @@
+"""Stage checkpoints of visit note analyses.
+
+Only the final patient_documents row marks a note as analyzed, so a note
+whose analysis failed halfway used to be redone from scratch. The result
+of every completed stage is now kept in the analysis_checkpoints table,
+see zollama.sql, keyed by note, model and stage:
+
+    summary                     the note's summary envelope
+    diagnose:<llm>              a model's diagnosis envelope
+    codes:<llm>                 its code section envelopes
+    lookup:<llm>                [codes per section, details per section]
+    store:<llm>                 true once its analysis is stored
+
+A rerun resumes after the completed stages, see services.pipeline and
+services.scheduler, and a note's checkpoints are deleted once all of its
+models' analyses are stored. Envelopes hold the LLM answers as stored,
+i.e. encrypted when patient data encryption is enabled.
+
+Checkpoints are an optimization: failures to read or write them are
+logged and the analysis carries on.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+from typing import Any, Iterable, Optional
+
+from database import execute_write_query, get_select_query_result_dicts
+from utils import serialize_datetime
+
+from app.core.config import settings
+
+
+def stage_key(name: str) -> tuple[str, str]:
+    """(stage, llm) of a stage name, e.g. diagnose:meditron."""
+    stage, _, llm = name.partition(":")
+    return stage, llm
+
+
+def _decode(obj: dict[str, Any]) -> dict[str, Any]:
+    """Envelope timestamps back to datetimes."""
+    if isinstance(obj.get("timestamp"), str):
+        try:
+            obj["timestamp"] = datetime.datetime.fromisoformat(obj["timestamp"])
+        except ValueError:
+            pass
+    return obj
+
+
+class NoteCheckpoints:
+    """Completed stages of one note's analysis by stage name."""
+
+    def __init__(self, note_id: str, results: Optional[dict[str, Any]] = None) -> None:
+        self.note_id = note_id
+        self.results = results or {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.results
+
+    def get(self, name: str) -> Any:
+        return self.results.get(name)
+
+    async def save(self, name: str, value: Any) -> None:
+        """Checkpoint a completed stage."""
+        self.results[name] = value
+        await asyncio.to_thread(save_checkpoint, self.note_id, name, value)
+
+
+def load_checkpoints(note_ids: Iterable[str]) -> dict[str, NoteCheckpoints]:
+    """Checkpoints of notes, empty for notes without any.
+
+    Args:
+        note_ids: Patient note identifiers
+
+    Returns:
+        NoteCheckpoints per note identifier
+    """
+    note_ids = list(note_ids)
+    checkpoints = {note_id: NoteCheckpoints(note_id) for note_id in note_ids}
+    if not settings.analysis_checkpoints_enabled or not note_ids:
+        return checkpoints
+
+    sql_query = """
+        SELECT patient_note_id, llm, stage, result::text AS result
+        FROM analysis_checkpoints
+        WHERE patient_note_id = ANY(%s);
+    """
+
+    try:
+        rows = get_select_query_result_dicts(sql_query, (note_ids,))
+    except Exception as e:
+        logging.error("Unable to load analysis checkpoints: %r", e)
+        return checkpoints
+
+    for row in rows:
+        name = f"{row['stage']}:{row['llm']}" if row["llm"] else row["stage"]
+        checkpoints[row["patient_note_id"]].results[name] = json.loads(row["result"], object_hook=_decode)
+    resumed = sum(1 for note in checkpoints.values() if note.results)
+    if resumed:
+        logging.info("Resuming %s of %s notes from checkpoints", resumed, len(note_ids))
+    return checkpoints
+
+
+def save_checkpoint(note_id: str, name: str, value: Any) -> None:
+    """Store the result of a completed stage, replacing an older one.
+
+    Args:
+        note_id: Patient note identifier
+        name: Stage name, e.g. codes:medllama2
+        value: JSON serializable stage result, datetimes allowed
+    """
+    if not settings.analysis_checkpoints_enabled:
+        return
+
+    stage, llm = stage_key(name)
+    sql_query = """
+        INSERT INTO analysis_checkpoints (patient_note_id, llm, stage, result)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (patient_note_id, llm, stage)
+        DO UPDATE SET result = EXCLUDED.result, created_at = now();
+    """
+
+    try:
+        execute_write_query(sql_query, (note_id, llm, stage, json.dumps(value, default=serialize_datetime)),
+                            fetch=False)
+    except Exception as e:
+        logging.error("Unable to checkpoint %s of note %s: %r", name, note_id[0:10], e)
+
+
+def clear_checkpoints(note_ids: Iterable[str]) -> None:
+    """Delete the checkpoints of notes whose analysis is complete.
+
+    Args:
+        note_ids: Patient note identifiers
+    """
+    note_ids = list(note_ids)
+    if not settings.analysis_checkpoints_enabled or not note_ids:
+        return
+
+    sql_query = "DELETE FROM analysis_checkpoints WHERE patient_note_id = ANY(%s);"
+
+    try:
+        execute_write_query(sql_query, (note_ids,), fetch=False)
+    except Exception as e:
+        logging.error("Unable to delete analysis checkpoints: %r", e)
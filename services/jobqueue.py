@@ -0,0 +1,310 @@
+"""Durable work queue of visit note analyses.
+
+Pending visit notes are enqueued as rows of the analysis_jobs table, see
+zollama.sql. Any number of worker processes, on any number of hosts,
+lease batches of jobs with FOR UPDATE SKIP LOCKED, so concurrent workers
+never lease the same job and never wait on each other's locks.
+
+A lease expires lease_seconds after it was taken or last renewed; workers
+renew the leases of the batch they are analyzing with heartbeats. Jobs of
+a worker that died are leased again once their lease expires. A job that
+failed, or whose lease expired, max_attempts times is marked failed.
+
+    pending --lease--> running --success--> done
+       ^                  |
+       +----failure-------+----attempts exhausted--> failed
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from database import execute_write_query, get_select_query_result_dicts
+
+from app.core.config import settings
+
+
+@dataclass(frozen=True)
+class AnalysisJob:
+    """A leased analysis_jobs row."""
+    id: int
+    patient_note_id: str
+    attempts: int
+
+
+def default_worker_id() -> str:
+    """Worker identifier unique across hosts and processes."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_pending_notes(medllms: Optional[list[str]] = None) -> int:
+    """Enqueue the visit notes not analyzed by every medical model yet.
+
+    A pending note whose job is done, e.g. because a model was added, gets
+    its job back; jobs pending, running or failed are left alone.
+
+    Args:
+        medllms: Medical LLM model names, settings.medllms by default
+
+    Returns:
+        Number of jobs enqueued
+    """
+    from services.analysis import PENDING_NOTES_QUERY
+
+    sql_query = f"""
+        INSERT INTO analysis_jobs (patient_note_id)
+        {PENDING_NOTES_QUERY}
+        ON CONFLICT (patient_note_id) DO UPDATE
+        SET status = 'pending', attempts = 0, last_error = NULL, updated_at = now()
+        WHERE analysis_jobs.status = 'done'
+        RETURNING id;
+    """
+
+    return len(execute_write_query(sql_query, (medllms or settings.medllms,)))
+
+
+def retry_failed_jobs() -> int:
+    """Make failed jobs pending again, with their attempts reset.
+
+    Returns:
+        Number of jobs reset
+    """
+    sql_query = """
+        UPDATE analysis_jobs
+        SET status = 'pending', attempts = 0, updated_at = now()
+        WHERE status = 'failed'
+        RETURNING id;
+    """
+
+    return len(execute_write_query(sql_query))
+
+
+def fail_exhausted_jobs(max_attempts: int) -> int:
+    """Mark failed the jobs whose lease expired on their last attempt.
+
+    Args:
+        max_attempts: Attempts of a job before it is marked failed
+
+    Returns:
+        Number of jobs marked failed
+    """
+    sql_query = """
+        UPDATE analysis_jobs
+        SET status = 'failed', leased_by = NULL, lease_expires_at = NULL,
+            last_error = COALESCE(last_error, 'lease expired'), updated_at = now()
+        WHERE status = 'running' AND lease_expires_at < now() AND attempts >= %s
+        RETURNING id;
+    """
+
+    return len(execute_write_query(sql_query, (max_attempts,)))
+
+
+def lease_jobs(worker_id: str, limit: int, lease_seconds: int, max_attempts: int) -> list[AnalysisJob]:
+    """Lease up to limit pending jobs, or jobs whose lease expired.
+
+    Args:
+        worker_id: Identifier of the leasing worker
+        limit: Maximum number of jobs
+        lease_seconds: Seconds until the lease expires without a heartbeat
+        max_attempts: Jobs with this many attempts are not leased again
+
+    Returns:
+        Leased jobs, oldest first
+    """
+    fail_exhausted_jobs(max_attempts)
+
+    sql_query = """
+        UPDATE analysis_jobs
+        SET status = 'running', leased_by = %s,
+            lease_expires_at = now() + make_interval(secs => %s),
+            attempts = attempts + 1, updated_at = now()
+        WHERE id IN (
+            SELECT id
+            FROM analysis_jobs
+            WHERE (status = 'pending' OR (status = 'running' AND lease_expires_at < now()))
+                AND attempts < %s
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, patient_note_id, attempts;
+    """
+
+    rows = execute_write_query(sql_query, (worker_id, lease_seconds, max_attempts, limit))
+    return sorted((AnalysisJob(*row) for row in rows), key=lambda job: job.id)
+
+
+def heartbeat(worker_id: str, job_ids: list[int], lease_seconds: int) -> set[int]:
+    """Renew the leases a worker holds.
+
+    Args:
+        worker_id: Identifier of the leasing worker
+        job_ids: Jobs to renew
+        lease_seconds: Seconds until the lease expires without a heartbeat
+
+    Returns:
+        Jobs whose lease was renewed, jobs missing from it were lost to
+        another worker after the lease expired
+    """
+    sql_query = """
+        UPDATE analysis_jobs
+        SET lease_expires_at = now() + make_interval(secs => %s), updated_at = now()
+        WHERE id = ANY(%s) AND leased_by = %s AND status = 'running'
+        RETURNING id;
+    """
+
+    return {row[0] for row in execute_write_query(sql_query, (lease_seconds, list(job_ids), worker_id))}
+
+
+def finish_job(job: AnalysisJob, worker_id: str, succeeded: bool, max_attempts: int,
+               error: Optional[str] = None) -> bool:
+    """Record the outcome of a leased job.
+
+    A failed job is pending again unless it ran out of attempts.
+
+    Args:
+        job: Leased job
+        worker_id: Identifier of the leasing worker
+        succeeded: True if the note was analyzed and stored
+        max_attempts: Attempts of a job before it is marked failed
+        error: Why the job failed
+
+    Returns:
+        False if the worker no longer held the lease
+    """
+    sql_query = """
+        UPDATE analysis_jobs
+        SET status = CASE WHEN %s THEN 'done' WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+            leased_by = NULL, lease_expires_at = NULL,
+            last_error = CASE WHEN %s THEN NULL ELSE %s END, updated_at = now()
+        WHERE id = %s AND leased_by = %s AND status = 'running'
+        RETURNING id;
+    """
+
+    params = (succeeded, max_attempts, succeeded, error, job.id, worker_id)
+    return bool(execute_write_query(sql_query, params))
+
+
+def queue_stats() -> dict[str, int]:
+    """Number of jobs per status."""
+    sql_query = "SELECT status, count(*) AS jobs FROM analysis_jobs GROUP BY status;"
+
+    return {row["status"]: row["jobs"] for row in get_select_query_result_dicts(sql_query)}
+
+
+async def _keep_leases(worker_id: str, job_ids: list[int], lease_seconds: int) -> None:
+    """Heartbeat a batch's leases every third of the lease time."""
+    while True:
+        await asyncio.sleep(max(1.0, lease_seconds / 3))
+        try:
+            renewed = await asyncio.to_thread(heartbeat, worker_id, job_ids, lease_seconds)
+        except Exception as e:
+            logging.error("Heartbeat of jobs %s failed: %r", job_ids, e)
+            continue
+        lost = set(job_ids) - renewed
+        if lost:
+            logging.warning("Worker %s lost the leases of jobs %s", worker_id, sorted(lost))
+
+
+async def process_jobs(jobs: list[AnalysisJob], worker_id: str, medllms: list[str],
+                       lease_seconds: int, max_attempts: int) -> dict[int, bool]:
+    """Analyze the notes of leased jobs in waves and record the outcomes.
+
+    Args:
+        jobs: Leased jobs
+        worker_id: Identifier of the leasing worker
+        medllms: Medical LLM model names
+        lease_seconds: Seconds until the lease expires without a heartbeat
+        max_attempts: Attempts of a job before it is marked failed
+
+    Returns:
+        Per job id, True if its note was analyzed and stored
+    """
+    from services.scheduler import analyze_notes_in_waves
+
+    keeper = asyncio.create_task(_keep_leases(worker_id, [job.id for job in jobs], lease_seconds))
+    error = "analysis failed"
+    try:
+        outcomes = await analyze_notes_in_waves([job.patient_note_id for job in jobs], medllms)
+    except Exception as e:
+        logging.error("Analysis of jobs %s failed: %r", [job.id for job in jobs], e)
+        outcomes = {}
+        error = repr(e)
+    finally:
+        keeper.cancel()
+
+    results = {}
+    for job in jobs:
+        succeeded = outcomes.get(job.patient_note_id, False)
+        if not await asyncio.to_thread(finish_job, job, worker_id, succeeded, max_attempts,
+                                       None if succeeded else error):
+            logging.warning("Job %s finished after its lease was lost", job.id)
+        results[job.id] = succeeded
+    return results
+
+
+def run_worker(worker_id: Optional[str] = None,
+               batch_size: int = 25,
+               poll_interval: float = 10.0,
+               once: bool = False,
+               stop: Optional[threading.Event] = None) -> None:
+    """Lease and analyze batches of jobs until stopped.
+
+    Batches run on one event loop for the worker's lifetime, so pooled
+    Ollama connections are reused across batches and closed on return.
+
+    Args:
+        worker_id: Identifier of this worker, host:pid by default
+        batch_size: Jobs leased, and analyzed in waves, at a time
+        poll_interval: Seconds to wait when the queue is empty
+        once: Return once the queue is empty
+        stop: Return after the current batch once set
+    """
+    worker_id = worker_id or default_worker_id()
+    stop = stop or threading.Event()
+    lease_seconds = settings.analysis_job_lease_seconds
+    max_attempts = settings.analysis_job_max_attempts
+    logging.info("Analysis worker %s started", worker_id)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        while not stop.is_set():
+            try:
+                jobs = lease_jobs(worker_id, batch_size, lease_seconds, max_attempts)
+            except Exception as e:
+                logging.error("Worker %s unable to lease jobs: %r", worker_id, e)
+                jobs = []
+            else:
+                if not jobs and once:
+                    break
+
+            if not jobs:
+                stop.wait(poll_interval)
+                continue
+
+            logging.info("Worker %s leased %s jobs", worker_id, len(jobs))
+            results = loop.run_until_complete(
+                process_jobs(jobs, worker_id, settings.medllms, lease_seconds, max_attempts))
+            logging.info("Worker %s analyzed %s of %s notes", worker_id, sum(results.values()), len(jobs))
+    finally:
+        _close_loop(loop)
+
+    logging.info("Analysis worker %s stopped", worker_id)
+
+
+def _close_loop(loop: asyncio.AbstractEventLoop) -> None:
+    """Close the worker's pooled Ollama clients, then its event loop."""
+    from gptutils import aclose_clients
+
+    try:
+        loop.run_until_complete(aclose_clients())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,284 @@
+"""DAG execution of the per-note analysis pipeline.
+
+The analysis of a visit note is a graph of stages, each stage starting as
+soon as the stages it depends on have succeeded:
+
+    summary --+--> diagnose:<llm> --> codes:<llm> --> lookup:<llm> --> store:<llm>
+              +--> diagnose:<llm2> --> ...          (one branch per MEDLLM)
+
+codes:<llm> itself asks the section prompts concurrently, see
+services.analysis.fetch_code_sections. Stages are grouped (summary,
+diagnosis, codes, lookup, store) and each group runs at most as many
+stages at once as PIPELINE_STAGE_LIMITS allows.
+
+The branches of the medical models run concurrently and are stored
+independently. A branch that is still diagnosing, extracting or looking
+up codes MEDLLM_TIMEOUT seconds after it started is cancelled so a slow
+model does not hold the note; the other models' results are kept. Its
+Ollama requests are cancelled with it, unless another caller shares
+them, see singleflight.py, so it frees its host right away. Each
+branch routes on the note and model, so with several Ollama hosts the
+models of a note can run on different hosts.
+
+A stage fails when it raises or returns None/False; the stages that
+depend on it are skipped, independent branches carry on. With
+checkpoints, stages completed by an earlier run are not run again, see
+services.checkpoints.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from encryption import decrypt_text
+
+from services.analysis import (
+    build_codes_document,
+    diagnose,
+    fetch_code_sections,
+    lookup_code_details,
+    store_analysis_with_codes,
+    summarize_visit_note,
+)
+from services.checkpoints import NoteCheckpoints, clear_checkpoints, load_checkpoints
+
+StageFn = Callable[[dict[str, Any]], Awaitable[Any]]
+
+
+@dataclass(frozen=True)
+class Stage:
+    """One step of a pipeline.
+
+    run is called with the results of all stages finished so far, keyed
+    by stage name; group names the concurrency limit the stage counts
+    against, the stage's own name if empty.
+    """
+    name: str
+    run: StageFn
+    deps: tuple[str, ...] = ()
+    group: str = ""
+
+
+@dataclass
+class PipelineResult:
+    """Outcome of run_pipeline."""
+    results: dict[str, Any] = field(default_factory=dict)
+    failed: dict[str, str] = field(default_factory=dict)
+    skipped: set[str] = field(default_factory=set)
+    resumed: set[str] = field(default_factory=set)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.skipped
+
+
+def topological_order(stages: list[Stage]) -> list[Stage]:
+    """Stages ordered so every stage follows its dependencies.
+
+    Raises:
+        ValueError: On duplicate names, unknown dependencies or cycles
+    """
+    by_name = {stage.name: stage for stage in stages}
+    if len(by_name) != len(stages):
+        raise ValueError("Duplicate stage names")
+
+    ordered: list[Stage] = []
+    state: dict[str, str] = {}
+
+    def visit(stage: Stage, path: tuple[str, ...]) -> None:
+        if state.get(stage.name) == "done":
+            return
+        if state.get(stage.name) == "visiting":
+            raise ValueError(f"Cycle through stages {' -> '.join(path + (stage.name,))}")
+        state[stage.name] = "visiting"
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+            visit(by_name[dep], path + (stage.name,))
+        state[stage.name] = "done"
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage, ())
+    return ordered
+
+
+async def run_pipeline(
+    stages: list[Stage],
+    limits: Optional[dict[str, int]] = None,
+    checkpoints: Optional[NoteCheckpoints] = None,
+) -> PipelineResult:
+    """Run stages as soon as their dependencies succeed.
+
+    Args:
+        stages: Pipeline stages
+        limits: Maximum concurrent stages per group, groups not listed are
+            unlimited
+        checkpoints: Results of stages completed earlier, which are not
+            run again; results of stages completed now are added
+
+    Returns:
+        Results of the stages that succeeded, reasons of the ones that
+        failed and names of the ones skipped or resumed from checkpoints
+    """
+    outcome = PipelineResult()
+    semaphores = {group: asyncio.Semaphore(limit) for group, limit in (limits or {}).items() if limit > 0}
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def execute(stage: Stage) -> bool:
+        for dep in stage.deps:
+            if not await tasks[dep]:
+                outcome.skipped.add(stage.name)
+                return False
+
+        if checkpoints is not None and stage.name in checkpoints:
+            outcome.results[stage.name] = checkpoints.get(stage.name)
+            outcome.resumed.add(stage.name)
+            return True
+
+        semaphore = semaphores.get(stage.group or stage.name)
+        try:
+            if semaphore is None:
+                value = await stage.run(outcome.results)
+            else:
+                async with semaphore:
+                    value = await stage.run(outcome.results)
+        except Exception as e:  # isolate the failure to the stage's descendants
+            outcome.failed[stage.name] = repr(e)
+            return False
+
+        if value is None or value is False:
+            outcome.failed[stage.name] = "no result"
+            return False
+        outcome.results[stage.name] = value
+        if checkpoints is not None:
+            await checkpoints.save(stage.name, value)
+        return True
+
+    for stage in topological_order(stages):
+        tasks[stage.name] = asyncio.create_task(execute(stage))
+    await asyncio.gather(*tasks.values())
+    return outcome
+
+
+class BranchBudget:
+    """Time budget shared by the stages of one branch, it starts with the
+    branch's first stage."""
+
+    def __init__(self, name: str, timeout: Optional[float]) -> None:
+        self.name = name
+        self.timeout = timeout
+        self._deadline: Optional[float] = None
+
+    async def run(self, awaitable: Awaitable[Any]) -> Any:
+        """Await within what is left of the budget.
+
+        Raises:
+            asyncio.TimeoutError: Once the budget is spent
+        """
+        if self.timeout is None:
+            return await awaitable
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.timeout
+        try:
+            return await asyncio.wait_for(awaitable, max(0.0, self._deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"{self.name} exceeded its {self.timeout:g}s budget") from None
+
+
+def _medllm_stages(visit_note: dict[str, Any], llm: str, timeout: Optional[float] = None) -> list[Stage]:
+    """Diagnosis, code extraction, lookup and storage with one medical model,
+    all but storage within timeout seconds."""
+    route_key = f"{visit_note['patient_note_id']}:{llm}"
+    budget = BranchBudget(llm, timeout)
+
+    async def run_diagnose(results: dict[str, Any]) -> Optional[dict[str, Any]]:
+        return await budget.run(diagnose(llm, results["summary"], route_key=route_key))
+
+    async def run_codes(results: dict[str, Any]) -> Optional[dict[str, dict[str, Any]]]:
+        decrypted_analysis = decrypt_text(results[f"diagnose:{llm}"]["analysis"])
+        return await budget.run(fetch_code_sections(llm, decrypted_analysis, route_key))
+
+    async def run_lookup(results: dict[str, Any]) -> tuple[dict[str, list[str]], dict[str, list]]:
+        from clincodeutils import extract_section_codes
+
+        sections = results[f"codes:{llm}"]
+        section_codes = extract_section_codes(sections)
+        return section_codes, await budget.run(lookup_code_details(sections, section_codes))
+
+    def store(results: dict[str, Any]) -> bool:
+        section_codes, details = results[f"lookup:{llm}"]
+        store_analysis_with_codes(
+            visit_note,
+            llm,
+            results["summary"],
+            results[f"diagnose:{llm}"],
+            build_codes_document(results[f"codes:{llm}"], details, section_codes),
+        )
+        return True
+
+    async def run_store(results: dict[str, Any]) -> bool:
+        return await asyncio.to_thread(store, results)
+
+    return [
+        Stage(f"diagnose:{llm}", run_diagnose, ("summary",), "diagnosis"),
+        Stage(f"codes:{llm}", run_codes, (f"diagnose:{llm}",), "codes"),
+        Stage(f"lookup:{llm}", run_lookup, (f"codes:{llm}",), "lookup"),
+        Stage(f"store:{llm}", run_store, (f"lookup:{llm}",), "store"),
+    ]
+
+
+def note_stages(
+    visit_note: dict[str, Any],
+    medllms: list[str],
+    timeouts: Optional[dict[str, Optional[float]]] = None,
+) -> list[Stage]:
+    """The analysis pipeline of one visit note.
+
+    Args:
+        visit_note: Visit note row
+        medllms: Medical LLM model names, one branch each
+        timeouts: Seconds each model's branch may take, unlimited if missing
+
+    Returns:
+        Pipeline stages
+    """
+
+    async def run_summary(results: dict[str, Any]) -> Optional[dict[str, Any]]:
+        return await summarize_visit_note(visit_note)
+
+    stages = [Stage("summary", run_summary, (), "summary")]
+    for llm in medllms:
+        stages.extend(_medllm_stages(visit_note, llm, (timeouts or {}).get(llm)))
+    return stages
+
+
+async def analyze_note_pipeline(
+    visit_note: dict[str, Any],
+    medllms: list[str],
+    limits: Optional[dict[str, int]] = None,
+    timeouts: Optional[dict[str, Optional[float]]] = None,
+) -> bool:
+    """Analyze a visit note with every medical model.
+
+    Args:
+        visit_note: Visit note row
+        medllms: Medical LLM model names
+        limits: Maximum concurrent stages per group
+        timeouts: Seconds each model's branch may take, unlimited if missing
+
+    Returns:
+        True if the analyses of all models were stored, False otherwise
+    """
+    note_id = visit_note["patient_note_id"]
+    checkpoints = (await asyncio.to_thread(load_checkpoints, [note_id]))[note_id]
+
+    outcome = await run_pipeline(note_stages(visit_note, medllms, timeouts), limits, checkpoints)
+    for name, reason in outcome.failed.items():
+        logging.error("Analysis of note %s failed at %s: %s", note_id[0:10], name, reason)
+
+    if outcome.ok:
+        await asyncio.to_thread(clear_checkpoints, [note_id])
+    return outcome.ok
@@ -0,0 +1,243 @@
+"""Model-affinity batch scheduling of visit note analyses.
+
+Analyzing one note at a time makes an Ollama host cycle through the
+summary model, every medical model and the lookup model per note, which
+on memory-constrained hosts evicts and reloads models constantly. The
+scheduler instead runs a batch of notes in model-homogeneous waves:
+
+    1. summaries of all notes with SUMMARY_LLM
+    2. per medical model, diagnoses and code prompts of all notes
+    3. code lookups of all notes (lookup model)
+    4. storage
+
+Intermediate results are carried between waves in NoteWork objects and
+checkpointed, so a note that failed in an earlier batch resumes at the
+wave it failed in, see services.checkpoints. A failed summary drops the
+note from the remaining waves; a medical model that fails only drops
+that model's later waves, the note's other models carry on.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from encryption import decrypt_text
+
+from services.analysis import (
+    build_codes_document,
+    diagnose,
+    fetch_code_sections,
+    get_visit_notes,
+    lookup_code_details,
+    store_analysis_with_codes,
+    summarize_visit_note,
+)
+from services.checkpoints import (
+    NoteCheckpoints,
+    clear_checkpoints,
+    load_checkpoints,
+    save_checkpoint,
+    stage_key,
+)
+
+
+@dataclass
+class NoteWork:
+    """Intermediate results of one visit note across waves."""
+    visit_note: dict[str, Any]
+    summarized_obj: Optional[dict[str, Any]] = None
+    diagnoses: dict[str, dict[str, Any]] = field(default_factory=dict)
+    sections: dict[str, dict[str, dict[str, Any]]] = field(default_factory=dict)
+    codes: dict[str, dict[str, list[str]]] = field(default_factory=dict)
+    details: dict[str, dict[str, list]] = field(default_factory=dict)
+    stored: set[str] = field(default_factory=set)
+    checkpoints: Optional[NoteCheckpoints] = None
+    failed: bool = False
+    failed_llms: set[str] = field(default_factory=set)
+
+    @property
+    def note_id(self) -> str:
+        return self.visit_note["patient_note_id"]
+
+    @property
+    def ok(self) -> bool:
+        """True unless the note or any of its models failed."""
+        return not self.failed and not self.failed_llms
+
+    def restore(self, checkpoints: NoteCheckpoints) -> None:
+        """Resume from the stages completed by earlier runs."""
+        self.checkpoints = checkpoints
+        self.summarized_obj = checkpoints.get("summary")
+        for name, value in checkpoints.results.items():
+            stage, llm = stage_key(name)
+            if stage == "diagnose":
+                self.diagnoses[llm] = value
+            elif stage == "codes":
+                self.sections[llm] = value
+            elif stage == "lookup":
+                self.codes[llm], self.details[llm] = value
+            elif stage == "store":
+                self.stored.add(llm)
+
+    async def checkpoint(self, name: str, value: Any) -> None:
+        if self.checkpoints is not None:
+            await self.checkpoints.save(name, value)
+
+
+def _fail(work: NoteWork, stage: str, llm: Optional[str] = None) -> None:
+    """Drop a model of a note, or the whole note, from the remaining waves."""
+    if llm:
+        work.failed_llms.add(llm)
+    else:
+        work.failed = True
+    logging.error("Analysis of note %s failed at %s %s", work.note_id[0:10], stage, llm or "")
+
+
+async def _summary_wave(batch: list[NoteWork]) -> None:
+    batch = [work for work in batch if work.summarized_obj is None]
+    summaries = await asyncio.gather(
+        *(summarize_visit_note(work.visit_note) for work in batch),
+        return_exceptions=True,
+    )
+    for work, summarized_obj in zip(batch, summaries):
+        if not summarized_obj or isinstance(summarized_obj, BaseException):
+            _fail(work, "summary")
+        else:
+            work.summarized_obj = summarized_obj
+            await work.checkpoint("summary", summarized_obj)
+
+
+async def _medllm_wave(batch: list[NoteWork], llm: str) -> None:
+    """Diagnosis and code prompts of every note with one medical model."""
+
+    async def run(work: NoteWork) -> None:
+        if llm in work.sections:
+            return
+
+        analyzed_obj = work.diagnoses.get(llm)
+        if analyzed_obj is None:
+            analyzed_obj = await diagnose(llm, work.summarized_obj, route_key=work.note_id)
+            if not analyzed_obj:
+                _fail(work, "diagnosis", llm)
+                return
+            work.diagnoses[llm] = analyzed_obj
+            await work.checkpoint(f"diagnose:{llm}", analyzed_obj)
+
+        sections = await fetch_code_sections(llm, decrypt_text(analyzed_obj["analysis"]), work.note_id)
+        if sections is None:
+            _fail(work, "code extraction", llm)
+            return
+
+        work.sections[llm] = sections
+        await work.checkpoint(f"codes:{llm}", sections)
+
+    batch = [work for work in batch if llm not in work.failed_llms]
+    results = await asyncio.gather(*(run(work) for work in batch), return_exceptions=True)
+    for work, result in zip(batch, results):
+        if isinstance(result, BaseException):
+            _fail(work, f"diagnosis/code extraction ({result!r})", llm)
+
+
+async def _lookup_wave(batch: list[NoteWork]) -> None:
+    """Code lookups of every note and medical model, each distinct code of
+    the batch looked up once."""
+    from clincodeutils import CodeLookupPlan, extract_section_codes
+
+    jobs = [(work, llm) for work in batch for llm in work.sections if llm not in work.details]
+    plan = CodeLookupPlan()
+    for work, llm in jobs:
+        work.codes[llm] = extract_section_codes(work.sections[llm])
+        plan.add(work.codes[llm])
+
+    try:
+        await plan.run()
+    except Exception as e:  # isolate the failure to the notes it affects
+        logging.error("Batched code lookup failed (%r), looking up per note", e)
+    else:
+        for work, llm in jobs:
+            work.details[llm] = plan.section_details(work.codes[llm])
+            await work.checkpoint(f"lookup:{llm}", [work.codes[llm], work.details[llm]])
+        return
+
+    results = await asyncio.gather(
+        *(lookup_code_details(work.sections[llm], work.codes[llm]) for work, llm in jobs),
+        return_exceptions=True,
+    )
+    for (work, llm), details in zip(jobs, results):
+        if isinstance(details, BaseException):
+            _fail(work, f"code lookup ({details!r})", llm)
+        else:
+            work.details[llm] = details
+            await work.checkpoint(f"lookup:{llm}", [work.codes[llm], details])
+
+
+def _store(work: NoteWork, llm: str) -> None:
+    store_analysis_with_codes(
+        work.visit_note,
+        llm,
+        work.summarized_obj,
+        work.diagnoses[llm],
+        build_codes_document(work.sections[llm], work.details[llm], work.codes[llm]),
+    )
+    work.stored.add(llm)
+    save_checkpoint(work.note_id, f"store:{llm}", True)
+
+
+async def analyze_notes_in_waves(visit_note_ids: list[str], medllms: list[str]) -> dict[str, bool]:
+    """Analyze a batch of visit notes in model-homogeneous waves.
+
+    Args:
+        visit_note_ids: Patient note identifiers
+        medllms: Medical LLM model names
+
+    Returns:
+        Per note identifier, True if the note was analyzed and stored;
+        notes that are not in the database are False
+    """
+    outcomes = dict.fromkeys(visit_note_ids, False)
+    if not visit_note_ids:
+        return outcomes
+
+    batch = [NoteWork(visit_note) for visit_note in await asyncio.to_thread(get_visit_notes, visit_note_ids)]
+    logging.info("Analyzing %s notes in waves", len(batch))
+
+    checkpoints = await asyncio.to_thread(load_checkpoints, [work.note_id for work in batch])
+    for work in batch:
+        work.restore(checkpoints[work.note_id])
+
+    await _summary_wave(batch)
+
+    for llm in medllms:
+        await _medllm_wave([work for work in batch if not work.failed], llm)
+
+    await _lookup_wave([work for work in batch if not work.failed])
+
+    for work in batch:
+        if work.failed:
+            continue
+        for llm in medllms:
+            if llm in work.stored or llm in work.failed_llms:
+                continue
+            try:
+                await asyncio.to_thread(_store, work, llm)
+            except Exception as e:
+                _fail(work, f"storage ({e!r})", llm)
+
+    outcomes.update({work.note_id: work.ok for work in batch})
+    await asyncio.to_thread(clear_checkpoints, [work.note_id for work in batch if work.ok])
+    return outcomes
+
+
+async def analyze_in_waves(visit_note_ids: list[str], medllms: list[str]) -> bool:
+    """Analyze a batch of visit notes in model-homogeneous waves.
+
+    Args:
+        visit_note_ids: Patient note identifiers
+        medllms: Medical LLM model names
+
+    Returns:
+        True if every note was analyzed and stored, False otherwise
+    """
+    outcomes = await analyze_notes_in_waves(visit_note_ids, medllms)
+    return all(outcomes.values())
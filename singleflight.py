@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Single-flight coalescing of identical in-flight calls
+    ©2024, Ovais Quraishi
+
+    While a call for a key is running, further calls for the same key
+    wait for it and share its result (or exception) instead of starting
+    their own. Unlike a cache this also helps before any response has been
+    stored, e.g. when many notes look up the same common code at once.
+"""
+
+import asyncio
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class _Call:
+    """A call in flight"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces calls made from threads
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> tuple[Any, bool]:
+        """fn() or the result of the identical call in flight, plus
+            whether the result was shared
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _AsyncCall:
+    """A task in flight and the number of callers awaiting it"""
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """Coalesces coroutines of the same event loop
+
+        The call runs as its own task, so a cancelled caller does not
+        cancel it for the others; once the last caller is gone the task
+        is cancelled too.
+    """
+
+    def __init__(self) -> None:
+        self._calls: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, _AsyncCall]]' = \
+            weakref.WeakKeyDictionary()
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """await fn() or the result of the identical call in flight, plus
+            whether the result was shared
+        """
+
+        calls = self._calls.setdefault(asyncio.get_running_loop(), {})
+        call = calls.get(key)
+        shared = call is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            call = _AsyncCall(asyncio.ensure_future(fn()))
+            calls[key] = call
+
+            def forget(done: asyncio.Task) -> None:
+                if calls.get(key) is call:
+                    del calls[key]
+
+            call.task.add_done_callback(forget)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # every caller was cancelled, nobody wants the result
+                if calls.get(key) is call:
+                    del calls[key]
+                call.task.cancel()
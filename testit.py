@@ -4,7 +4,7 @@ import unittest
 import json
 import os
 import sys
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Set up path to find config.py and setup.config
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -94,7 +94,7 @@ class TestFastAPIApp(unittest.TestCase):
     def test_analyze_visit_notes_endpoint(self):
         """Test /api/v1/analyze-visit-notes endpoint."""
 
-        with patch('app.api.v1.endpoints.analyze_visit_notes') as mock_analyze_visit_notes:
+        with patch('app.api.v1.endpoints.analyze_visit_notes', new_callable=AsyncMock) as mock_analyze_visit_notes:
             mock_analyze_visit_notes.return_value = True
 
             # Send GET request to /api/v1/analyze-visit-notes endpoint
@@ -110,7 +110,7 @@ class TestFastAPIApp(unittest.TestCase):
     def test_analyze_visit_note_endpoint(self):
         """Test /api/v1/analyze-visit-note endpoint."""
 
-        with patch('app.api.v1.endpoints.analyze_visit_note') as mock_analyze_visit_note:
+        with patch('app.api.v1.endpoints.analyze_visit_note', new_callable=AsyncMock) as mock_analyze_visit_note:
             mock_analyze_visit_note.return_value = True
 
             # Send GET request to /api/v1/analyze-visit-note endpoint with visit_note_id parameter
@@ -131,5 +131,965 @@ class TestFastAPIApp(unittest.TestCase):
         self.assertIn('message', data)
         self.assertIn('version', data)
 
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_threshold_and_half_opens(self):
+        """Breaker opens on consecutive failures and lets one trial through after reset."""
+        from healthmonitor import CircuitBreaker, OPEN, HALF_OPEN, CLOSED
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        breaker.reset_timeout = 0
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_lost_half_open_trial_is_released(self):
+        """A trial without an outcome is released, or reclaimed once stale or after a successful probe."""
+        from healthmonitor import CircuitBreaker
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, trial_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.release_trial()
+        self.assertTrue(breaker.allow_request())
+
+        breaker.probe_succeeded()
+        self.assertFalse(breaker.allow_request())
+        breaker.trial_timeout = 0
+        breaker.probe_succeeded()
+        self.assertTrue(breaker.allow_request())
+
+    def test_monitor_caches_probe_result(self):
+        """HealthMonitor probes once per TTL instead of on every call."""
+        from healthmonitor import HealthMonitor
+
+        probe = MagicMock(return_value=True)
+        monitor = HealthMonitor(ttl=60, probe_interval=0, probe=probe)
+        for _ in range(5):
+            self.assertTrue(monitor.is_available('http://ollama:11434'))
+        self.assertEqual(probe.call_count, 1)
+
+    def test_stale_state_is_probed_off_the_event_loop(self):
+        """On an event loop a stale host answers from cache while a background probe refreshes it."""
+        import asyncio
+        import threading
+        import time
+        from healthmonitor import HealthMonitor
+
+        probed = threading.Event()
+
+        def probe(host, timeout):
+            time.sleep(0.3)
+            probed.set()
+            return False
+
+        monitor = HealthMonitor(ttl=60, probe_interval=0, probe=probe)
+
+        async def ask():
+            started = time.monotonic()
+            return monitor.is_up('http://ollama:11434'), time.monotonic() - started
+
+        is_up, elapsed = asyncio.run(ask())
+        self.assertTrue(is_up)
+        self.assertLess(elapsed, 0.1)
+        self.assertTrue(probed.wait(2))
+        time.sleep(0.05)
+        self.assertFalse(monitor.is_up('http://ollama:11434'))
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_memory_tier_is_lru(self):
+        """Least recently used entries are evicted first."""
+        from llmcache import MemoryTier
+
+        tier = MemoryTier(max_entries=2)
+        tier.set('a', '1')
+        tier.set('b', '2')
+        tier.get('a')
+        tier.set('c', '3')
+        self.assertEqual(tier.get('a'), '1')
+        self.assertIsNone(tier.get('b'))
+
+    def test_persistent_hit_is_promoted_and_counted(self):
+        """A hit in the SQLite tier is promoted to memory and counted."""
+        from llmcache import ResponseCache, MemoryTier, SQLiteTier, cache_key
+
+        sqlite_tier = SQLiteTier(':memory:')
+        key = cache_key('llama3.2', 'sha256:abc', 'Explain CPT code 99213', {'temperature': 0})
+        sqlite_tier.set(key, 'office visit')
+
+        cache = ResponseCache([MemoryTier(), sqlite_tier])
+        self.assertEqual(cache.get(key), 'office visit')
+        self.assertEqual(cache.get(key), 'office visit')
+        self.assertIsNone(cache.get('missing'))
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], {'memory': 1, 'sqlite': 1})
+        self.assertEqual(stats['misses'], 1)
+
+class TestOllamaRouter(unittest.TestCase):
+
+    def setUp(self):
+        from healthmonitor import HealthMonitor
+        from llmrouter import OllamaRouter
+
+        self.hosts = ['http://ollama-1:11434', 'http://ollama-2:11434', 'http://ollama-3:11434']
+        monitor = HealthMonitor(ttl=60, probe_interval=0, probe=MagicMock(return_value=True))
+        self.router = OllamaRouter(self.hosts, monitor)
+
+    def test_least_outstanding(self):
+        """Unkeyed requests go to the least busy host."""
+        with self.router.track(self.hosts[0]), self.router.track(self.hosts[1]):
+            self.assertEqual(self.router.pick('phi4:latest'), self.hosts[2])
+
+    def test_model_availability_and_sticky_key(self):
+        """Only hosts with the model are used, and a route key sticks to one of them."""
+        self.router.set_models(self.hosts[0], {'llama3.2:latest'})
+        self.router.set_models(self.hosts[1], {'phi4:latest'})
+        self.router.set_models(self.hosts[2], {'phi4:latest'})
+
+        picks = {self.router.pick('phi4:latest', route_key='note-1') for _ in range(5)}
+        self.assertEqual(len(picks), 1)
+        self.assertIn(picks.pop(), self.hosts[1:])
+        self.assertEqual(self.router.pick('llama3.2:latest', route_key='note-1'), self.hosts[0])
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_calls_are_aggregated_per_model_and_prompt_type(self):
+        """Ollama timings land in histograms, cache hits and errors are only counted."""
+        from llmtelemetry import Telemetry, CallRecord
+
+        telemetry = Telemetry()
+        metrics = {'load_duration': 2 * 10**9, 'prompt_eval_count': 100, 'prompt_eval_duration': 10**9,
+                   'eval_count': 50, 'eval_duration': 5 * 10**9, 'total_duration': 8 * 10**9}
+        telemetry.record(CallRecord('medllama2', 'icd', 8.2, metrics=metrics))
+        telemetry.record(CallRecord('medllama2', 'icd', 0.01, cache_hit=True))
+        telemetry.record(CallRecord('medllama2', 'icd', 0.5, error='ConnectError'))
+
+        icd = telemetry.snapshot()['medllama2']['icd']
+        self.assertEqual((icd['calls'], icd['cache_hits'], icd['errors']), (3, 1, 1))
+        self.assertEqual(icd['wall_time']['count'], 1)
+        self.assertEqual(icd['load_duration']['sum'], 2.0)
+        self.assertEqual(icd['eval_tokens_per_second'], 10.0)
+        self.assertEqual(telemetry.quantile('medllama2', 'icd', 0.95), 10.0)
+        self.assertIsNone(telemetry.quantile('phi4', 'summary', 0.95))
+
+    def test_ledger_writes_from_forked_processes(self):
+        """A worker process forked after the ledger started writes its own records."""
+        import multiprocessing
+        import time
+        from llmtelemetry import LedgerWriter, CallRecord
+
+        context = multiprocessing.get_context('fork')
+        written = context.Queue()
+
+        class Ledger(LedgerWriter):
+            def write(self, batch):
+                written.put([record.model for record in batch])
+
+        def child():
+            ledger(CallRecord('meditron', 'icd', 1.0))
+            time.sleep(0.5)
+
+        ledger = Ledger()
+        ledger(CallRecord('medllama2', 'icd', 1.0))
+        self.assertEqual(written.get(timeout=5), ['medllama2'])
+        process = context.Process(target=child)
+        process.start()
+        process.join(5)
+        self.assertEqual(written.get(timeout=5), ['meditron'])
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_identical_calls_share_one_execution(self):
+        """Threads and coroutines asking for the same key while it is in flight share one call."""
+        import asyncio
+        import threading
+        import time
+        from singleflight import SingleFlight, AsyncSingleFlight
+
+        flight, calls = SingleFlight(), []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'J45.909'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('icd', slow))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True])
+
+        async_flight = AsyncSingleFlight()
+
+        async def slow_async():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'J45.909'
+
+        async def run():
+            return await asyncio.gather(*(async_flight.do('icd', slow_async) for _ in range(4)))
+
+        self.assertEqual([value for value, _ in asyncio.run(run())], ['J45.909'] * 4)
+        self.assertEqual(len(calls), 2)
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_retries_within_attempts_budget_and_deadline(self):
+        """Transient errors are retried until attempts, budget or deadline run out."""
+        import asyncio
+        from retrypolicy import RetryPolicy, RetryBudget, DeadlineExceeded
+
+        policy = RetryPolicy(max_attempts=3, base_delay=0.01, retry_on=(ConnectionError,))
+        attempts = []
+
+        def flaky(attempt, remaining):
+            attempts.append(attempt)
+            if attempt < 3:
+                raise ConnectionError('reset')
+            return 'ok'
+
+        self.assertEqual(policy.call(flaky), 'ok')
+        self.assertEqual(attempts, [1, 2, 3])
+        with self.assertRaises(ValueError):
+            policy.call(lambda attempt, remaining: attempts.append(attempt) or int('x'))
+        self.assertEqual(len(attempts), 4)
+
+        budget = RetryBudget(ratio=0.0, max_tokens=1)
+        policy = RetryPolicy(max_attempts=5, base_delay=0.01, budget=budget)
+        attempts.clear()
+        with self.assertRaises(ConnectionError):
+            policy.call(flaky)
+        self.assertEqual(attempts, [1, 2])
+
+        async def hang(attempt, remaining):
+            await asyncio.sleep(1)
+
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(RetryPolicy(deadline=0.05).call_async(hang))
+
+    def test_inner_timeout_before_the_deadline_is_retried(self):
+        """A TimeoutError raised by an attempt is retried while the call's deadline has not passed."""
+        import asyncio
+        from retrypolicy import RetryPolicy
+
+        attempts = []
+
+        async def read(attempt, remaining):
+            attempts.append(attempt)
+            if attempt == 1:
+                await asyncio.wait_for(asyncio.sleep(1), 0.01)
+            return 'ok'
+
+        self.assertEqual(asyncio.run(RetryPolicy(base_delay=0.01, deadline=5).call_async(read)), 'ok')
+        self.assertEqual(attempts, [1, 2])
+
+        import gptutils
+        attempts.clear()
+        self.assertEqual(asyncio.run(gptutils.RETRY_POLICY.call_async(read, 5)), 'ok')
+        self.assertEqual(attempts, [1, 2])
+
+class TestOptionProfiles(unittest.TestCase):
+
+    def test_config_sections_override_default_profiles(self):
+        """[profile:<name>] sections override defaults and prompt types map to profiles."""
+        import configparser
+        from llmprofiles import load_profiles, profile_for
+
+        config = configparser.RawConfigParser()
+        config.read_string('[profile:code_lookup]\nnum_predict=200\nnum_ctx=\nstop=["\\n\\n"]\nkeep_alive=30m\n')
+        profiles = load_profiles(config)
+        lookup = profile_for(profiles, 'cpt_lookup')
+        self.assertEqual(lookup.options(), {'num_predict': 200, 'stop': ['\n\n']})
+        self.assertEqual(lookup.keep_alive, '30m')
+        self.assertEqual(profile_for(profiles, 'prescription_cpt').name, 'code_extraction')
+        self.assertIsNone(profile_for(profiles, 'chat'))
+
+class TestICDIndex(unittest.TestCase):
+
+    def test_details_come_from_the_index(self):
+        """Valid codes are described from the index, invalid ones dropped, only billable ones priced."""
+        import tempfile
+        import clincodeutils
+        from icdindex import ICDCode, ICDIndex
+
+        path = os.path.join(tempfile.mkdtemp(), 'icd.tsv.gz')
+        ICDIndex([ICDCode('J45.909', True, 'Asthma', 'Unspecified asthma, uncomplicated'),
+                  ICDCode('J45', False, 'Asthma', 'Asthma')]).write(path)
+        index = ICDIndex.load(path)
+        self.assertTrue(index.is_billable('j45909'))
+        self.assertNotIn('J99.999', index)
+
+        guidelines = {'medical_provider': {'reimbursement_rate': '$50-$100'}}
+        with patch.object(clincodeutils, 'get_icd_index', return_value=index), \
+             patch.object(clincodeutils, 'lookup_icd_reimbursement_gpt', return_value=guidelines) as priced:
+            details = clincodeutils.icd_10_code_details_list(['J45.909', 'J99.999', 'J45'])
+        self.assertEqual([detail['code'] for detail in details], ['J45.909', 'J45'])
+        self.assertEqual(details[0]['full_data']['billing_guidelines'], guidelines)
+        self.assertNotIn('billing_guidelines', details[1]['full_data'])
+        priced.assert_called_once_with('J45.909', 'Unspecified asthma, uncomplicated')
+
+    def test_failed_code_does_not_fail_the_list(self):
+        """Codes are looked up concurrently, in order, and a failing code only drops itself."""
+        import clincodeutils
+
+        def lookup(code):
+            # E11.9 gets a truncated, malformed response
+            return "{'code': 'E11.9', 'billable'" if code == 'E11.9' else f"{{'code': '{code}'}}"
+
+        codes = ['J45.909', 'E11.9', 'I10', 'J45.909']
+        with patch.object(clincodeutils, 'get_icd_index', return_value=None), \
+             patch.object(clincodeutils, 'icd_10_code_details', side_effect=lookup):
+            details = clincodeutils.icd_10_code_details_list(codes)
+        self.assertEqual([detail['code'] for detail in details], ['J45.909', 'I10', 'J45.909'])
+
+class TestBatchedLookups(unittest.TestCase):
+
+    def test_one_call_per_batch_and_retry_of_missing_codes(self):
+        """Codes are looked up in one batched call, codes it missed are retried, answers cached per code."""
+        import clincodeutils
+
+        batch_answer = json.dumps({'codes': [{'code': '99213', 'short_description': 'Office visit',
+                                              'long_description': 'Established patient office visit'}]})
+
+        def chat(llm, prompt, encrypt, **kwargs):
+            if kwargs.get('format'):
+                return {'analysis': batch_answer}
+            return {'analysis': '{"cpt": "94010", "details": {}}'}
+
+        with patch.object(clincodeutils, 'prompt_chat', side_effect=chat) as prompt, \
+             patch.object(clincodeutils, 'cached_response', return_value=None), \
+             patch.object(clincodeutils, 'cache_response') as cache:
+            details = clincodeutils.lookup_cpt_gpt(['99213', '94010', '99213'])
+        self.assertEqual(prompt.call_count, 2)
+        self.assertEqual(json.loads(details[0])['details']['short_description'], 'Office visit')
+        self.assertEqual(details[0], details[2])
+        self.assertEqual(json.loads(details[1])['cpt'], '94010')
+        self.assertEqual(cache.call_args[0][1], clincodeutils.cpt_lookup_prompt('99213'))
+
+    def test_failed_single_lookup_only_drops_its_code(self):
+        """A single-code fallback that fails leaves that code unresolved, the others are kept."""
+        import asyncio
+        import clincodeutils
+        from clincodeutils import CodeLookupPlan
+
+        async def chat(llm, prompt, encrypt, **kwargs):
+            if kwargs.get('format'):
+                return False
+            return False if '94010' in prompt else {'analysis': '{"cpt": "99213", "details": {}}'}
+
+        plan = CodeLookupPlan()
+        plan.add({'cpt': ['99213', '94010']})
+        with patch.object(clincodeutils, 'prompt_chat_async', side_effect=chat) as prompt, \
+             patch.object(clincodeutils, 'cached_response_async', new=AsyncMock(return_value=None)), \
+             patch.object(clincodeutils, 'cache_response_async', new=AsyncMock()), \
+             patch.object(clincodeutils, 'icd_10_code_details_by_code', return_value={}):
+            asyncio.run(plan.run())
+        self.assertEqual(prompt.call_count, 3)
+        self.assertEqual(plan.section_details({'cpt': ['99213', '94010']}),
+                         {'cpt': ['{"cpt": "99213", "details": {}}']})
+
+class TestCodeLookupPlan(unittest.TestCase):
+
+    def test_each_distinct_code_is_looked_up_once(self):
+        """Codes shared by sections and notes are looked up once and fanned back out per section."""
+        import asyncio
+        import clincodeutils
+        from clincodeutils import CodeLookupPlan, extract_section_codes
+
+        note_1 = extract_section_codes({'icd': {'analysis': 'J45.909'},
+                                        'cpt': {'analysis': '99213 and 94010'},
+                                        'prescription_cpt': {'analysis': '94010'}})
+        note_2 = extract_section_codes({'cpt': {'analysis': '99213'}, 'hcpcs': {'analysis': ''}})
+
+        async def describe(codes):
+            return [f'details of {code}' for code in codes]
+
+        plan = CodeLookupPlan()
+        plan.add(note_1)
+        plan.add(note_2)
+        with patch.object(clincodeutils, 'lookup_cpt_gpt_async', side_effect=describe) as cpt, \
+             patch.object(clincodeutils, 'lookup_hcpcs_gpt_async', side_effect=describe), \
+             patch.object(clincodeutils, 'icd_10_code_details_by_code', return_value={'J45.909': 'asthma'}):
+            asyncio.run(plan.run())
+        cpt.assert_called_once_with(['99213', '94010'])
+        self.assertEqual(plan.section_details(note_1), {'icd': ['asthma'],
+                                                        'cpt': ['details of 99213', 'details of 94010'],
+                                                        'prescription_cpt': ['details of 94010']})
+        self.assertEqual(plan.section_details(note_2), {'cpt': ['details of 99213'], 'hcpcs': []})
+
+class TestCodeScanner(unittest.TestCase):
+
+    def test_scan_classifies_and_validates_codes(self):
+        """One pass sorts codes by kind, drops invalid ICD codes, duplicates, amounts and ZIP+4 codes."""
+        from codescanner import CodeScanner
+        from icdindex import ICDCode, ICDIndex
+
+        index = ICDIndex([ICDCode('J45.909', True, 'Asthma', 'Asthma'), ICDCode('E11.9', True, 'T2DM', 'T2DM')])
+        scanner = CodeScanner({'cpt': {'99213'}, 'hcpcs': {'J1100'}}, index, ('icd', 'hcpcs'))
+        text = ('J45.909, E11.9 and Z99.999; CPT 99213, 0011M, 99213; HCPCS J1100, G0027. '
+                'Billed $12345.00, lab 98.6, ZIP 60601-1234')
+        self.assertEqual(scanner.scan(text), {'icd': ['J45.909', 'E11.9'],
+                                              'cpt': ['99213', '0011M'],
+                                              'hcpcs': ['J1100']})
+
+    def test_undotted_icd_codes_and_addresses(self):
+        """Undotted ICD codes are checked against the index before HCPCS, ZIP codes are not CPT codes."""
+        from codescanner import CodeScanner
+        from icdindex import ICDCode, ICDIndex
+
+        index = ICDIndex([ICDCode('J45.909', True, 'Asthma', 'Asthma'), ICDCode('E11.65', True, 'T2DM', 'T2DM'),
+                          ICDCode('J11.00', True, 'Influenza', 'Influenza')])
+        scanner = CodeScanner({'hcpcs': {'J1100'}}, index)
+        self.assertEqual(scanner.scan('J45909, E1165, J1100 and G0027'),
+                         {'icd': ['J45.909', 'E11.65'], 'cpt': [], 'hcpcs': ['J1100', 'G0027']})
+        self.assertEqual(CodeScanner({}, index).scan('ICD-10: E1165, J1100. HCPCS: J1100'),
+                         {'icd': ['E11.65', 'J11.00'], 'cpt': [], 'hcpcs': ['J1100']})
+        self.assertEqual(scanner.scan('CPT 99213. Springfield, IL 62704, ZIP code: 62705')['cpt'], ['99213'])
+
+class TestLLMJSON(unittest.TestCase):
+
+    def test_loads_repairs_llm_output(self):
+        """The first JSON value is found in prose and Python literals are repaired, failures are structured."""
+        from llmjson import loads, LLMJSONError
+
+        text = ("Here you go: {'code': 'J45.909', 'billable': True, 'note': None,\n"
+                " 'full_data': {'short_description': 'Asthma [unspecified]', 'tags': ['a', 'b',],},} Thanks!")
+        self.assertEqual(loads(text, expect=dict), {'code': 'J45.909', 'billable': True, 'note': None,
+                                                    'full_data': {'short_description': 'Asthma [unspecified]',
+                                                                  'tags': ['a', 'b']}})
+        for text, reason in (('I can not help with that.', 'no_json'),
+                             ("{'code': 'J45.909', 'full_data': {", 'unbalanced'),
+                             ('[1, 2]', 'unexpected_type')):
+            with self.assertRaises(LLMJSONError) as caught:
+                loads(text, expect=dict)
+            self.assertEqual(caught.exception.reason, reason)
+
+class TestAnalysisJobQueue(unittest.TestCase):
+
+    def test_leased_jobs_finish_with_their_note_outcome(self):
+        """Jobs are leased with SKIP LOCKED and each job records its own note's outcome."""
+        import asyncio
+        import services.jobqueue as jobqueue
+        from services.jobqueue import AnalysisJob
+
+        with patch.object(jobqueue, 'execute_write_query',
+                          side_effect=[[], [(2, 'note2', 1), (1, 'note1', 3)]]) as write:
+            jobs = jobqueue.lease_jobs('host:1', 2, 900, 3)
+        self.assertIn('FOR UPDATE SKIP LOCKED', write.call_args.args[0])
+        self.assertEqual(jobs, [AnalysisJob(1, 'note1', 3), AnalysisJob(2, 'note2', 1)])
+
+        with patch('services.scheduler.analyze_notes_in_waves',
+                   return_value={'note1': True, 'note2': False}), \
+             patch.object(jobqueue, 'finish_job', return_value=True) as finish:
+            results = asyncio.run(jobqueue.process_jobs(jobs, 'host:1', ['medllama2'], 900, 3))
+        self.assertEqual(results, {1: True, 2: False})
+        finish.assert_any_call(jobs[0], 'host:1', True, 3, None)
+        finish.assert_any_call(jobs[1], 'host:1', False, 3, 'analysis failed')
+
+    def test_notes_missing_a_model_stay_pending(self):
+        """Notes are pending until every medical model stored its analysis and no checkpoints are left."""
+        import services.analysis as analysis
+        import services.jobqueue as jobqueue
+
+        with patch.object(analysis, 'get_select_query_result_dicts',
+                          return_value=[{'patient_note_id': 'note1'}]) as select:
+            self.assertEqual(analysis.get_pending_visit_note_ids(['medllama2', 'meditron']), ['note1'])
+        sql, params = select.call_args.args
+        self.assertEqual(params, (['medllama2', 'meditron'],))
+        self.assertIn("analysis_document->>'llm' = m.llm", sql)
+        self.assertIn('FROM analysis_checkpoints', sql)
+        self.assertNotIn('NOT IN', sql)
+
+        with patch.object(jobqueue, 'execute_write_query', return_value=[(1,), (2,)]) as write:
+            self.assertEqual(jobqueue.enqueue_pending_notes(['medllama2']), 2)
+        self.assertIn(analysis.PENDING_NOTES_QUERY, write.call_args.args[0])
+        self.assertEqual(write.call_args.args[1], (['medllama2'],))
+
+    def test_worker_reuses_and_closes_its_ollama_clients(self):
+        """Batches of a worker share pooled Ollama clients, closed when the worker stops."""
+        import gptutils
+        import services.jobqueue as jobqueue
+        from services.jobqueue import AnalysisJob
+
+        clients = []
+
+        async def process(jobs, worker_id, medllms, lease_seconds, max_attempts):
+            clients.append(gptutils.get_async_client('http://127.0.0.1:11434'))
+            return {job.id: True for job in jobs}
+
+        with patch.object(jobqueue, 'lease_jobs',
+                          side_effect=[[AnalysisJob(1, 'note1', 1)], [AnalysisJob(2, 'note2', 1)], []]), \
+             patch.object(jobqueue, 'process_jobs', side_effect=process):
+            jobqueue.run_worker('host:1', once=True)
+
+        self.assertEqual(len(clients), 2)
+        self.assertIs(clients[0], clients[1])
+        self.assertTrue(clients[0]._client.is_closed)
+
+class TestWaveScheduler(unittest.TestCase):
+
+    def test_waves_are_model_homogeneous_and_failures_stay_with_their_model(self):
+        """Every note's summary runs before any diagnosis, one model at a time, and a failed model only drops itself."""
+        import asyncio
+        import clincodeutils
+        import services.scheduler as scheduler
+        from services.checkpoints import NoteCheckpoints
+
+        events, stored = [], []
+        notes = [{'patient_id': 'p1', 'patient_note_id': 'note1'}, {'patient_id': 'p2', 'patient_note_id': 'note2'}]
+
+        async def summarize(visit_note):
+            events.append(('summary', visit_note['patient_note_id']))
+            return {'analysis': 'summary'}
+
+        async def diagnose(llm, summarized_obj, route_key=None):
+            events.append((llm, route_key))
+            if (llm, route_key) == ('meditron', 'note2'):
+                return False
+            return {'analysis': llm, 'shasum_512': f'{route_key}-{llm}'}
+
+        async def sections(llm, content, route_key=None):
+            return {'icd': {'analysis': 'J45.909'}}
+
+        class Plan:
+            def add(self, section_codes):
+                pass
+
+            async def run(self):
+                events.append(('lookup', None))
+
+            def section_details(self, section_codes):
+                return {}
+
+        with patch.object(scheduler, 'get_visit_notes', return_value=notes), \
+             patch.object(scheduler, 'load_checkpoints',
+                          return_value={note['patient_note_id']: NoteCheckpoints(note['patient_note_id'])
+                                        for note in notes}), \
+             patch('services.checkpoints.save_checkpoint'), \
+             patch.object(scheduler, 'save_checkpoint'), \
+             patch.object(scheduler, 'clear_checkpoints') as clear, \
+             patch.object(scheduler, 'summarize_visit_note', side_effect=summarize), \
+             patch.object(scheduler, 'diagnose', side_effect=diagnose), \
+             patch.object(scheduler, 'decrypt_text', side_effect=lambda text: text), \
+             patch.object(scheduler, 'fetch_code_sections', side_effect=sections), \
+             patch.object(clincodeutils, 'CodeLookupPlan', Plan), \
+             patch.object(clincodeutils, 'extract_section_codes', return_value={}), \
+             patch.object(scheduler, 'build_codes_document', return_value={}), \
+             patch.object(scheduler, 'store_analysis_with_codes',
+                          side_effect=lambda note, llm, summary, analyzed, codes:
+                          stored.append(analyzed['shasum_512'])):
+            outcomes = asyncio.run(scheduler.analyze_notes_in_waves(['note1', 'note2'],
+                                                                    ['medllama2', 'meditron', 'llama3']))
+
+        self.assertEqual([event[0] for event in events],
+                         ['summary', 'summary', 'medllama2', 'medllama2', 'meditron', 'meditron',
+                          'llama3', 'llama3', 'lookup'])
+        self.assertEqual(outcomes, {'note1': True, 'note2': False})
+        self.assertEqual(sorted(stored), ['note1-llama3', 'note1-meditron', 'note1-medllama2',
+                                          'note2-llama3', 'note2-medllama2'])
+        clear.assert_called_once_with(['note1'])
+
+    def test_failed_document_write_does_not_duplicate_codes(self):
+        """A note whose document write failed stores its codes once when it is analyzed again."""
+        import asyncio
+        import psycopg2
+        import clincodeutils
+        import database
+        import services.scheduler as scheduler
+        from services.checkpoints import NoteCheckpoints
+
+        committed, failures = [], ['patient_documents']
+
+        class Connection:
+            def __init__(self):
+                self.pending = []
+
+            def cursor(self):
+                return self
+
+            def execute(self, sql_query, params=None):
+                if failures and failures[0] in sql_query:
+                    raise psycopg2.OperationalError(f'{failures.pop()} write failed')
+                self.pending.append(sql_query)
+
+            def commit(self):
+                committed.extend(self.pending)
+                self.pending = []
+
+            def rollback(self):
+                self.pending = []
+
+            def close(self):
+                pass
+
+        def connect():
+            conn = Connection()
+            return conn, conn
+
+        note = {'patient_id': 'p1', 'patient_note_id': 'note1', 'patient_locality': '01'}
+
+        async def diagnose(llm, summarized_obj, route_key=None):
+            return {'analysis': llm, 'shasum_512': 'doc1', 'timestamp': '2024-01-01T00:00:00+00:00'}
+
+        async def sections(llm, content, route_key=None):
+            return {'icd': {'analysis': 'J45.909'}}
+
+        class Plan:
+            def add(self, section_codes):
+                pass
+
+            async def run(self):
+                pass
+
+            def section_details(self, section_codes):
+                return {}
+
+        with patch.object(database, 'psql_connection', connect), \
+             patch.object(scheduler, 'get_visit_notes', return_value=[note]), \
+             patch.object(scheduler, 'load_checkpoints', side_effect=lambda ids: {'note1': NoteCheckpoints('note1')}), \
+             patch('services.checkpoints.save_checkpoint'), \
+             patch.object(scheduler, 'save_checkpoint'), \
+             patch.object(scheduler, 'clear_checkpoints'), \
+             patch.object(scheduler, 'summarize_visit_note', AsyncMock(return_value={'analysis': 'summary'})), \
+             patch.object(scheduler, 'diagnose', side_effect=diagnose), \
+             patch.object(scheduler, 'decrypt_text', side_effect=lambda text: text), \
+             patch.object(scheduler, 'fetch_code_sections', side_effect=sections), \
+             patch.object(clincodeutils, 'CodeLookupPlan', Plan), \
+             patch.object(clincodeutils, 'extract_section_codes', return_value={}), \
+             patch.object(scheduler, 'build_codes_document', return_value={}):
+            first = asyncio.run(scheduler.analyze_notes_in_waves(['note1'], ['medllama2']))
+            second = asyncio.run(scheduler.analyze_notes_in_waves(['note1'], ['medllama2']))
+
+        self.assertEqual((first, second), ({'note1': False}, {'note1': True}))
+        self.assertEqual(len([sql for sql in committed if 'patient_codes' in sql]), 1)
+        self.assertEqual(len([sql for sql in committed if 'patient_documents' in sql]), 1)
+
+class TestPipeline(unittest.TestCase):
+
+    def test_branches_run_independently_within_group_limits(self):
+        """A failed stage skips only its descendants and groups never exceed their limit."""
+        import asyncio
+        from services.pipeline import Stage, run_pipeline
+
+        running = {'diagnosis': 0}
+        peak = {'diagnosis': 0}
+
+        def stage(name, deps=(), group='', value=True):
+            async def run(results):
+                if group == 'diagnosis':
+                    running[group] += 1
+                    peak[group] = max(peak[group], running[group])
+                await asyncio.sleep(0.01)
+                if group == 'diagnosis':
+                    running[group] -= 1
+                return value
+            return Stage(name, run, deps, group)
+
+        stages = [stage('summary', value='summary')]
+        for llm in ('medllama2', 'meditron', 'llama3'):
+            stages.append(stage(f'diagnose:{llm}', ('summary',), 'diagnosis', value=llm != 'meditron' and llm))
+            stages.append(stage(f'store:{llm}', (f'diagnose:{llm}',), 'store'))
+
+        outcome = asyncio.run(run_pipeline(stages, {'diagnosis': 2}))
+        self.assertEqual(outcome.failed, {'diagnose:meditron': 'no result'})
+        self.assertEqual(outcome.skipped, {'store:meditron'})
+        self.assertIn('store:medllama2', outcome.results)
+        self.assertIn('store:llama3', outcome.results)
+        self.assertEqual(peak['diagnosis'], 2)
+
+    def test_medllms_run_concurrently_and_a_slow_one_times_out(self):
+        """Every model's branch is stored on its own, a model over its budget is dropped."""
+        import asyncio
+        import time
+        import services.pipeline as pipeline
+
+        async def diagnose(llm, summarized_obj, route_key=None):
+            await asyncio.sleep(5 if llm == 'meditron' else 0.2)
+            return {'analysis': llm, 'shasum_512': f'doc-{llm}', 'route_key': route_key}
+
+        async def summarize(visit_note):
+            return {'analysis': 'summary'}
+
+        async def sections(llm, content, route_key=None):
+            return {'icd': {'analysis': 'J45.909'}}
+
+        async def details(sections, section_codes):
+            return {'icd': []}
+
+        stored = []
+        with patch.object(pipeline, 'summarize_visit_note', side_effect=summarize), \
+             patch.object(pipeline, 'diagnose', side_effect=diagnose), \
+             patch.object(pipeline, 'decrypt_text', side_effect=lambda text: text), \
+             patch.object(pipeline, 'fetch_code_sections', side_effect=sections), \
+             patch.object(pipeline, 'lookup_code_details', side_effect=details), \
+             patch.object(pipeline, 'build_codes_document', return_value={}), \
+             patch.object(pipeline, 'store_analysis_with_codes',
+                          side_effect=lambda note, llm, summary, analyzed, codes: stored.append(llm)):
+            started = time.monotonic()
+            ok = asyncio.run(pipeline.analyze_note_pipeline(
+                {'patient_id': 'p1', 'patient_note_id': 'note1'}, ['medllama2', 'meditron', 'llama3'],
+                timeouts={'meditron': 0.5}))
+            elapsed = time.monotonic() - started
+
+        self.assertFalse(ok)
+        self.assertEqual(sorted(stored), ['llama3', 'medllama2'])
+        self.assertLess(elapsed, 1.5)
+
+    def test_checkpointed_stages_are_resumed(self):
+        """Stages completed by an earlier run are not run again, new ones are checkpointed."""
+        import asyncio
+        import datetime
+        import json
+        import services.checkpoints as checkpoints
+        from services.checkpoints import NoteCheckpoints
+        from services.pipeline import Stage, run_pipeline
+
+        ran = []
+
+        def stage(name, deps=()):
+            async def run(results):
+                ran.append(name)
+                return {'analysis': name, 'timestamp': datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)}
+            return Stage(name, run, deps)
+
+        saved = {}
+        with patch.object(checkpoints, 'execute_write_query',
+                          side_effect=lambda sql, params, fetch: saved.update({params[:3]: params[3]})):
+            note = NoteCheckpoints('note1', {'summary': {'analysis': 'earlier summary'}})
+            outcome = asyncio.run(run_pipeline([stage('summary'), stage('diagnose:meditron', ('summary',))],
+                                               checkpoints=note))
+
+        self.assertEqual(ran, ['diagnose:meditron'])
+        self.assertEqual(outcome.resumed, {'summary'})
+        self.assertEqual(json.loads(saved[('note1', 'meditron', 'diagnose')]),
+                         {'analysis': 'diagnose:meditron', 'timestamp': '2024-01-01T00:00:00+00:00'})
+
+class TestConversation(unittest.TestCase):
+
+    def test_questions_share_the_context_prefix(self):
+        """Every question starts with the same context messages and follow-ups carry history."""
+        from gptutils import Conversation
+
+        conversation = Conversation('medllama2', 'Diagnosis: hypertension', route_key='note-1')
+        icd = conversation.messages('What are the ICD codes?')
+        cpt = conversation.messages('What are the CPT codes?', (('What medication?', 'Lisinopril'),))
+        self.assertEqual(icd[:2], cpt[:2])
+        self.assertEqual(icd[0]['content'], 'Diagnosis: hypertension')
+        self.assertEqual([m['role'] for m in cpt], ['user', 'assistant', 'user', 'assistant', 'user'])
+        self.assertEqual(cpt[-1]['content'], 'What are the CPT codes?')
+
+class TestStructuredCodes(unittest.TestCase):
+
+    def test_structured_response_becomes_sections(self):
+        """A schema-conforming response is split into per-section envelopes, anything else falls back."""
+        import asyncio
+        from services.analysis import _fetch_code_sections_structured
+
+        envelope = {'timestamp': 'ts', 'shasum_512': 'sha',
+                    'analysis': json.dumps({'icd': ['J45.909', 'E11.9'], 'prescriptions': ['albuterol', 'prednisone']})}
+        with patch('services.analysis.prompt_chat_async', new=AsyncMock(return_value=envelope)):
+            sections = asyncio.run(_fetch_code_sections_structured('medllama2', 'asthma', 'note-1'))
+        self.assertEqual(sections['icd']['analysis'], 'J45.909, E11.9')
+        self.assertEqual(sections['prescription']['analysis'], 'albuterol\nprednisone')
+        self.assertEqual(sections['cpt']['analysis'], '')
+
+        envelope['analysis'] = 'J45.909 is the code'
+        with patch('services.analysis.prompt_chat_async', new=AsyncMock(return_value=envelope)):
+            self.assertIsNone(asyncio.run(_fetch_code_sections_structured('medllama2', 'asthma', 'note-1')))
+
+class TestOllamaStub(unittest.TestCase):
+
+    def setUp(self):
+        import gptutils
+        from healthmonitor import HealthMonitor
+        from llmrouter import OllamaRouter
+        from tools.ollama_stub import start_stub
+
+        self.stub = start_stub(time_scale=0, seed=1)
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        monitor = HealthMonitor(ttl=60, probe_interval=0)
+        for name, value in (('HEALTH_MONITOR', monitor),
+                            ('ROUTER', OllamaRouter([self.stub.url], monitor)),
+                            ('RESPONSE_CACHE', None)):
+            patcher = patch.object(gptutils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_code_sections_end_to_end(self):
+        """fetch_code_sections runs against the stub server without a live Ollama."""
+        import asyncio
+        from clincodeutils import extract_icd10_codes
+        from services.analysis import fetch_code_sections
+
+        sections = asyncio.run(fetch_code_sections('medllama2', 'Diagnosis: asthma', 'note-1'))
+        self.assertEqual(set(sections), {'icd', 'cpt', 'hcpcs', 'prescription', 'prescription_cpt', 'prescription_hcpcs'})
+        self.assertEqual(extract_icd10_codes(sections['icd']['analysis']), ['J45.909', 'E11.9'])
+
+    def test_record_then_replay(self):
+        """A recorded exchange is served from the recording once Ollama is gone."""
+        import tempfile
+        import gptutils
+        from llmreplay import Recorder, Replayer
+
+        path = os.path.join(tempfile.mkdtemp(), 'recording.jsonl')
+        with patch.object(gptutils, 'RECORDER', Recorder(path)):
+            recorded = gptutils.prompt_chat('phi4', 'What disease does this patient have?', False)
+        self.assertTrue(recorded)
+
+        self.stub.shutdown()
+        with patch.object(gptutils, 'REPLAYER', Replayer(path)), \
+             patch.object(gptutils.ROUTER, 'pick', side_effect=AssertionError('Ollama was called')):
+            replayed = gptutils.prompt_chat('phi4', 'What disease does this patient have?', False)
+        self.assertEqual(replayed['analysis'], recorded['analysis'])
+
+    def test_hung_host_opens_its_breaker(self):
+        """Timeouts of a hanging host count against its breaker when the deadline equals OLLAMA_TIMEOUT."""
+        import gptutils
+        from healthmonitor import HealthMonitor, OPEN
+        from llmrouter import OllamaRouter
+        from tools.ollama_stub import start_stub
+
+        hung = start_stub(load_time=5, jitter=0)
+        self.addCleanup(hung.server_close)
+        self.addCleanup(hung.shutdown)
+        monitor = HealthMonitor(ttl=60, probe_interval=0, failure_threshold=3)
+        with patch.object(gptutils, 'HEALTH_MONITOR', monitor), \
+             patch.object(gptutils, 'ROUTER', OllamaRouter([hung.url], monitor)), \
+             patch.object(gptutils, 'OLLAMA_TIMEOUT', 0.3):
+            for attempt in range(3):
+                self.assertFalse(gptutils.prompt_chat('phi4', f'Question {attempt}', False, deadline=0.3))
+        self.assertEqual(monitor.breaker(hung.url).state, OPEN)
+
+    def test_deadline_capped_trial_does_not_block_the_host(self):
+        """A half-open trial cut by the caller's deadline leaves the host usable by the next call."""
+        import gptutils
+        from healthmonitor import HealthMonitor, CLOSED
+        from llmrouter import OllamaRouter
+        from tools.ollama_stub import start_stub
+
+        slow = start_stub(load_time=2, prompt_rate=1e6, token_rate=1e6, jitter=0)
+        self.addCleanup(slow.server_close)
+        self.addCleanup(slow.shutdown)
+        monitor = HealthMonitor(ttl=60, probe_interval=0, failure_threshold=1, reset_timeout=0)
+        monitor.record_failure(slow.url)
+        with patch.object(gptutils, 'HEALTH_MONITOR', monitor), \
+             patch.object(gptutils, 'ROUTER', OllamaRouter([slow.url], monitor)):
+            self.assertFalse(gptutils.prompt_chat('phi4', 'Loading question', False, deadline=0.3))
+            self.assertTrue(gptutils.prompt_chat('phi4', 'Next question', False))
+        self.assertEqual(monitor.breaker(slow.url).state, CLOSED)
+
+    def test_branch_timeout_cancels_its_ollama_request(self):
+        """A model branch over its budget stops its request, so the host has no outstanding work left."""
+        import asyncio
+        import gptutils
+        from healthmonitor import HealthMonitor
+        from llmrouter import OllamaRouter
+        from services.pipeline import BranchBudget
+        from tools.ollama_stub import start_stub
+
+        slow = start_stub(load_time=5, jitter=0)
+        self.addCleanup(slow.server_close)
+        self.addCleanup(slow.shutdown)
+        monitor = HealthMonitor(ttl=60, probe_interval=0)
+        router = OllamaRouter([slow.url], monitor)
+
+        async def branch():
+            with self.assertRaises(asyncio.TimeoutError):
+                await BranchBudget('meditron', 0.3).run(gptutils.prompt_chat_async('meditron', 'Diagnose', False))
+            await asyncio.sleep(0.1)
+            return router.status()[slow.url]['outstanding']
+
+        with patch.object(gptutils, 'HEALTH_MONITOR', monitor), patch.object(gptutils, 'ROUTER', router):
+            self.assertEqual(asyncio.run(branch()), 0)
+
+    def test_async_prompts_respect_concurrency_limits(self):
+        """Concurrent prompt_chat_async calls overlap on the server, bounded per model and per host."""
+        import asyncio
+        import threading
+        import gptutils
+        from healthmonitor import HealthMonitor
+        from llmrouter import OllamaRouter
+        from tools.ollama_stub import StubHandler, start_stub
+
+        stub = start_stub(load_time=0, prompt_rate=1e6, token_rate=50, jitter=0,
+                          canned=[{'match': 'Question', 'response': 'one two three four five six seven eight nine ten'}])
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        lock = threading.Lock()
+        running = {'host': 0}
+        peaks = {'host': 0}
+        chat = StubHandler._chat
+
+        def counted_chat(handler, request):
+            keys = ('host', request['model'])
+            with lock:
+                for key in keys:
+                    running[key] = running.get(key, 0) + 1
+                    peaks[key] = max(peaks.get(key, 0), running[key])
+            try:
+                chat(handler, request)
+            finally:
+                with lock:
+                    for key in keys:
+                        running[key] -= 1
+
+        async def fan_out():
+            return await asyncio.gather(*(gptutils.prompt_chat_async(llm, f'Question {n} for {llm}', False)
+                                          for llm in ('medllama2', 'meditron') for n in range(4)))
+
+        monitor = HealthMonitor(ttl=60, probe_interval=0)
+        with patch.object(StubHandler, '_chat', counted_chat), \
+             patch.object(gptutils, 'HEALTH_MONITOR', monitor), \
+             patch.object(gptutils, 'ROUTER', OllamaRouter([stub.url], monitor)), \
+             patch.object(gptutils, 'OLLAMA_MAX_CONCURRENCY_PER_MODEL', 2), \
+             patch.object(gptutils, 'OLLAMA_MAX_CONCURRENCY_PER_HOST', 3):
+            results = asyncio.run(fan_out())
+        self.assertTrue(all(result and result['analysis'].startswith('one two') for result in results))
+        self.assertEqual(stub.state.requests, 8)
+        self.assertEqual(peaks['host'], 3)
+        self.assertLessEqual(peaks['medllama2'], 2)
+        self.assertLessEqual(peaks['meditron'], 2)
+
+    def test_stream_stops_after_the_first_json_object(self):
+        """A streamed answer ends with its first balanced JSON object and frees its connection."""
+        import gptutils
+        from healthmonitor import HealthMonitor
+        from llmrouter import OllamaRouter
+        from tools.ollama_stub import start_stub
+
+        answer = '{"code": "J45.909", "details": {"note": "a } in a string"}} Let me know if you need more.'
+        stub = start_stub(time_scale=0, canned=[{'match': 'JSON please', 'response': answer}])
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        monitor = HealthMonitor(ttl=60, probe_interval=0)
+        chunks = []
+        with patch.object(gptutils, 'HEALTH_MONITOR', monitor), \
+             patch.object(gptutils, 'ROUTER', OllamaRouter([stub.url], monitor)):
+            result = gptutils.prompt_chat('phi4', 'JSON please', False, on_chunk=chunks.append,
+                                          stop_when=gptutils.stop_after_json_object())
+            pool = gptutils.get_client(stub.url)._client._transport._pool
+            self.assertFalse([conn for conn in pool.connections
+                              if not (conn.is_idle() or conn.is_closed())])
+            again = gptutils.prompt_chat('phi4', 'JSON please, again', False)
+        self.assertEqual(json.loads(result['analysis']),
+                         {'code': 'J45.909', 'details': {'note': 'a } in a string'}})
+        self.assertNotIn('Let me know', ''.join(chunks))
+        self.assertIn('Let me know', again['analysis'])
+        self.assertEqual(stub.state.requests, 2)
+
 if __name__ == '__main__':
     unittest.main()
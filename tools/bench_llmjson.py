@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Benchmark llmjson.loads against the former ast.literal_eval path
+
+    The corpus is the responses of one or more LLM_RECORD_PATH recordings,
+    see llmreplay.py; encrypted recordings are decrypted with the service's
+    ENCRYPTION_KEY. Reports, per parser, how many responses parsed to a dict
+    and the time per response.
+
+    Usage:
+        python tools/bench_llmjson.py llm_recordings.jsonl
+        python tools/bench_llmjson.py llm_recordings.jsonl --prompt-type icd_lookup --repeat 20
+
+    ©2024, Ovais Quraishi
+"""
+
+import argparse
+import ast
+import json
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterator
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from llmjson import loads, LLMJSONError  # noqa: E402
+
+
+def literal_eval_path(text: str) -> dict:
+    """How clincodeutils parsed code details before llmjson"""
+
+    value = ast.literal_eval(text.replace('  ', '').replace('\n', ''))
+    if not isinstance(value, dict):
+        raise ValueError(f'expected dict, got {type(value).__name__}')
+    return value
+
+
+def llmjson_path(text: str) -> dict:
+    return loads(text, expect=dict)
+
+
+def recorded_responses(paths: list[str], prompt_types: set[str]) -> Iterator[str]:
+    """Responses of the recordings, optionally of some prompt types only"""
+
+    decrypt = None
+    for path in paths:
+        with open(path, encoding='utf-8') as afile:
+            for line in afile:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line)
+                if prompt_types and exchange.get('prompt_type') not in prompt_types:
+                    continue
+                response = exchange['response']
+                if exchange.get('encrypted'):
+                    if decrypt is None:
+                        from encryption import decrypt_text as decrypt
+                    response = decrypt(response)
+                yield response
+
+
+def bench(parse: Callable[[str], dict], corpus: list[str], repeat: int) -> tuple[int, Counter, float]:
+    """Responses parsed, failures by reason and seconds per response"""
+
+    parsed = 0
+    failures: Counter = Counter()
+    for text in corpus:
+        try:
+            parse(text)
+            parsed += 1
+        except LLMJSONError as e:
+            failures[e.reason] += 1
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError) as e:
+            failures[type(e).__name__] += 1
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            try:
+                parse(text)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                pass
+    elapsed = time.perf_counter() - started
+    return parsed, failures, elapsed / max(1, repeat * len(corpus))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark LLM JSON parsing on recorded responses')
+    parser.add_argument('recordings', nargs='+', help='LLM_RECORD_PATH JSONL files')
+    parser.add_argument('--prompt-type', action='append', default=[],
+                        help='only responses of this prompt type, may be repeated')
+    parser.add_argument('--repeat', type=int, default=10, help='timed passes over the corpus')
+    args = parser.parse_args()
+
+    corpus = list(recorded_responses(args.recordings, set(args.prompt_type)))
+    if not corpus:
+        sys.exit('No recorded responses found')
+
+    print(f'{len(corpus)} responses')
+    for name, parse in (('ast.literal_eval', literal_eval_path), ('llmjson', llmjson_path)):
+        parsed, failures, per_response = bench(parse, corpus, args.repeat)
+        print(f'{name:<18} parsed {parsed:>6}/{len(corpus)}  {per_response * 1e6:>9.1f} us/response  '
+              f'failures {dict(failures)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Build the offline ICD-10-CM index read by icdindex.py
+
+    The code set comes from a CMS icd10cm_order_<year>.txt file, which has
+    separate short and long descriptions (--order-file), or else from the
+    simple_icd_10_cm package. Billable codes are the leaves of the code
+    hierarchy, i.e. the header flag 1 in the CMS file.
+
+    Usage:
+        python tools/build_icd_index.py --output icd10cm_index.tsv.gz
+        python tools/build_icd_index.py --order-file icd10cm_order_2024.txt
+
+    ©2024, Ovais Quraishi
+"""
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import Iterator
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from icdindex import ICDCode, ICDIndex, ICD_INDEX_PATH, add_dot  # noqa: E402
+
+
+def codes_from_order_file(path: str) -> Iterator[ICDCode]:
+    """Codes of a CMS icd10cm_order file, fixed width: order number, code,
+        header flag (1 = billable), short and long description
+    """
+
+    with open(path, encoding='utf-8') as afile:
+        for line in afile:
+            if len(line) < 77:
+                continue
+            yield ICDCode(add_dot(line[6:13].strip()), line[14] == '1', line[16:76].strip(), line[77:].strip())
+
+
+def codes_from_simple_icd_10_cm() -> Iterator[ICDCode]:
+    """Categories and subcategories of the simple_icd_10_cm code set"""
+
+    import simple_icd_10_cm as cm
+
+    for code in cm.get_all_codes(with_dots=True):
+        if cm.is_category_or_subcategory(code) or cm.is_extended_subcategory(code):
+            description = cm.get_description(code)
+            yield ICDCode(code, cm.is_leaf(code), description, description)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Build the offline ICD-10-CM index')
+    parser.add_argument('--order-file', help='CMS icd10cm_order_<year>.txt to build from')
+    parser.add_argument('--output', default=ICD_INDEX_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    codes = codes_from_order_file(args.order_file) if args.order_file else codes_from_simple_icd_10_cm()
+    index = ICDIndex(codes)
+    index.write(args.output)
+    logging.info('Wrote %s ICD-10-CM codes to %s', len(index), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""Stub Ollama server for offline pipeline runs and benchmarks
+
+    Implements HEAD /, GET /, GET /api/tags, POST /api/show and POST
+    /api/chat (streaming and not) with the standard library only.
+    Response time is simulated from a model load time, prompt evaluation
+    and generation token rates plus log-normal jitter, and reported in the
+    usual total_duration/load_duration/prompt_eval_*/eval_* fields.
+
+    Responses come from, in order:
+        1. a recording written with LLM_RECORD_PATH (--replay)
+        2. canned responses, a JSON list of {"match": "substring",
+           "response": "text"} checked against the last message (--responses)
+        3. built-in answers shaped like what the pipeline's prompts expect
+
+    Usage:
+        python tools/ollama_stub.py --port 11434 --token-rate 15 --replay recording.jsonl
+
+    ©2024, Ovais Quraishi
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Any, Optional
+
+# recordings are keyed and encrypted the way gptutils writes them
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from llmreplay import Replayer, exchange_key  # noqa: E402
+
+DEFAULT_MODELS = ('llama3.2', 'phi4', 'medllama2', 'meditron')
+
+SAMPLE_CODES = {
+                'icd': ['J45.909', 'E11.9'],
+                'cpt': ['99213', '94010'],
+                'hcpcs': ['J1100'],
+                'prescriptions': ['albuterol inhaler', 'prednisone'],
+                'prescription_cpt': ['94640'],
+                'prescription_hcpcs': ['J7613']
+               }
+
+
+@dataclass
+class StubSettings:
+    """Simulated model behaviour"""
+    models: tuple[str, ...] = DEFAULT_MODELS
+    load_time: float = 2.0
+    prompt_rate: float = 200.0
+    token_rate: float = 20.0
+    jitter: float = 0.2
+    time_scale: float = 1.0
+    canned: list[dict[str, str]] = field(default_factory=list)
+    replayer: Optional[Replayer] = None
+    seed: Optional[int] = None
+
+
+def _tag(model: str) -> str:
+    return model if ':' in model else f'{model}:latest'
+
+
+def _tokens(text: str) -> int:
+    """Rough token count, ~1.3 tokens per word"""
+
+    return max(1, int(len(text.split()) * 1.3))
+
+
+def _num_predict(request: dict[str, Any]) -> int:
+    """Generation limit of a request, 0 if unlimited"""
+
+    return max(0, int((request.get('options') or {}).get('num_predict') or 0))
+
+
+def _from_schema(schema: dict[str, Any], name: str = '') -> Any:
+    """Sample value for a JSON schema, codes for known property names"""
+
+    kind = schema.get('type')
+    if kind == 'object' or 'properties' in schema:
+        return {key: _from_schema(value, key) for key, value in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return list(SAMPLE_CODES.get(name, ['stub']))
+    if kind in ('integer', 'number'):
+        return 0
+    if kind == 'boolean':
+        return True
+    return 'stub'
+
+
+def builtin_response(question: str, format: Optional[Any]) -> str:
+    """Answer shaped like what the pipeline's prompts ask for"""
+
+    batch = re.search(r'Explain each of the following (CPT|HCPCS) codes: (.+?)\. Respond', question)
+    if batch and isinstance(format, dict):
+        return json.dumps({'codes': [{'code': code, 'short_description': f'Stub {code}',
+                                      'long_description': f'Stub description of {code}'}
+                                     for code in batch.group(2).split(', ')]})
+    if isinstance(format, dict):
+        return json.dumps(_from_schema(format))
+    if format == 'json':
+        return json.dumps({'response': 'stub'})
+
+    reimbursement = re.search(r'Estimate reimbursement rates for ICD-10 code', question)
+    if reimbursement:
+        return ("{'insurance_company': {'reimbursement_rate': '$100-$200', 'billing_instructions': 'Stub'}, "
+                "'medical_provider': {'reimbursement_rate': '$50-$100', 'billing_instructions': 'Stub'}}")
+
+    icd = re.search(r'ICD-10 code (\S+?),', question)
+    if icd:
+        return ("{'code': '%s', 'billable': True, 'full_data': {'short_description': 'Stub %s', "
+                "'long_description': 'Stub description of %s', 'billing_guidelines': {'insurance_company': "
+                "{'reimbursement_rate': '$100-$200', 'billing_instructions': 'Stub'}, 'medical_provider': "
+                "{'reimbursement_rate': '$50-$100', 'billing_instructions': 'Stub'}}}}") % ((icd.group(1),) * 3)
+
+    lookup = re.search(r'Explain (CPT|HCPCS) code (\S+?)\.', question)
+    if lookup:
+        key = lookup.group(1).lower()
+        return json.dumps({key: lookup.group(2),
+                           'details': {'short_description': f'Stub {lookup.group(2)}',
+                                       'long_description': f'Stub description of {lookup.group(2)}'}})
+
+    return ('Based on the information provided, the likely diagnosis is asthma. '
+            f"ICD-10 codes: {', '.join(SAMPLE_CODES['icd'])}. "
+            f"CPT codes: {', '.join(SAMPLE_CODES['cpt'])}. "
+            f"HCPCS codes: {', '.join(SAMPLE_CODES['hcpcs'])}. "
+            f"Prescribe {' and '.join(SAMPLE_CODES['prescriptions'])}.")
+
+
+class StubState:
+    """Loaded models and response selection shared by request handlers"""
+
+    def __init__(self, settings: StubSettings) -> None:
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.loaded: set[str] = set()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def respond(self, request: dict[str, Any]) -> tuple[str, dict[str, int]]:
+        """Response text and simulated metrics (in seconds) of a chat request"""
+
+        model = request.get('model', '')
+        messages = request.get('messages') or []
+        question = messages[-1]['content'] if messages else ''
+
+        text = recorded_metrics = None
+        if self.settings.replayer is not None:
+            recorded = self.settings.replayer.get(exchange_key(model, messages, request.get('options'),
+                                                               request.get('format')))
+            if recorded is not None:
+                text, recorded_metrics = recorded
+        if text is None:
+            for rule in self.settings.canned:
+                if rule['match'] in question:
+                    text = rule['response']
+                    break
+        if text is None:
+            text = builtin_response(question, request.get('format'))
+        num_predict = _num_predict(request)
+        if num_predict and _tokens(text) > num_predict:
+            # generation limit, cut like Ollama does
+            text = ' '.join(text.split()[:max(1, int(num_predict / 1.3))])
+
+        with self._lock:
+            self.requests += 1
+            load = 0.0 if _tag(model) in self.loaded else self.settings.load_time
+            self.loaded.add(_tag(model))
+            if request.get('keep_alive') in (0, '0', '0s'):
+                self.loaded.discard(_tag(model))
+            jitter = self.random.lognormvariate(0, self.settings.jitter) if self.settings.jitter else 1.0
+
+        prompt_tokens = sum(_tokens(message.get('content', '')) for message in messages)
+        eval_tokens = min(_tokens(text), num_predict) if num_predict else _tokens(text)
+        timings = {
+                   'load_duration': load,
+                   'prompt_eval_count': prompt_tokens,
+                   'prompt_eval_duration': prompt_tokens / self.settings.prompt_rate * jitter,
+                   'eval_count': eval_tokens,
+                   'eval_duration': eval_tokens / self.settings.token_rate * jitter
+                  }
+        if recorded_metrics and recorded_metrics.get('eval_duration'):
+            # a recording replays the real model's timings
+            timings = {name: recorded_metrics.get(name) or 0 for name in timings}
+            for name in ('load_duration', 'prompt_eval_duration', 'eval_duration'):
+                timings[name] /= 1e9
+        return text, timings
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Ollama API subset"""
+
+    server_version = 'OllamaStub/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    def log_message(self, format, *args) -> None:
+        logging.debug('%s %s', self.address_string(), format % args)
+
+    def _json(self, status: int, body: Any) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self) -> dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _sleep(self, seconds: float) -> None:
+        if seconds > 0 and self.state.settings.time_scale > 0:
+            time.sleep(seconds * self.state.settings.time_scale)
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        if self.path == '/api/tags':
+            self._json(200, {'models': [
+                    {
+                     'name': _tag(model),
+                     'model': _tag(model),
+                     'digest': hashlib.sha256(model.encode()).hexdigest(),
+                     'size': 0,
+                     'modified_at': '2024-01-01T00:00:00Z',
+                     'details': {'format': 'gguf', 'family': 'stub'}
+                    } for model in self.state.settings.models]})
+        elif self.path == '/':
+            payload = b'Ollama is running'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self._json(404, {'error': 'not found'})
+
+    def do_POST(self) -> None:
+        request = self._read_json()
+        if self.path == '/api/show':
+            self._show(request)
+        elif self.path == '/api/chat':
+            self._chat(request)
+        else:
+            self._json(404, {'error': 'not found'})
+
+    def _known(self, model: str) -> bool:
+        return _tag(model) in {_tag(name) for name in self.state.settings.models}
+
+    def _show(self, request: dict[str, Any]) -> None:
+        model = request.get('model') or request.get('name', '')
+        if not self._known(model):
+            self._json(404, {'error': f"model '{model}' not found"})
+            return
+        self._json(200, {
+                         'modelfile': f'FROM {model}',
+                         'parameters': '',
+                         'template': '{{ .Prompt }}',
+                         'details': {'format': 'gguf', 'family': 'stub', 'parameter_size': '0B'},
+                         'model_info': {},
+                         'modified_at': '2024-01-01T00:00:00Z'
+                        })
+
+    def _chat(self, request: dict[str, Any]) -> None:
+        model = request.get('model', '')
+        if not self._known(model):
+            self._json(404, {'error': f"model '{model}' not found, try pulling it first"})
+            return
+
+        text, timings = self.state.respond(request)
+        started = time.monotonic()
+        self._sleep(timings['load_duration'] + timings['prompt_eval_duration'])
+
+        def final(content: str) -> dict[str, Any]:
+            return {
+                    'model': model,
+                    'created_at': datetime.now(timezone.utc).isoformat(),
+                    'message': {'role': 'assistant', 'content': content},
+                    'done': True,
+                    'done_reason': 'length' if 0 < _num_predict(request) <= timings['eval_count'] else 'stop',
+                    'total_duration': int((time.monotonic() - started) * 1e9),
+                    'load_duration': int(timings['load_duration'] * 1e9),
+                    'prompt_eval_count': timings['prompt_eval_count'],
+                    'prompt_eval_duration': int(timings['prompt_eval_duration'] * 1e9),
+                    'eval_count': timings['eval_count'],
+                    'eval_duration': int(timings['eval_duration'] * 1e9)
+                   }
+
+        if request.get('stream', True) is False:
+            self._sleep(timings['eval_duration'])
+            self._json(200, final(text))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = re.findall(r'\S+\s*', text) or ['']
+        per_word = timings['eval_duration'] / len(words)
+        try:
+            for word in words:
+                self._sleep(per_word)
+                self._write_chunk({'model': model,
+                                   'created_at': datetime.now(timezone.utc).isoformat(),
+                                   'message': {'role': 'assistant', 'content': word},
+                                   'done': False})
+            self._write_chunk(final(''))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, i.e. stopped generation early
+            logging.debug('Client closed the stream for %s', model)
+            self.close_connection = True
+
+    def _write_chunk(self, obj: dict[str, Any]) -> None:
+        data = (json.dumps(obj) + '\n').encode()
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer carrying the shared StubState"""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], settings: StubSettings) -> None:
+        super().__init__(address, StubHandler)
+        self.state = StubState(settings)
+
+    def handle_error(self, request, client_address) -> None:
+        # pooled clients drop idle keep-alive connections, not an error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_stub(host: str = '127.0.0.1', port: int = 0, **settings) -> StubServer:
+    """Run a stub server in a background thread, port 0 picks a free
+        port. Stop it with shutdown().
+    """
+
+    server = StubServer((host, port), StubSettings(**settings))
+    threading.Thread(target=server.serve_forever, name='ollama-stub', daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Stub Ollama server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS),
+                        help='comma separated models to report as pulled')
+    parser.add_argument('--load-time', type=float, default=2.0,
+                        help='seconds to "load" a model on its first request')
+    parser.add_argument('--prompt-rate', type=float, default=200.0,
+                        help='prompt evaluation tokens per second')
+    parser.add_argument('--token-rate', type=float, default=20.0,
+                        help='generated tokens per second')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='sigma of the log-normal latency multiplier, 0 disables jitter')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='multiplier for simulated sleeps, 0 answers immediately')
+    parser.add_argument('--responses', help='JSON list of {"match": ..., "response": ...} canned responses')
+    parser.add_argument('--replay', help='JSONL recording written with LLM_RECORD_PATH')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    canned = []
+    if args.responses:
+        with open(args.responses, encoding='utf-8') as afile:
+            canned = json.load(afile)
+
+    replayer = None
+    if args.replay:
+        # encrypted recordings are decrypted with the service's key
+        from encryption import decrypt_text
+        replayer = Replayer(args.replay, decode=decrypt_text)
+
+    server = StubServer((args.host, args.port), StubSettings(
+        models=tuple(model.strip() for model in args.models.split(',') if model.strip()),
+        load_time=args.load_time,
+        prompt_rate=args.prompt_rate,
+        token_rate=args.token_rate,
+        jitter=args.jitter,
+        time_scale=args.time_scale,
+        canned=canned,
+        replayer=replayer,
+        seed=args.seed))
+    logging.info('Stub Ollama server listening on %s', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ import requests
 import string
 from datetime import datetime as DT
 from database import get_icd_billable_estimates
+from retrypolicy import RetryPolicy
 
 # set the locale English (United States)
 locale.setlocale(locale.LC_ALL, 'en_US')
@@ -89,12 +90,12 @@ def serialize_datetime(obj):
         return obj.isoformat() 
     raise TypeError("Type not serializable")
 
-def check_endpoint_health(url):
+def check_endpoint_health(url, timeout=5):
     """Check if endpoint is available
     """
 
     try:
-        response = requests.head(url)
+        response = requests.head(url, timeout=timeout)
         if response.status_code == requests.codes.ok:
             return True
         else:
@@ -103,20 +104,11 @@ def check_endpoint_health(url):
         return False
 
 def retry_with_timeout(max_retry_count, timeout_seconds, func, *args, **kwargs):
-    """Retry logic
+    """Retry logic, exponential backoff with jitter within timeout_seconds
     """
 
-    start_time = time.time()
-    retry_count = 0
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            retry_count += 1
-            if retry_count >= max_retry_count or time.time() - start_time >= timeout_seconds:
-                raise e
-            print(f"Retry {retry_count} failed. Retrying...")
-            time.sleep(1)  # Wait for 1 second before retrying
+    policy = RetryPolicy(max_attempts=max_retry_count, base_delay=1.0, deadline=timeout_seconds)
+    return policy.call(lambda attempt, remaining: func(*args, **kwargs))
 
 def replace_newline_in_dict(a_dict, replacement=''):
     """Remove newlines from a dict object generated by LLM
@@ -10,16 +10,13 @@ from flask_jwt_extended import JWTManager, jwt_required, create_access_token
 
 # Import required local modules
 from config import get_config
-from clincodeutils import extract_icd10_codes
-from clincodeutils import extract_cpt_codes
-from clincodeutils import extract_hcpcs_codes
-from clincodeutils import icd_10_code_details_list
-from clincodeutils import lookup_cpt_gpt
-from clincodeutils import lookup_hcpcs_gpt
+from clincodeutils import CodeLookupPlan
+from clincodeutils import extract_section_codes
 from database import insert_data_into_table
 from database import get_select_query_result_dicts
 from encryption import decrypt_text
 from gptutils import prompt_chat
+from gptutils import prompt_chat_async
 from utils import ts_int_to_dt_obj
 from utils import serialize_datetime
 
@@ -126,7 +123,7 @@ def analyze_visit_note(visit_note_id):
         content = decrypt_text(visit_note['patient_note']['note'])
 
         prompt = "What disease does this patient have? P is patient, D is Doctor"
-        summarized_obj = prompt_chat('phi4', prompt + content)
+        summarized_obj = prompt_chat('phi4', prompt + content, prompt_type='summary')
 
         if summarized_obj:
             recommended_diagnosis = decrypt_text(summarized_obj['analysis'])
@@ -136,9 +133,11 @@ def analyze_visit_note(visit_note_id):
                 analyzed_obj =             prompt_chat(
                                                        llm,
                                                        'Diagnose this patient: ' +
-                                                       recommended_diagnosis
+                                                       recommended_diagnosis,
+                                                       prompt_type='diagnosis'
                                                       )
-                                          
+                if not analyzed_obj:
+                    return False
 
                 # decrypt analysis result for ICD/CPT processing only
                 decrypted_analysis = decrypt_text(analyzed_obj['analysis'])
@@ -176,7 +175,8 @@ def analyze_visit_note(visit_note_id):
                                         }
 
                 insert_data_into_table('patient_documents', patient_analysis_data)
-                return True
+            # every medical LLM analyzed
+            return True
         else:
             return False
 
@@ -197,7 +197,7 @@ async def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed
         prompts['prescription_cpt'] = prompts['prescription']
 
     async def fetch_code(prompt_key, content):
-        return prompt_chat(llm, prompts[prompt_key] + content, False)
+        return await prompt_chat_async(llm, prompts[prompt_key] + content, False, prompt_type=prompt_key)
 
     # Gather all asynchronous tasks
     icd_obj, cpt_obj, hcpcs_obj, prescription_obj = await asyncio.gather(
@@ -215,27 +215,33 @@ async def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed
         fetch_code('prescription_hcpcs', prescription_analysis)
     )
 
-    icd_10_code_details = icd_10_code_details_list(extract_icd10_codes(icd_obj['analysis']))
-    prescription_cpt_details = lookup_cpt_gpt(extract_cpt_codes(prescription_cpt_obj['analysis']))
-    prescription_hcpcs_details = lookup_hcpcs_gpt(extract_hcpcs_codes(prescription_hcpcs_obj['analysis']))
-
-    hcpcs_codes = extract_hcpcs_codes(hcpcs_obj['analysis'])
+    # each section's codes are extracted once and every distinct code is
+    #  looked up once, even if several sections share it
+    section_codes = extract_section_codes({'icd': icd_obj,
+                                           'cpt': cpt_obj,
+                                           'hcpcs': hcpcs_obj,
+                                           'prescription_cpt': prescription_cpt_obj,
+                                           'prescription_hcpcs': prescription_hcpcs_obj})
+    plan = CodeLookupPlan()
+    plan.add(section_codes)
+    await plan.run()
+    details = plan.section_details(section_codes)
 
     codes_document = {
         'icd': {
             'timestamp': serialize_datetime(icd_obj['timestamp']),
-            'codes': extract_icd10_codes(icd_obj['analysis']),
-            'details': icd_10_code_details
+            'codes': section_codes['icd'],
+            'details': details['icd']
         },
         'cpt': {
             'timestamp': serialize_datetime(cpt_obj['timestamp']),
-            'codes': extract_cpt_codes(cpt_obj['analysis']),
-            'details': lookup_cpt_gpt(extract_cpt_codes(cpt_obj['analysis']))
+            'codes': section_codes['cpt'],
+            'details': details['cpt']
         },
         'hcpcs': {
             'timestamp': serialize_datetime(hcpcs_obj['timestamp']),
-            'codes': hcpcs_codes,
-            'details': lookup_hcpcs_gpt(hcpcs_codes)
+            'codes': section_codes['hcpcs'],
+            'details': details['hcpcs']
         },
         'prescription': {
             'timestamp': serialize_datetime(prescription_obj['timestamp']),
@@ -243,13 +249,13 @@ async def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed
         },
         'prescription_cpt': {
             'timestamp': serialize_datetime(prescription_cpt_obj['timestamp']),
-            'codes': extract_cpt_codes(prescription_cpt_obj['analysis']),
-            'details': prescription_cpt_details
+            'codes': section_codes['prescription_cpt'],
+            'details': details['prescription_cpt']
         },
         'prescription_hcpcs': {
             'timestamp': serialize_datetime(prescription_hcpcs_obj['timestamp']),
-            'codes': extract_hcpcs_codes(prescription_hcpcs_obj['analysis']),
-            'details': prescription_hcpcs_details
+            'codes': section_codes['prescription_hcpcs'],
+            'details': details['prescription_hcpcs']
         }
     }
 
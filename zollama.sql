@@ -51,6 +51,54 @@ SET default_tablespace = '';
 
 SET default_table_access_method = heap;
 
+--
+-- Name: analysis_checkpoints; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.analysis_checkpoints (
+    patient_note_id text NOT NULL,
+    llm text DEFAULT ''::text NOT NULL,
+    stage text NOT NULL,
+    result jsonb NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.analysis_checkpoints OWNER TO zollama;
+
+--
+-- Name: analysis_jobs; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.analysis_jobs (
+    id bigint NOT NULL,
+    patient_note_id text NOT NULL,
+    status text DEFAULT 'pending'::text NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    leased_by text,
+    lease_expires_at timestamp with time zone,
+    last_error text,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.analysis_jobs OWNER TO zollama;
+
+--
+-- Name: analysis_jobs_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.analysis_jobs ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.analysis_jobs_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
 --
 -- Name: cpt_hcpcs_codes; Type: TABLE; Schema: public; Owner: zollama
 --
@@ -96,6 +144,59 @@ CREATE TABLE public.embeddings (
 
 ALTER TABLE public.embeddings OWNER TO zollama;
 
+--
+-- Name: llm_calls; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.llm_calls (
+    id bigint NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    model text NOT NULL,
+    host text,
+    prompt_type text NOT NULL,
+    cache_hit boolean NOT NULL,
+    complete boolean NOT NULL,
+    error text,
+    wall_time double precision NOT NULL,
+    total_duration bigint,
+    load_duration bigint,
+    prompt_eval_count integer,
+    prompt_eval_duration bigint,
+    eval_count integer,
+    eval_duration bigint
+);
+
+
+ALTER TABLE public.llm_calls OWNER TO zollama;
+
+--
+-- Name: llm_calls_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.llm_calls ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.llm_calls_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: llm_response_cache; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.llm_response_cache (
+    cache_key text NOT NULL,
+    value text NOT NULL,
+    created_at timestamp with time zone NOT NULL,
+    accessed_at timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.llm_response_cache OWNER TO zollama;
+
 --
 -- Name: medicare_data; Type: TABLE; Schema: public; Owner: zollama
 --
@@ -215,6 +316,30 @@ ALTER TABLE public.patient_notes ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDE
 );
 
 
+--
+-- Name: analysis_checkpoints analysis_checkpoints_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_checkpoints
+    ADD CONSTRAINT analysis_checkpoints_pkey PRIMARY KEY (patient_note_id, llm, stage);
+
+
+--
+-- Name: analysis_jobs analysis_jobs_patient_note_id_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_jobs
+    ADD CONSTRAINT analysis_jobs_patient_note_id_key UNIQUE (patient_note_id);
+
+
+--
+-- Name: analysis_jobs analysis_jobs_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_jobs
+    ADD CONSTRAINT analysis_jobs_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: cpt_hcpcs_codes cpt_hcpcs_codes_pkey1; Type: CONSTRAINT; Schema: public; Owner: zollama
 --
@@ -239,6 +364,22 @@ ALTER TABLE ONLY public.embeddings
     ADD CONSTRAINT embeddings_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: llm_calls llm_calls_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.llm_calls
+    ADD CONSTRAINT llm_calls_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: llm_response_cache llm_response_cache_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.llm_response_cache
+    ADD CONSTRAINT llm_response_cache_pkey PRIMARY KEY (cache_key);
+
+
 --
 -- Name: patient_codes patient_codes_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
 --
@@ -286,6 +427,13 @@ ALTER TABLE ONLY public.patient_notes
 CREATE INDEX analysis_document_gin_index ON public.patient_documents USING gin (analysis_document jsonb_path_ops);
 
 
+--
+-- Name: idx_analysis_jobs_status; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_analysis_jobs_status ON public.analysis_jobs USING btree (status, lease_expires_at);
+
+
 --
 -- Name: idx_codes_document_gin; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -300,6 +448,20 @@ CREATE INDEX idx_codes_document_gin ON public.patient_codes USING gin (codes_doc
 CREATE INDEX idx_cpt_codes_sha256 ON public.cpt_hcpcs_codes USING btree (sha256);
 
 
+--
+-- Name: idx_llm_calls_model_prompt_type; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_llm_calls_model_prompt_type ON public.llm_calls USING btree (model, prompt_type, "timestamp");
+
+
+--
+-- Name: idx_llm_response_cache_accessed_at; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_llm_response_cache_accessed_at ON public.llm_response_cache USING btree (accessed_at);
+
+
 --
 -- Name: idx_mac; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -370,6 +532,27 @@ CREATE INDEX timestamp_index ON public.patient_notes USING btree ("timestamp");
 GRANT CREATE ON SCHEMA public TO zollama;
 
 
+--
+-- Name: TABLE analysis_checkpoints; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.analysis_checkpoints TO zollama;
+
+
+--
+-- Name: TABLE analysis_jobs; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.analysis_jobs TO zollama;
+
+
+--
+-- Name: SEQUENCE analysis_jobs_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.analysis_jobs_id_seq TO zollama;
+
+
 --
 -- Name: TABLE cpt_hcpcs_codes; Type: ACL; Schema: public; Owner: zollama
 --
@@ -391,6 +574,27 @@ GRANT SELECT,USAGE ON SEQUENCE public.cpt_hcpcs_codes_id_seq1 TO zollama;
 GRANT ALL ON TABLE public.embeddings TO zollama;
 
 
+--
+-- Name: TABLE llm_calls; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.llm_calls TO zollama;
+
+
+--
+-- Name: SEQUENCE llm_calls_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.llm_calls_id_seq TO zollama;
+
+
+--
+-- Name: TABLE llm_response_cache; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.llm_response_cache TO zollama;
+
+
 --
 -- Name: TABLE medicare_data; Type: ACL; Schema: public; Owner: zollama
 --